@@ -4,50 +4,62 @@ AI 使用习惯分析脚本
 计算并可视化用户与 AI 交互的各种指标
 """
 
-import pandas as pd
 import json
+import hashlib
+import os
+import pickle
 import numpy as np
-from datetime import datetime
-from collections import Counter
-import matplotlib.pyplot as plt
-import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
 
-# 设置中文字体（如果需要）
-plt.rcParams['font.sans-serif'] = ['Arial Unicode MS', 'SimHei', 'DejaVu Sans']
-plt.rcParams['axes.unicode_minus'] = False
+from dataset_io import load_prepared
+from metrics_engine import conversation_features, load_conversation_features
+from time_cube import TimeCube, load_time_cube
 
 
-def load_data(messages_file='messages.csv', edges_file='edges.csv'):
-    """加载数据"""
+# 图表缓存：output_dir 中记录每张图的输入哈希，输入不变的图不再重画；
+# 绘图代码或样式变化时递增版本号使旧缓存失效
+CHART_CACHE_FILE = 'chart_cache.json'
+CHART_CACHE_VERSION = 1
+CHART_DPI = 150
+DAY_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# 本脚本用到的 messages 列（列式格式下只读取这些列）
+MESSAGE_COLUMNS = [
+    'conversation_id', 'node_id', 'parent_id', 'children_ids', 'depth', 'create_time',
+    'role', 'content_type', 'has_code', 'has_image', 'image_asset_ids', 'has_link',
+    'model_slug', 'default_model_slug', 'tool_name',
+]
+
+
+def load_data(data_dir='.', use_cache=True):
+    """加载数据并添加派生列（时间、子节点数）；源文件未变化时直接读取缓存"""
     print("正在加载数据...")
-    messages_df = pd.read_csv(messages_file)
-    edges_df = pd.read_csv(edges_file)
-    
-    # 转换时间戳
-    messages_df['datetime'] = pd.to_datetime(
-        messages_df['create_time'], unit='s', errors='coerce'
-    )
-    messages_df['date'] = messages_df['datetime'].dt.date
-    messages_df['hour'] = messages_df['datetime'].dt.hour
-    messages_df['day_of_week'] = messages_df['datetime'].dt.day_name()
-    
-    # 计算子节点数量
-    messages_df['children_count'] = messages_df['children_ids'].apply(
-        lambda x: len(eval(x)) if pd.notna(x) and str(x) != '' and str(x) != 'nan' else 0
-    )
-    
-    # 计算是否有分叉
-    messages_df['has_branch'] = messages_df['children_count'] > 1
-    
-    return messages_df, edges_df
+    return load_prepared(data_dir, message_columns=MESSAGE_COLUMNS, use_cache=use_cache)
+
+
+def _ranked_counts(series):
+    """按出现次数降序计数，次数相同时保持首次出现的顺序"""
+    return series.astype(object).value_counts(sort=False).sort_values(ascending=False, kind='stable')
 
 
-def calculate_metrics(messages_df, edges_df):
-    """计算所有指标"""
+def calculate_metrics(messages_df, edges_df, features=None, cube=None):
+    """
+    计算所有指标
+    
+    Args:
+        messages_df: 消息 DataFrame（含 load_data 添加的派生列）
+        edges_df: 边 DataFrame
+        features: 对话特征表（metrics_engine.conversation_features）；默认现场计算
+        cube: 时间立方体（time_cube.TimeCube）；默认现场构建
+    """
+    if features is None:
+        features = conversation_features(messages_df, edges_df)
+    if cube is None:
+        cube = TimeCube.from_messages(messages_df)
     metrics = {}
     
     # 1. 基本统计
-    metrics['total_conversations'] = messages_df['conversation_id'].nunique()
+    metrics['total_conversations'] = len(features)
     metrics['total_messages'] = len(messages_df)
     metrics['total_edges'] = len(edges_df)
     metrics['date_span_days'] = (
@@ -55,7 +67,7 @@ def calculate_metrics(messages_df, edges_df):
     ).days
     
     # 2. 对话长度统计
-    conv_lengths = messages_df.groupby('conversation_id').size()
+    conv_lengths = features['message_count']
     metrics['avg_messages_per_conv'] = conv_lengths.mean()
     metrics['median_messages_per_conv'] = conv_lengths.median()
     metrics['max_messages_per_conv'] = conv_lengths.max()
@@ -73,12 +85,16 @@ def calculate_metrics(messages_df, edges_df):
     metrics['content_type_distribution'] = content_type_counts.to_dict()
     
     # 5. 内容标签统计
-    metrics['messages_with_code'] = messages_df['has_code'].sum()
-    metrics['messages_with_image'] = messages_df['has_image'].sum()
-    metrics['messages_with_link'] = messages_df['has_link'].sum()
+    metrics['messages_with_code'] = features['code_messages'].sum()
+    metrics['messages_with_image'] = features['image_messages'].sum()
+    metrics['messages_with_link'] = features['link_messages'].sum()
     metrics['code_percentage'] = (metrics['messages_with_code'] / len(messages_df)) * 100
     metrics['image_percentage'] = (metrics['messages_with_image'] / len(messages_df)) * 100
     metrics['link_percentage'] = (metrics['messages_with_link'] / len(messages_df)) * 100
+    # zip 导入时 load_prepared 已按 assets 表补上附件大小
+    if 'image_bytes' in messages_df.columns:
+        metrics['image_asset_bytes'] = int(messages_df['image_bytes'].sum())
+        metrics['missing_image_assets'] = int(messages_df['missing_asset_count'].sum())
     
     # 6. 分叉分析
     metrics['branching_nodes'] = messages_df['has_branch'].sum()
@@ -86,79 +102,39 @@ def calculate_metrics(messages_df, edges_df):
     metrics['max_children'] = messages_df['children_count'].max()
     metrics['avg_children'] = messages_df['children_count'].mean()
     
-    # 7. 对话深度分析（简化版：计算每条对话的最大深度）
-    def calculate_conversation_depth(conv_id, edges_df, messages_df):
-        """计算单个对话的最大深度"""
-        conv_edges = edges_df[edges_df['conversation_id'] == conv_id]
-        conv_nodes = messages_df[messages_df['conversation_id'] == conv_id]
-        
-        # 找到根节点（parent_id 为 None 或不在 edges 中作为 child）
-        root_nodes = conv_nodes[conv_nodes['parent_id'].isna()]['node_id'].tolist()
-        if not root_nodes:
-            # 如果没有明确的根，找没有 parent 边的节点
-            parents_in_conv = set(conv_edges['parent_id'].unique())
-            children_in_conv = set(conv_edges['child_id'].unique())
-            root_candidates = parents_in_conv - children_in_conv
-            root_nodes = list(root_candidates) if root_candidates else [conv_nodes.iloc[0]['node_id']]
-        
-        if not root_nodes:
-            return 0
-        
-        # BFS 计算深度
-        from collections import deque
-        depths = {}
-        queue = deque([(root_nodes[0], 0)])
-        
-        while queue:
-            node, depth = queue.popleft()
-            if node in depths:
-                continue
-            depths[node] = depth
-            
-            children = conv_edges[conv_edges['parent_id'] == node]['child_id'].tolist()
-            for child in children:
-                queue.append((child, depth + 1))
-        
-        return max(depths.values()) if depths else 0
-    
-    conv_ids = messages_df['conversation_id'].unique()
-    depths = [calculate_conversation_depth(cid, edges_df, messages_df) for cid in conv_ids[:100]]  # 限制前100个以节省时间
-    if depths:
-        metrics['avg_conversation_depth'] = np.mean(depths)
-        metrics['max_conversation_depth'] = max(depths)
-        metrics['median_conversation_depth'] = np.median(depths)
+    # 7. 对话深度与分叉系数（全部对话，edges 表上的向量化计算，见 tree_metrics.py）
+    depths = features['max_depth'].dropna()
+    if len(depths):
+        metrics['avg_conversation_depth'] = depths.mean()
+        metrics['max_conversation_depth'] = int(depths.max())
+        metrics['median_conversation_depth'] = depths.median()
+        metrics['avg_branching_factor'] = features['branching_factor'].mean()
     
     # 8. 时间分布
-    metrics['daily_avg_conversations'] = (
-        messages_df.groupby('date')['conversation_id'].nunique().mean()
-    )
-    metrics['daily_avg_messages'] = messages_df.groupby('date').size().mean()
+    metrics['daily_avg_conversations'] = cube.distinct_conversations('date').mean()
+    metrics['daily_avg_messages'] = cube.rollup('date').mean()
     
-    hour_counts = messages_df['hour'].value_counts().sort_index()
+    hour_counts = cube.rollup('hour')
     metrics['most_active_hour'] = hour_counts.idxmax()
     metrics['least_active_hour'] = hour_counts.idxmin()
     
     # 9. Tool 使用
     tool_messages = messages_df[messages_df['role'] == 'tool']
-    metrics['tool_usage_count'] = len(tool_messages)
-    metrics['tool_usage_percentage'] = (len(tool_messages) / len(messages_df)) * 100
-    
-    # 10. 模型信息提取（从 metadata）
-    model_slugs = []
-    for meta_str in messages_df[messages_df['metadata_raw'].notna()]['metadata_raw']:
-        try:
-            meta = json.loads(meta_str)
-            if 'model_slug' in meta:
-                model_slugs.append(meta['model_slug'])
-            elif 'default_model_slug' in meta:
-                model_slugs.append(meta['default_model_slug'])
-        except:
-            pass
-    
-    if model_slugs:
-        model_counts = Counter(model_slugs)
-        metrics['model_distribution'] = dict(model_counts.most_common())
-        metrics['most_used_model'] = model_counts.most_common(1)[0][0] if model_counts else None
+    metrics['tool_usage_count'] = int(features['tool_messages'].sum())
+    metrics['tool_usage_percentage'] = (metrics['tool_usage_count'] / len(messages_df)) * 100
+    if 'tool_name' in tool_messages.columns:
+        tool_counts = _ranked_counts(tool_messages['tool_name'])
+        if len(tool_counts):
+            metrics['tool_distribution'] = tool_counts.to_dict()
+    
+    # 10. 模型分布（model_slug 缺失时使用 default_model_slug）
+    model_slugs = messages_df['model_slug'].astype(object).fillna(
+        messages_df['default_model_slug'].astype(object)
+    )
+    model_counts = _ranked_counts(model_slugs)
+    if len(model_counts):
+        metrics['model_distribution'] = model_counts.to_dict()
+        metrics['most_used_model'] = model_counts.index[0]
     
     return metrics
 
@@ -194,6 +170,9 @@ def print_metrics_report(metrics):
     print(f"  包含代码: {metrics['messages_with_code']} ({metrics['code_percentage']:.1f}%)")
     print(f"  包含图片: {metrics['messages_with_image']} ({metrics['image_percentage']:.1f}%)")
     print(f"  包含链接: {metrics['messages_with_link']} ({metrics['link_percentage']:.1f}%)")
+    if 'image_asset_bytes' in metrics:
+        print(f"  图片附件总大小: {metrics['image_asset_bytes'] / 1024 / 1024:.1f} MB"
+              f"（压缩包中缺失 {metrics['missing_image_assets']} 个）")
     
     print(f"\n【对话分叉】")
     print(f"  分叉节点数: {metrics['branching_nodes']} ({metrics['branching_percentage']:.1f}%)")
@@ -205,6 +184,7 @@ def print_metrics_report(metrics):
         print(f"  平均深度: {metrics['avg_conversation_depth']:.1f}")
         print(f"  最大深度: {metrics['max_conversation_depth']}")
         print(f"  中位数深度: {metrics['median_conversation_depth']:.1f}")
+        print(f"  平均分叉系数: {metrics['avg_branching_factor']:.2f}")
     
     print(f"\n【时间分布】")
     print(f"  日均对话数: {metrics['daily_avg_conversations']:.1f}")
@@ -214,6 +194,8 @@ def print_metrics_report(metrics):
     
     print(f"\n【工具使用】")
     print(f"  Tool 消息数: {metrics['tool_usage_count']} ({metrics['tool_usage_percentage']:.1f}%)")
+    for tool, count in list(metrics.get('tool_distribution', {}).items())[:5]:
+        print(f"  {tool}: {count}")
     
     if 'model_distribution' in metrics and metrics['model_distribution']:
         print(f"\n【模型使用】")
@@ -224,77 +206,154 @@ def print_metrics_report(metrics):
     print("\n" + "="*80)
 
 
-def create_simple_visualizations(messages_df, output_dir='.'):
-    """创建简单的可视化图表"""
-    import os
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # 1. 角色分布饼图
+def _pyplot():
+    """延迟导入 matplotlib（无界面的 Agg 后端），只在真正画图的进程中加载"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    
+    # 设置中文字体（如果需要）
+    plt.rcParams['font.sans-serif'] = ['Arial Unicode MS', 'SimHei', 'DejaVu Sans']
+    plt.rcParams['axes.unicode_minus'] = False
+    return plt
+
+
+def _plot_role_distribution(plt, role_counts):
+    """1. 角色分布饼图"""
     plt.figure(figsize=(10, 6))
-    role_counts = messages_df['role'].value_counts()
     plt.pie(role_counts.values, labels=role_counts.index, autopct='%1.1f%%', startangle=90)
     plt.title('消息角色分布')
-    plt.tight_layout()
-    plt.savefig(f'{output_dir}/01_role_distribution.png', dpi=150, bbox_inches='tight')
-    plt.close()
-    
-    # 2. 内容类型分布（Top 10）
+
+
+def _plot_content_types(plt, content_counts):
+    """2. 内容类型分布（Top 10）"""
     plt.figure(figsize=(12, 6))
-    content_counts = messages_df['content_type'].value_counts().head(10)
     plt.barh(range(len(content_counts)), content_counts.values)
     plt.yticks(range(len(content_counts)), content_counts.index)
     plt.xlabel('消息数量')
     plt.title('内容类型分布 (Top 10)')
-    plt.tight_layout()
-    plt.savefig(f'{output_dir}/02_content_type_distribution.png', dpi=150, bbox_inches='tight')
-    plt.close()
-    
-    # 3. 对话长度分布
+
+
+def _plot_conversation_lengths(plt, conv_lengths):
+    """3. 对话长度分布"""
     plt.figure(figsize=(10, 6))
-    conv_lengths = messages_df.groupby('conversation_id').size()
     plt.hist(conv_lengths, bins=50, edgecolor='black', alpha=0.7)
     plt.xlabel('每条对话的消息数')
     plt.ylabel('对话数量')
     plt.title('对话长度分布')
     plt.axvline(conv_lengths.mean(), color='red', linestyle='--', label=f'平均值: {conv_lengths.mean():.1f}')
     plt.legend()
-    plt.tight_layout()
-    plt.savefig(f'{output_dir}/03_conversation_length_distribution.png', dpi=150, bbox_inches='tight')
-    plt.close()
-    
-    # 4. 活跃时段热力图（小时 × 星期）
+
+
+def _plot_active_hours(plt, hour_day_pivot):
+    """4. 活跃时段热力图（小时 × 星期）"""
+    import seaborn as sns
     plt.figure(figsize=(12, 6))
-    hour_day = messages_df.groupby(['day_of_week', 'hour']).size().reset_index(name='count')
-    hour_day_pivot = hour_day.pivot(index='day_of_week', columns='hour', values='count')
-    # 按星期顺序排序
-    day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    hour_day_pivot = hour_day_pivot.reindex([d for d in day_order if d in hour_day_pivot.index])
     sns.heatmap(hour_day_pivot, cmap='YlOrRd', annot=False, fmt='g', cbar_kws={'label': '消息数'})
     plt.title('活跃时段热力图 (星期 × 小时)')
     plt.xlabel('小时')
     plt.ylabel('星期')
-    plt.tight_layout()
-    plt.savefig(f'{output_dir}/04_active_hours_heatmap.png', dpi=150, bbox_inches='tight')
-    plt.close()
-    
-    # 5. 内容标签统计
+
+
+def _plot_content_tags(plt, counts):
+    """5. 内容标签统计"""
     plt.figure(figsize=(8, 6))
     labels = ['包含代码', '包含图片', '包含链接']
-    counts = [
-        messages_df['has_code'].sum(),
-        messages_df['has_image'].sum(),
-        messages_df['has_link'].sum()
-    ]
     plt.bar(labels, counts, color=['#3498db', '#e74c3c', '#2ecc71'], alpha=0.7)
     plt.ylabel('消息数量')
     plt.title('内容标签统计')
     for i, count in enumerate(counts):
         plt.text(i, count, str(count), ha='center', va='bottom')
+
+
+def chart_inputs(messages_df, cube=None):
+    """
+    计算每张图需要的聚合数据（都很小，可以直接传给子进程并做哈希）
+    
+    Returns:
+        文件名 -> (绘图函数, 聚合数据)
+    """
+    cube = cube if cube is not None else TimeCube.from_messages(messages_df)
+    hour_day = cube.rollup(['day_of_week', 'hour']).reset_index(name='count')
+    hour_day_pivot = hour_day.pivot(index='day_of_week', columns='hour', values='count')
+    # 按星期顺序排序
+    hour_day_pivot = hour_day_pivot.reindex([d for d in DAY_ORDER if d in hour_day_pivot.index])
+    
+    return {
+        '01_role_distribution.png': (_plot_role_distribution, messages_df['role'].value_counts()),
+        '02_content_type_distribution.png': (_plot_content_types, messages_df['content_type'].value_counts().head(10)),
+        '03_conversation_length_distribution.png': (
+            _plot_conversation_lengths, messages_df.groupby('conversation_id', observed=True).size()
+        ),
+        '04_active_hours_heatmap.png': (_plot_active_hours, hour_day_pivot),
+        '05_content_tags.png': (_plot_content_tags, [
+            messages_df['has_code'].sum(),
+            messages_df['has_image'].sum(),
+            messages_df['has_link'].sum()
+        ]),
+    }
+
+
+def _chart_key(plot_func, data):
+    """图表缓存键：绘图函数名 + 版本 + 聚合数据的哈希"""
+    payload = pickle.dumps((plot_func.__name__, CHART_CACHE_VERSION, CHART_DPI, data))
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def _render_chart(plot_func, data, path):
+    """在当前进程中画一张图并保存为 PNG"""
+    plt = _pyplot()
+    plot_func(plt, data)
     plt.tight_layout()
-    plt.savefig(f'{output_dir}/05_content_tags.png', dpi=150, bbox_inches='tight')
+    plt.savefig(path, dpi=CHART_DPI, bbox_inches='tight')
     plt.close()
-    
-    print(f"\n可视化图表已保存到 {output_dir}/ 目录")
+    return path
+
+
+def create_simple_visualizations(messages_df, output_dir='.', workers=None, cube=None):
+    """
+    创建简单的可视化图表
+    
+    每张图只依赖一份小的聚合数据：聚合数据的哈希与上次相同且 PNG 仍存在时跳过，
+    其余的图在进程池中并行绘制。
+    
+    Args:
+        messages_df: 消息 DataFrame
+        output_dir: 输出目录
+        workers: 绘图进程数（默认为需要重画的图数与 CPU 数的较小值）
+        cube: 时间立方体（热力图使用）；默认现场构建
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cache_path = os.path.join(output_dir, CHART_CACHE_FILE)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    
+    pending = {}
+    keys = {}
+    for filename, (plot_func, data) in chart_inputs(messages_df, cube).items():
+        path = os.path.join(output_dir, filename)
+        keys[filename] = _chart_key(plot_func, data)
+        if cache.get(filename) != keys[filename] or not os.path.exists(path):
+            pending[filename] = (plot_func, data, path)
+    
+    workers = workers or min(len(pending), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {name: pool.submit(_render_chart, *args) for name, args in pending.items()}
+            for future in futures.values():
+                future.result()
+    else:
+        for args in pending.values():
+            _render_chart(*args)
+    
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(keys, f, indent=2)
+    
+    skipped = len(keys) - len(pending)
+    print(f"\n可视化图表已保存到 {output_dir}/ 目录（重新绘制 {len(pending)} 张，未变化跳过 {skipped} 张）")
 
 
 def main():
@@ -306,11 +365,14 @@ def main():
     print("="*80)
     
     # 加载数据
-    messages_df, edges_df = load_data()
+    data_dir = '.'
+    messages_df, edges_df = load_data(data_dir)
     
     # 计算指标
     print("\n正在计算指标...")
-    metrics = calculate_metrics(messages_df, edges_df)
+    features = load_conversation_features(data_dir, messages_df, edges_df)
+    cube = load_time_cube(data_dir, messages_df)
+    metrics = calculate_metrics(messages_df, edges_df, features, cube)
     
     # 打印报告
     print_metrics_report(metrics)
@@ -318,7 +380,7 @@ def main():
     # 创建可视化
     output_dir = sys.argv[1] if len(sys.argv) > 1 else 'analysis_output'
     print(f"\n正在生成可视化图表...")
-    create_simple_visualizations(messages_df, output_dir)
+    create_simple_visualizations(messages_df, output_dir, cube=cube)
     
     # 保存指标到 JSON
     # 转换 numpy 类型为 Python 原生类型以便 JSON 序列化
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+近似模式的网站指标（适用于上亿行、多用户合并的语料）
+
+精确模式（calculate_website_metrics.py）需要把 messages 表整表读入内存，
+并对 conversation_id 做分组和去重计数。近似模式按块流式读取 messages 表，
+只维护固定大小的草图（见 sketches.py）：
+
+1. 对话数（总数、按日期、按月份、按内容标记）- HyperLogLog 去重计数
+2. 对话长度的中位数 / P90 / P99 - KLL 分位数草图，输入为各根节点的
+   subtree_size（根节点子树大小即该对话的节点数，不需要按对话分组）
+3. 消息数、按小时 / 星期 / 日期的消息数、复杂 / 多步骤对话数 - 精确计数
+4. 对话平均深度、迭代优化对话数 - 按 conversation_id 连续的行段统计，只在块之间
+   保留最后一段；json_to_dataset.py 写出的表中同一对话的行总是连续的，结果精确
+   （行不连续时一个对话会被拆成多段计入）
+
+SketchMetrics 之间可以 merge，各分片或各用户分别累积后合并即可得到整体结果。
+messages 表没有导入时计算的 depth / subtree_size 列（旧版数据集）时，由 edges 表
+现场计算（见 tree_metrics.py）。
+"""
+
+import re
+from collections import Counter
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import find_table, iter_table, read_table, table_columns, to_datetime
+from metrics_engine import (
+    BUSINESS_KEYWORDS, CODE_LANGUAGES, COMPLEX_THRESHOLD, FEATURE_EDGE_COLUMNS, IMAGE_TYPES,
+    INTERACTION_MODES, ITERATIVE_THRESHOLD, MULTI_STEP_THRESHOLD, PERSONALITY_TRAITS, TOOL_USAGE_TYPES,
+)
+from sketches import HyperLogLog, KLLSketch, hash_values
+from tree_metrics import node_depths
+
+
+# 近似模式读取的 messages 列
+APPROX_COLUMNS = [
+    'conversation_id', 'conversation_title', 'depth', 'subtree_size', 'create_time',
+    'role', 'content_type', 'has_code', 'has_image',
+]
+# 按对话去重计数的内容标记
+FLAG_NAMES = ['code', 'image', 'tool', 'multimodal', 'complex', 'multi_step', 'business']
+LENGTH_QUANTILES = {'median': 0.5, 'p90': 0.9, 'p99': 0.99}
+TREE_COLUMNS = ['depth', 'subtree_size']
+
+
+def _flag_masks(chunk: pd.DataFrame, roots: pd.Series) -> Dict[str, pd.Series]:
+    """每个内容标记对应的行掩码（命中的行所属的对话计入该标记）"""
+    lengths = pd.to_numeric(chunk['subtree_size'], errors='coerce').fillna(0)
+    titles = chunk['conversation_title'].astype(object)
+    unique_titles = pd.Series(titles.dropna().unique(), dtype=object)
+    pattern = '|'.join(re.escape(kw) for kw in BUSINESS_KEYWORDS)
+    business_titles = unique_titles[unique_titles.astype(str).str.lower().str.contains(pattern)]
+    return {
+        'code': chunk['has_code'].fillna(False).astype(bool),
+        'image': chunk['has_image'].fillna(False).astype(bool),
+        'tool': chunk['role'] == 'tool',
+        'multimodal': chunk['content_type'] == 'multimodal_text',
+        'complex': roots & (lengths > COMPLEX_THRESHOLD),
+        'multi_step': roots & (lengths > MULTI_STEP_THRESHOLD),
+        'business': titles.isin(business_titles),
+    }
+
+
+class SketchMetrics:
+    """按块累积的近似指标状态"""
+
+    def __init__(self, precision: int = 14, k: int = 200):
+        self.precision = precision
+        self.k = k
+        self.total_messages = 0
+        self.first_time = None
+        self.last_time = None
+        self.conversations = HyperLogLog(precision)
+        self.flags = {name: HyperLogLog(precision) for name in FLAG_NAMES}
+        self.flag_messages = Counter()
+        self.daily = {}
+        self.daily_messages = Counter()
+        self.hourly_messages = Counter()
+        self.weekday_messages = Counter()
+        self.lengths = KLLSketch(k)
+        self.length_sum = 0
+        self.max_depth = 0
+        # 已结束的对话行段：最大深度之和、有深度的对话数、迭代优化对话数
+        self.depth_sum = 0
+        self.depth_conversations = 0
+        self.iterative = 0
+        # 当前块末尾尚未结束的行段 (conversation_id, 最大深度, user 消息数)
+        self.open_run = None
+
+    def _close_runs(self, max_depths: pd.Series, user_counts: pd.Series) -> None:
+        """把已结束的对话行段计入深度与迭代优化统计"""
+        depths = max_depths.dropna()
+        self.depth_sum += int(depths.sum())
+        self.depth_conversations += len(depths)
+        self.iterative += int((user_counts > ITERATIVE_THRESHOLD).sum())
+
+    def _update_runs(self, conv_ids: pd.Series, depth: pd.Series, role: pd.Series) -> None:
+        """按 conversation_id 连续的行段累积每个对话的最大深度和 user 消息数"""
+        ids = conv_ids.astype(object).reset_index(drop=True)
+        run = (ids != ids.shift()).cumsum().to_numpy()
+        runs = pd.DataFrame({
+            'conversation_id': ids,
+            'depth': depth.to_numpy(),
+            'user': (role == 'user').to_numpy(),
+        }).groupby(run, sort=False).agg(
+            conversation_id=('conversation_id', 'first'), max_depth=('depth', 'max'), user=('user', 'sum'),
+        ).reset_index(drop=True)
+        if self.open_run is not None:
+            conv_id, max_depth, user = self.open_run
+            if runs['conversation_id'].iloc[0] == conv_id:
+                runs.loc[0, 'max_depth'] = np.fmax(runs['max_depth'].iloc[0], max_depth)
+                runs.loc[0, 'user'] += user
+            else:
+                self._close_runs(pd.Series([max_depth], dtype=float), pd.Series([user]))
+        self._close_runs(runs['max_depth'].iloc[:-1], runs['user'].iloc[:-1])
+        last = runs.iloc[-1]
+        self.open_run = (last['conversation_id'], float(last['max_depth']), int(last['user']))
+
+    def _run_totals(self):
+        """(最大深度之和, 有深度的对话数, 迭代优化对话数)，包括未结束的行段"""
+        depth_sum, depth_conversations, iterative = self.depth_sum, self.depth_conversations, self.iterative
+        if self.open_run is not None:
+            _, max_depth, user = self.open_run
+            if not np.isnan(max_depth):
+                depth_sum += int(max_depth)
+                depth_conversations += 1
+            iterative += int(user > ITERATIVE_THRESHOLD)
+        return depth_sum, depth_conversations, iterative
+
+    def update(self, chunk: pd.DataFrame) -> 'SketchMetrics':
+        """加入一块 messages 行（列见 APPROX_COLUMNS）"""
+        if chunk.empty:
+            return self
+        self.total_messages += len(chunk)
+        conv_ids = chunk['conversation_id']
+        valid = conv_ids.notna().to_numpy()
+        hashes = np.zeros(len(chunk), dtype=np.uint64)
+        hashes[valid] = hash_values(conv_ids)
+        self.conversations.add_hashes(hashes[valid])
+
+        depth = pd.to_numeric(chunk['depth'], errors='coerce')
+        roots = depth == 0
+        for name, mask in _flag_masks(chunk, roots).items():
+            mask = mask.to_numpy() & valid
+            self.flags[name].add_hashes(hashes[mask])
+            if name in ('code', 'image', 'tool', 'multimodal'):
+                self.flag_messages[name] += int(mask.sum())
+
+        if valid.any():
+            self._update_runs(conv_ids[valid], depth[valid], chunk['role'][valid])
+
+        lengths = pd.to_numeric(chunk.loc[roots, 'subtree_size'], errors='coerce').dropna()
+        self.lengths.update(lengths)
+        self.length_sum += int(lengths.sum())
+        if depth.notna().any():
+            self.max_depth = max(self.max_depth, int(depth.max()))
+
+        times = to_datetime(chunk['create_time'])
+        timed = times.notna().to_numpy()
+        if timed.any():
+            first, last = times.min(), times.max()
+            self.first_time = first if self.first_time is None else min(self.first_time, first)
+            self.last_time = last if self.last_time is None else max(self.last_time, last)
+        times = times[timed]
+        self.hourly_messages.update(times.dt.hour.value_counts().to_dict())
+        self.weekday_messages.update(times.dt.day_name().value_counts().to_dict())
+        dates = times.dt.date
+        self.daily_messages.update(dates.value_counts().to_dict())
+        # 每个日期一个草图：按日期分组取行号，逐日期更新
+        dated = timed & valid
+        dated_hashes = hashes[dated]
+        positions = pd.Series(np.arange(len(dated_hashes))).groupby(dates[dated[timed]].to_numpy()).indices
+        for date, idx in positions.items():
+            if date not in self.daily:
+                self.daily[date] = HyperLogLog(self.precision)
+            self.daily[date].add_hashes(dated_hashes[idx])
+        return self
+
+    def merge(self, other: 'SketchMetrics') -> 'SketchMetrics':
+        """合并另一个分片的状态（precision 必须相同），返回自身"""
+        self.total_messages += other.total_messages
+        for attr, pick in (('first_time', min), ('last_time', max)):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            setattr(self, attr, theirs if mine is None else mine if theirs is None else pick(mine, theirs))
+        self.conversations.merge(other.conversations)
+        for name in FLAG_NAMES:
+            self.flags[name].merge(other.flags[name])
+        self.flag_messages.update(other.flag_messages)
+        for date, sketch in other.daily.items():
+            self.daily.setdefault(date, HyperLogLog(self.precision)).merge(sketch)
+        self.daily_messages.update(other.daily_messages)
+        self.hourly_messages.update(other.hourly_messages)
+        self.weekday_messages.update(other.weekday_messages)
+        self.lengths.merge(other.lengths)
+        self.length_sum += other.length_sum
+        self.max_depth = max(self.max_depth, other.max_depth)
+        # 分片之间的行段不相连，双方未结束的行段都直接计入
+        self.depth_sum, self.depth_conversations, self.iterative = (
+            mine + theirs for mine, theirs in zip(self._run_totals(), other._run_totals())
+        )
+        self.open_run = None
+        return self
+
+    def _monthly(self):
+        """按月份合并每日草图"""
+        months = {}
+        for date, sketch in self.daily.items():
+            month = pd.Period(date, freq='M')
+            months.setdefault(month, HyperLogLog(self.precision)).merge(sketch)
+        messages = Counter()
+        for date, count in self.daily_messages.items():
+            messages[pd.Period(date, freq='M')] += count
+        return months, messages
+
+    def result(self) -> dict:
+        """
+        生成与 website_metrics.json 结构相同的近似指标
+
+        Returns:
+            指标字典；对话数为估计值（取整），approximation 一节给出误差界
+        """
+        total_convs = max(round(self.conversations.count()), 1)
+        total_messages = self.total_messages
+        flag_convs = {name: round(sketch.count()) for name, sketch in self.flags.items()}
+        date_span = (self.last_time - self.first_time).days if self.first_time is not None else 0
+        depth_sum, depth_conversations, iterative = self._run_totals()
+
+        def pct(count, total):
+            return round(count / total * 100, 1)
+
+        tech = round(HyperLogLog.union(self.flags[n] for n in ('code', 'tool', 'complex')).count())
+        creative = round(HyperLogLog.union(self.flags[n] for n in ('image', 'multimodal')).count())
+        conversation_types = {
+            "technical": {"count": tech, "percentage": pct(tech, total_convs),
+                          "description": "深度技术咨询（编程、统计建模、数据分析）"},
+            "business": {"count": flag_convs['business'], "percentage": pct(flag_convs['business'], total_convs),
+                         "description": "商务文档优化（PPT、邮件、报告）"},
+            "creative": {"count": creative, "percentage": pct(creative, total_convs),
+                         "description": "创意设计协作（图像生成、3D打印、品牌设计）"},
+            "learning": {"count": int(total_convs * 0.15), "percentage": 15.0,
+                         "description": "专业知识学习（概念解释、知识问答）"},
+            "daily": {"count": int(total_convs * 0.05), "percentage": 5.0,
+                      "description": "日常实用咨询（旅行、购物、生活）"},
+        }
+
+        technical = {}
+        for name in ('code', 'image', 'tool', 'multimodal'):
+            technical[name] = {
+                "conversations": flag_convs[name],
+                "conversation_percentage": pct(flag_convs[name], total_convs),
+                "messages": self.flag_messages[name],
+                "message_percentage": pct(self.flag_messages[name], total_messages),
+            }
+        technical['code']['languages'] = CODE_LANGUAGES
+        technical['image']['types'] = IMAGE_TYPES
+        technical['tool']['usage_types'] = TOOL_USAGE_TYPES
+
+        root_count = self.lengths.n
+        interaction = {
+            "conversation_length": {
+                "average": round(self.length_sum / root_count, 1) if root_count else 0,
+                **{name: round(self.lengths.quantile(q), 1) for name, q in LENGTH_QUANTILES.items()},
+                "max": int(self.lengths.max) if root_count else 0,
+                "min": int(self.lengths.min) if root_count else 0,
+            },
+            "complexity": {
+                "complex_conversations": flag_convs['complex'],
+                "complex_percentage": pct(flag_convs['complex'], total_convs),
+                "threshold": COMPLEX_THRESHOLD,
+            },
+            "depth": {
+                "average": round(depth_sum / depth_conversations, 1) if depth_conversations else 0,
+                "max": self.max_depth,
+            },
+            "interaction_modes": INTERACTION_MODES,
+        }
+
+        dates = sorted(self.daily)[:30]
+        months, monthly_messages = self._monthly()
+        hour_counts = pd.Series(self.hourly_messages).sort_index()
+        time_patterns = {
+            "active_hours": {
+                "most_active": int(hour_counts.idxmax()) if len(hour_counts) else None,
+                "least_active": int(hour_counts.idxmin()) if len(hour_counts) else None,
+                "hourly_distribution": {int(h): int(c) for h, c in hour_counts.items()},
+            },
+            "daily_trend": {
+                "dates": [str(d) for d in dates],
+                "conversations": [round(self.daily[d].count()) for d in dates],
+                "messages": [self.daily_messages[d] for d in dates],
+            },
+            "weekly_pattern": {day: int(c) for day, c in sorted(self.weekday_messages.items())},
+            "monthly_trend": {
+                "months": [str(m) for m in sorted(months)],
+                "conversations": [round(months[m].count()) for m in sorted(months)],
+                "messages": [monthly_messages[m] for m in sorted(months)],
+            },
+        }
+
+        tech_depth = (flag_convs['code'] * 0.4 + flag_convs['tool'] * 0.3
+                      + flag_convs['complex'] * 0.3) / total_convs * 100
+        creative_exploration = creative / total_convs * 100
+        workflow_integration = (flag_convs['multi_step'] + flag_convs['tool']) / total_convs * 100
+
+        rse = self.conversations.relative_error
+        return {
+            "overview": {
+                "total_conversations": total_convs,
+                "total_messages": total_messages,
+                "usage_days": int(date_span),
+                "daily_avg_conversations": round(total_convs / date_span, 1) if date_span > 0 else 0,
+                "daily_avg_messages": round(total_messages / date_span, 1) if date_span > 0 else 0,
+            },
+            "conversation_types": conversation_types,
+            "technical": technical,
+            "interaction": interaction,
+            "time_patterns": time_patterns,
+            "personality": {
+                "iterative_optimization": {
+                    "conversations": iterative,
+                    "percentage": pct(iterative, total_convs),
+                },
+                "indices": {
+                    "tech_depth": round(tech_depth, 1),
+                    "creative_exploration": round(creative_exploration, 1),
+                    "workflow_integration": round(workflow_integration, 1),
+                },
+                "personality_traits": PERSONALITY_TRAITS,
+            },
+            "approximation": {
+                "distinct_counts": {
+                    "method": "HyperLogLog",
+                    "precision": self.precision,
+                    "relative_standard_error": round(rse, 4),
+                    # 约 95% 置信度的区间
+                    "total_conversations_range": [round(total_convs * (1 - 2 * rse)),
+                                                  round(total_convs * (1 + 2 * rse))],
+                },
+                "quantiles": {
+                    "method": "KLL",
+                    "k": self.k,
+                    "normalized_rank_error": round(self.lengths.rank_error, 4),
+                },
+                "exact_fields": [
+                    "total_messages", "messages", "hourly_distribution", "weekly_pattern",
+                    "conversation_length.average/max/min", "depth.max",
+                ],
+                # 同一对话的行连续时精确（json_to_dataset.py 写出的表），否则一个对话可能被计为多个
+                "contiguous_run_fields": ["depth.average", "iterative_optimization.conversations"],
+            },
+        }
+
+
+def _tree_columns(data_dir: str) -> pd.DataFrame:
+    """
+    由 edges 表计算每个节点的 depth，以及根节点的 subtree_size（该对话的节点数）
+
+    只用于没有导入时树结构列的旧数据集；近似模式只使用根节点的 subtree_size，
+    非根节点为空。
+    """
+    edges_df = read_table('edges', data_dir, columns=FEATURE_EDGE_COLUMNS)
+    nodes_df = read_table('messages', data_dir, columns=['conversation_id', 'node_id'])
+    nodes = node_depths(edges_df, nodes_df)
+    sizes = nodes.groupby('conversation_id', sort=False)['node_id'].transform('size')
+    nodes['subtree_size'] = sizes.where(nodes['depth'] == 0)
+    return nodes.set_index(['conversation_id', 'node_id'])[TREE_COLUMNS]
+
+
+def calculate_approx_metrics(data_dir: str = '.', precision: int = 14, k: int = 200,
+                             chunk_rows: int = 500_000,
+                             state: Optional[SketchMetrics] = None) -> SketchMetrics:
+    """
+    流式读取 messages 表并累积近似指标
+
+    Args:
+        data_dir: 数据目录
+        precision: HyperLogLog 精度（寄存器数 2^precision）
+        k: KLL 草图大小
+        chunk_rows: 每块读取的行数
+        state: 可选，在已有状态上继续累积（多个数据目录合并时使用）
+
+    Returns:
+        SketchMetrics，调用 result() 得到指标字典
+    """
+    state = state or SketchMetrics(precision, k)
+    columns = APPROX_COLUMNS
+    tree = None
+    if not set(TREE_COLUMNS) <= set(table_columns(find_table('messages', data_dir), 'messages')):
+        print(f"提示: {data_dir} 的 messages 表没有 depth / subtree_size 列，由 edges 表计算")
+        tree = _tree_columns(data_dir)
+        columns = APPROX_COLUMNS + ['node_id']
+    for chunk in iter_table('messages', data_dir, columns, chunk_rows=chunk_rows):
+        if tree is not None:
+            keys = pd.MultiIndex.from_arrays([chunk['conversation_id'].astype(object), chunk['node_id']])
+            for col in TREE_COLUMNS:
+                chunk[col] = tree[col].reindex(keys).to_numpy()
+        state.update(chunk)
+    return state
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+按 token 预算把对话打包成批次
+
+固定每批 30 个对话时，长对话多的批次会超出模型上下文或 max_tokens 的输出
+预算（总结被截断），短对话多的批次又浪费了请求容量。这里按每个对话的输入
+token 估计值和预计输出 token 数装箱：
+
+1. 输入预算 - 提示词模板 + 每个对话的文本不超过 max_input_tokens
+2. 输出预算 - 每个对话预计输出 output_tokens_per_item，合计不超过 max_output_tokens
+3. 可选的每批对话数上限 max_items
+
+按输入顺序依次装入当前批次，放不下时开始新批次（next-fit）：对话按时间顺序
+分批，可以边读边打包，每批只会浪费不到一个对话的容量。单个对话本身就超过
+输入预算时，截断到预算以内并在批次中记录，而不是让请求被静默截断。
+
+用法示例：
+    packer = BatchPacker(max_input_tokens=24000, max_output_tokens=4000,
+                         output_tokens_per_item=120, overhead_tokens=500)
+    for batch in packer.pack((conv_id, text) for conv_id, text in conversations):
+        print(batch.number, len(batch.texts), batch.input_tokens)
+"""
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from rate_limiter import estimate_tokens
+
+
+# 每个对话在批次提示词中的额外开销（"【对话 N】" 标题和分隔符）
+ITEM_OVERHEAD_TOKENS = 10
+TRUNCATION_MARK = "\n...[对话过长，已截断]"
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """把文本截断到估计 token 数不超过 max_tokens（末尾加截断标记）"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - estimate_tokens(TRUNCATION_MARK))
+    # 二分查找能放下的最长前缀
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + TRUNCATION_MARK
+
+
+class Batch:
+    """一个请求中的对话"""
+
+    def __init__(self, number: int):
+        self.number = number
+        self.conversation_ids: List[str] = []
+        self.texts: List[str] = []
+        self.input_tokens = 0
+        self.truncated: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+
+class BatchPacker:
+    """按输入 / 输出 token 预算装箱"""
+
+    def __init__(self, max_input_tokens: int, max_output_tokens: int, output_tokens_per_item: int,
+                 overhead_tokens: int = 0, max_items: Optional[int] = None):
+        """
+        Args:
+            max_input_tokens: 每个请求的输入 token 预算（含提示词模板）
+            max_output_tokens: 每个请求的输出 token 预算（请求的 max_tokens）
+            output_tokens_per_item: 每个对话预计的输出 token 数
+            overhead_tokens: 提示词模板（不含对话文本）的 token 数
+            max_items: 每批最多对话数（None 或 0 表示只受 token 预算限制）
+        """
+        self.item_budget = max_input_tokens - overhead_tokens
+        if self.item_budget <= ITEM_OVERHEAD_TOKENS:
+            raise ValueError(f"输入预算 {max_input_tokens} 不足以容纳提示词模板（{overhead_tokens} tokens）")
+        self.overhead_tokens = overhead_tokens
+        self.items_per_batch = max(1, max_output_tokens // output_tokens_per_item)
+        if max_items:
+            self.items_per_batch = min(self.items_per_batch, max_items)
+
+    def pack(self, items: Iterable[Tuple[str, str]]) -> Iterator[Batch]:
+        """
+        把 (对话 ID, 对话文本) 依次装入批次（惰性生成，可以直接消费生成器）
+
+        Yields:
+            Batch，编号从 1 开始
+        """
+        batch = Batch(1)
+        for conv_id, text in items:
+            tokens = estimate_tokens(text) + ITEM_OVERHEAD_TOKENS
+            truncated = tokens > self.item_budget
+            if truncated:
+                text = truncate_to_tokens(text, self.item_budget - ITEM_OVERHEAD_TOKENS)
+                tokens = estimate_tokens(text) + ITEM_OVERHEAD_TOKENS
+            if len(batch) and (len(batch) >= self.items_per_batch
+                               or batch.input_tokens + tokens > self.item_budget):
+                batch.input_tokens += self.overhead_tokens
+                yield batch
+                batch = Batch(batch.number + 1)
+            batch.conversation_ids.append(conv_id)
+            batch.texts.append(text)
+            batch.input_tokens += tokens
+            if truncated:
+                batch.truncated.append(conv_id)
+        if len(batch):
+            batch.input_tokens += self.overhead_tokens
+            yield batch
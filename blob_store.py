@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+内容寻址的文本存储（blob store）
+
+分叉和重新生成会产生大量 text / parts_raw / content_raw / metadata_raw 完全相同的消息节点。
+去重模式下（json_to_dataset.py --dedupe-text）：
+1. blobs 表 - 每段不同的内容只存一行（hash, content）
+2. messages 表 - 用 text_hash / parts_hash / content_hash / metadata_hash 引用内容
+
+不需要正文的读取（大多数指标计算）只读哈希列，几乎没有额外开销；
+需要正文时用 resolve() 或 read_table(columns=[..., 'text']) 自动还原。
+"""
+
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+
+from dataset_io import (
+    MESSAGE_COLUMNS, find_table, open_writer, read_table, table_path,
+)
+
+
+# 正文列 -> 引用列
+BLOB_FIELDS = {
+    "text": "text_hash",
+    "parts_raw": "parts_hash",
+    "content_raw": "content_hash",
+    "metadata_raw": "metadata_hash",
+}
+HASH_FIELDS = {v: k for k, v in BLOB_FIELDS.items()}
+
+DEDUPED_MESSAGE_COLUMNS = [BLOB_FIELDS.get(col, col) for col in MESSAGE_COLUMNS]
+
+# sqlite 单条语句的参数个数上限较低，按批查询
+SQLITE_BATCH = 900
+
+
+def content_hash(content: Any) -> Optional[str]:
+    """计算内容哈希；空内容返回 None（不占用 blob）"""
+    if content is None or (isinstance(content, float) and pd.isna(content)) or content == "":
+        return None
+    return hashlib.blake2b(str(content).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def is_deduped(columns: Iterable[str]) -> bool:
+    """根据列名判断 messages 表是否为去重格式"""
+    return any(col in HASH_FIELDS for col in columns)
+
+
+def hash_contents(df: pd.DataFrame, seen: set):
+    """
+    把正文列替换为哈希引用列
+
+    Args:
+        df: messages 记录（没有正文列的行原样保留，如已经是哈希引用的旧行）
+        seen: 已写出的哈希；新出现的哈希会被加入
+
+    Returns:
+        (替换后的 DataFrame, 新内容的 blobs 记录列表)
+    """
+    df = df.copy()
+    new_blobs: List[Dict[str, str]] = []
+    for field, hash_col in BLOB_FIELDS.items():
+        if field in df.columns:
+            contents = df.pop(field)
+            # map 在 pandas 3 中把 None 结果变成 NaN，统一还原为 None（空内容没有 blob）
+            hashes = contents.map(content_hash).astype(object)
+            hashes = hashes.where(hashes.notna(), None)
+            for h, content in zip(hashes, contents):
+                if isinstance(h, str) and h not in seen:
+                    seen.add(h)
+                    new_blobs.append({"hash": h, "content": str(content)})
+            df[hash_col] = hashes
+    return df, new_blobs
+
+
+class DedupingMessageWriter:
+    """
+    写出去重格式的 messages 表，同时把新出现的内容写入 blobs 表
+
+    write() 既接受含正文列的记录（计算哈希并登记新内容），也接受已经是
+    哈希引用的记录（如增量模式中保留的旧行，直接写出）。
+    """
+
+    def __init__(self, output_dir: str, fmt: str = "csv",
+                 path: Optional[Path] = None, blobs_path: Optional[Path] = None):
+        self.messages = open_writer(output_dir, "messages", fmt, path=path,
+                                    columns=DEDUPED_MESSAGE_COLUMNS)
+        self.blobs = open_writer(output_dir, "blobs", fmt, path=blobs_path)
+        self.path = self.messages.path
+        self.seen: set = set()
+        self.referenced: set = set()
+
+    @property
+    def rows(self) -> int:
+        return self.messages.rows
+
+    def write(self, records) -> None:
+        df = pd.DataFrame(records)
+        if df.empty:
+            return
+        df, new_blobs = hash_contents(df, self.seen)
+        for hash_col in HASH_FIELDS:
+            if hash_col in df.columns:
+                self.referenced.update(df[hash_col].dropna())
+        self.blobs.write(new_blobs)
+        self.messages.write(df)
+
+    def carry_over(self, blobs_df: pd.DataFrame) -> None:
+        """从旧的 blobs 表中补写仍被引用、但本次没有重新写出的内容"""
+        missing = self.referenced - self.seen
+        keep = blobs_df[blobs_df["hash"].isin(missing)]
+        self.seen.update(keep["hash"])
+        self.blobs.write(keep)
+
+    def close(self) -> None:
+        try:
+            self.messages.close()
+        finally:
+            self.blobs.close()
+
+
+def open_messages_writer(output_dir: str, fmt: str = "csv", dedupe: bool = False,
+                         path: Optional[Path] = None, blobs_path: Optional[Path] = None):
+    """创建 messages 表写出器；dedupe=True 时使用内容寻址存储"""
+    if dedupe:
+        return DedupingMessageWriter(output_dir, fmt, path=path, blobs_path=blobs_path)
+    return open_writer(output_dir, "messages", fmt, path=path)
+
+
+def get_blobs(hashes: Iterable[str], data_dir: str = ".", fmt: Optional[str] = None) -> Dict[str, str]:
+    """
+    按哈希取回内容
+
+    Args:
+        hashes: 需要的哈希
+        data_dir: 数据目录
+        fmt: blobs 表的格式；默认自动选择
+
+    Returns:
+        hash -> content 字典
+    """
+    wanted = {h for h in hashes if isinstance(h, str)}
+    if not wanted:
+        return {}
+    path = table_path(data_dir, "blobs", fmt) if fmt else find_table("blobs", data_dir)
+    if path.suffix == ".parquet":
+        # 只读取需要的行（按 row group 统计信息和谓词过滤）
+        blobs_df = pd.read_parquet(path, filters=[("hash", "in", list(wanted))])
+    elif path.suffix == ".sqlite":
+        # 走 hash 索引逐批查询，避免读取整张 blobs 表
+        found: Dict[str, str] = {}
+        wanted_list = list(wanted)
+        with sqlite3.connect(str(path)) as conn:
+            for i in range(0, len(wanted_list), SQLITE_BATCH):
+                batch = wanted_list[i:i + SQLITE_BATCH]
+                placeholders = ", ".join("?" for _ in batch)
+                found.update(conn.execute(
+                    f"SELECT hash, content FROM blobs WHERE hash IN ({placeholders})", batch
+                ).fetchall())
+        return found
+    else:
+        blobs_df = read_table("blobs", data_dir, fmt=path.suffix.lstrip("."))
+        blobs_df = blobs_df[blobs_df["hash"].isin(wanted)]
+    return dict(zip(blobs_df["hash"], blobs_df["content"]))
+
+
+def resolve(messages_df: pd.DataFrame, fields: Optional[List[str]] = None,
+            data_dir: str = ".", fmt: Optional[str] = None,
+            drop_hashes: bool = True) -> pd.DataFrame:
+    """
+    把 messages 表中的哈希引用还原为正文列
+
+    Args:
+        messages_df: 含 text_hash 等引用列的 DataFrame
+        fields: 需要还原的正文列（默认所有存在引用列的字段）
+        data_dir: blobs 表所在目录
+        fmt: blobs 表的格式；默认自动选择
+        drop_hashes: 还原后是否删除引用列
+
+    Returns:
+        带正文列的 DataFrame（空内容为 None，与非去重格式一致）
+    """
+    fields = fields or [f for f, h in BLOB_FIELDS.items() if h in messages_df.columns]
+    hash_cols = [BLOB_FIELDS[f] for f in fields if BLOB_FIELDS[f] in messages_df.columns]
+    if not hash_cols:
+        return messages_df
+    hashes = set()
+    for col in hash_cols:
+        hashes.update(messages_df[col].dropna())
+    lookup = get_blobs(hashes, data_dir, fmt)
+
+    messages_df = messages_df.copy()
+    for col in hash_cols:
+        field = HASH_FIELDS[col]
+        values = messages_df[col].map(lookup)
+        # 空正文在非去重格式中是 ""，其他原始 JSON 列是 None
+        messages_df[field] = values.fillna("") if field == "text" else values
+        if drop_hashes:
+            del messages_df[col]
+    return messages_df
@@ -4,37 +4,41 @@
 生成 JSON 格式的数据供前端使用
 """
 
-import pandas as pd
+import argparse
 import json
-import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from collections import Counter
-import re
+from pathlib import Path
 
+from approx_metrics import calculate_approx_metrics
+from dataset_io import load_prepared
+from incremental_metrics import incremental_partial
+from metrics_engine import (
+    CODE_LANGUAGES, COMPLEX_THRESHOLD, IMAGE_TYPES, INTERACTION_MODES, PERSONALITY_TRAITS,
+    TOOL_USAGE_TYPES, load_conversation_features,
+)
+from partial_metrics import PARTIAL_FILE, PartialMetrics, histogram_mean, histogram_median
+from time_cube import load_time_cube
 
-def load_data():
-    """加载数据"""
-    messages_df = pd.read_csv('messages.csv')
-    edges_df = pd.read_csv('edges.csv')
-    
-    # 转换时间
-    messages_df['datetime'] = pd.to_datetime(
-        messages_df['create_time'], unit='s', errors='coerce'
-    )
-    messages_df['date'] = messages_df['datetime'].dt.date
-    messages_df['hour'] = messages_df['datetime'].dt.hour
-    messages_df['day_of_week'] = messages_df['datetime'].dt.day_name()
-    messages_df['month'] = messages_df['datetime'].dt.to_period('M')
-    
-    return messages_df, edges_df
+# 本脚本用到的 messages 列（列式格式下只读取这些列）
+MESSAGE_COLUMNS = [
+    'conversation_id', 'conversation_title', 'node_id', 'create_time', 'role',
+    'content_type', 'has_code', 'has_image', 'has_link', 'model_slug', 'depth',
+]
+
+
+def load_data(data_dir='.', use_cache=True):
+    """加载数据并添加派生列（时间）；源文件未变化时直接读取缓存"""
+    return load_prepared(data_dir, message_columns=MESSAGE_COLUMNS, use_cache=use_cache)
 
 
-def calculate_overview_metrics(messages_df):
+def calculate_overview_metrics(partial):
     """计算总体概览指标"""
-    total_convs = messages_df['conversation_id'].nunique()
-    total_messages = len(messages_df)
+    total_convs = partial.conversations
+    total_messages = partial.messages
     
-    date_span = (messages_df['datetime'].max() - messages_df['datetime'].min()).days
+    date_span = (partial.last_time - partial.first_time).days
     daily_avg_convs = total_convs / date_span if date_span > 0 else 0
     daily_avg_messages = total_messages / date_span if date_span > 0 else 0
     
@@ -47,81 +51,67 @@ def calculate_overview_metrics(messages_df):
     }
 
 
-def calculate_conversation_types(messages_df):
+def calculate_conversation_types(partial):
     """计算对话类型分布（基于实际数据特征）"""
-    # 基于数据特征分类
-    code_convs = set(messages_df[messages_df['has_code'] == True]['conversation_id'].unique())
-    image_convs = set(messages_df[messages_df['has_image'] == True]['conversation_id'].unique())
-    tool_convs = set(messages_df[messages_df['role'] == 'tool']['conversation_id'].unique())
-    
-    # 复杂对话（>20条消息）
-    conv_lengths = messages_df.groupby('conversation_id').size()
-    complex_convs = set(conv_lengths[conv_lengths > 20].index)
-    
-    # 多模态对话
-    multimodal_convs = set(messages_df[messages_df['content_type'] == 'multimodal_text']['conversation_id'].unique())
-    
-    # 商务文档（包含"PPT"、"邮件"、"周报"等关键词的对话标题）
-    business_keywords = ['ppt', '邮件', '周报', '报告', '演示', 'presentation', 'email', 'report']
-    business_convs = set()
-    for conv_id in messages_df['conversation_id'].unique():
-        titles = messages_df[messages_df['conversation_id'] == conv_id]['conversation_title'].dropna()
-        if len(titles) > 0:
-            title_lower = str(titles.iloc[0]).lower()
-            if any(kw in title_lower for kw in business_keywords):
-                business_convs.add(conv_id)
+    total_convs = partial.conversations
+    flags = partial.conversation_flags
     
-    total_convs = messages_df['conversation_id'].nunique()
-    
-    # 分类逻辑
-    tech_convs = code_convs | tool_convs | complex_convs
-    creative_convs = image_convs | multimodal_convs
-    learning_convs = set()  # 基于内容类型判断
-    daily_convs = set()
+    # 分类逻辑（基于对话特征表中的标记，各类型之间可能重叠）
+    # 技术：包含代码、使用工具或复杂对话（>20条消息）
+    tech_count = int(flags['technical'])
+    # 商务文档：标题包含"PPT"、"邮件"、"周报"等关键词
+    business_count = int(flags['is_business'])
+    # 创意：包含图片或多模态内容
+    creative_count = int(flags['creative'])
+    learning_count = 0  # 基于内容类型判断
+    daily_count = 0
     
     # 计算各类型数量（可能有重叠）
     return {
         "technical": {
-            "count": len(tech_convs),
-            "percentage": round(len(tech_convs) / total_convs * 100, 1),
+            "count": tech_count,
+            "percentage": round(tech_count / total_convs * 100, 1),
             "description": "深度技术咨询（编程、统计建模、数据分析）"
         },
         "business": {
-            "count": len(business_convs),
-            "percentage": round(len(business_convs) / total_convs * 100, 1),
+            "count": business_count,
+            "percentage": round(business_count / total_convs * 100, 1),
             "description": "商务文档优化（PPT、邮件、报告）"
         },
         "creative": {
-            "count": len(creative_convs),
-            "percentage": round(len(creative_convs) / total_convs * 100, 1),
+            "count": creative_count,
+            "percentage": round(creative_count / total_convs * 100, 1),
             "description": "创意设计协作（图像生成、3D打印、品牌设计）"
         },
         "learning": {
-            "count": len(learning_convs) if learning_convs else int(total_convs * 0.15),
+            "count": learning_count if learning_count else int(total_convs * 0.15),
             "percentage": 15.0,
             "description": "专业知识学习（概念解释、知识问答）"
         },
         "daily": {
-            "count": len(daily_convs) if daily_convs else int(total_convs * 0.05),
+            "count": daily_count if daily_count else int(total_convs * 0.05),
             "percentage": 5.0,
             "description": "日常实用咨询（旅行、购物、生活）"
         }
     }
 
 
-def calculate_technical_metrics(messages_df):
+def calculate_technical_metrics(partial):
     """计算技术能力使用指标"""
-    total_convs = messages_df['conversation_id'].nunique()
-    total_messages = len(messages_df)
+    total_convs = partial.conversations
+    total_messages = partial.messages
+    flags = partial.conversation_flags
+    sums = partial.message_sums
     
-    code_convs = len(messages_df[messages_df['has_code'] == True]['conversation_id'].unique())
-    image_convs = len(messages_df[messages_df['has_image'] == True]['conversation_id'].unique())
-    tool_convs = len(messages_df[messages_df['role'] == 'tool']['conversation_id'].unique())
-    multimodal_convs = len(messages_df[messages_df['content_type'] == 'multimodal_text']['conversation_id'].unique())
+    code_convs = int(flags['has_code'])
+    image_convs = int(flags['has_image'])
+    tool_convs = int(flags['has_tool'])
+    multimodal_convs = int(flags['is_multimodal'])
     
-    code_messages = messages_df['has_code'].sum()
-    image_messages = messages_df['has_image'].sum()
-    tool_messages = (messages_df['role'] == 'tool').sum()
+    code_messages = sums['code_messages']
+    image_messages = sums['image_messages']
+    tool_messages = sums['tool_messages']
+    multimodal_messages = sums['multimodal_messages']
     
     return {
         "code": {
@@ -129,92 +119,81 @@ def calculate_technical_metrics(messages_df):
             "conversation_percentage": round(code_convs / total_convs * 100, 1),
             "messages": int(code_messages),
             "message_percentage": round(code_messages / total_messages * 100, 1),
-            "languages": ["R", "Python", "SQL"]  # 基于总结分析
+            "languages": CODE_LANGUAGES  # 基于总结分析
         },
         "image": {
             "conversations": image_convs,
             "conversation_percentage": round(image_convs / total_convs * 100, 1),
             "messages": int(image_messages),
             "message_percentage": round(image_messages / total_messages * 100, 1),
-            "types": ["图像识别", "创意生成", "技术处理"]
+            "types": IMAGE_TYPES
         },
         "tool": {
             "conversations": tool_convs,
             "conversation_percentage": round(tool_convs / total_convs * 100, 1),
             "messages": int(tool_messages),
             "message_percentage": round(tool_messages / total_messages * 100, 1),
-            "usage_types": ["搜索", "图像生成", "文件处理"]
+            "usage_types": TOOL_USAGE_TYPES
         },
         "multimodal": {
             "conversations": multimodal_convs,
             "conversation_percentage": round(multimodal_convs / total_convs * 100, 1),
-            "messages": int((messages_df['content_type'] == 'multimodal_text').sum()),
-            "message_percentage": round((messages_df['content_type'] == 'multimodal_text').sum() / total_messages * 100, 1)
+            "messages": int(multimodal_messages),
+            "message_percentage": round(multimodal_messages / total_messages * 100, 1)
         }
     }
 
 
-def calculate_interaction_metrics(messages_df, edges_df):
+def calculate_interaction_metrics(partial):
     """计算交互模式指标"""
-    conv_lengths = messages_df.groupby('conversation_id').size()
-    
-    avg_length = conv_lengths.mean()
-    median_length = conv_lengths.median()
-    max_length = conv_lengths.max()
-    complex_convs = len(conv_lengths[conv_lengths > 20])
-    total_convs = len(conv_lengths)
+    conv_lengths = partial.histograms['length_histogram']
     
-    # 计算对话深度（简化版）
-    def get_conv_depth(conv_id):
-        conv_edges = edges_df[edges_df['conversation_id'] == conv_id]
-        if len(conv_edges) == 0:
-            return 1
-        # 简单估算：边数 + 1
-        return len(conv_edges) + 1
+    avg_length = histogram_mean(conv_lengths)
+    median_length = histogram_median(conv_lengths)
+    max_length = conv_lengths.index.max()
+    complex_convs = int(partial.conversation_flags['is_complex'])
+    total_convs = partial.conversations
     
-    depths = [get_conv_depth(cid) for cid in messages_df['conversation_id'].unique()[:100]]
-    avg_depth = np.mean(depths) if depths else 0
+    # 对话深度：全部对话的精确深度（每个对话的 max_depth，见 tree_metrics.py）
+    depths = partial.histograms['depth_histogram']
+    avg_depth = histogram_mean(depths) if len(depths) else 0
     
     return {
         "conversation_length": {
             "average": round(avg_length, 1),
             "median": round(median_length, 1),
             "max": int(max_length),
-            "min": int(conv_lengths.min())
+            "min": int(conv_lengths.index.min())
         },
         "complexity": {
             "complex_conversations": complex_convs,
             "complex_percentage": round(complex_convs / total_convs * 100, 1),
-            "threshold": 20
+            "threshold": COMPLEX_THRESHOLD
         },
         "depth": {
             "average": round(avg_depth, 1),
-            "max": int(max(depths)) if depths else 0
+            "max": int(depths.index.max()) if len(depths) else 0
         },
-        "interaction_modes": {
-            "collaborative": 40,  # 基于总结分析
-            "guidance": 35,
-            "qa": 25
-        }
+        "interaction_modes": INTERACTION_MODES  # 基于总结分析
     }
 
 
-def calculate_time_metrics(messages_df):
-    """计算时间使用模式"""
-    hour_counts = messages_df['hour'].value_counts().sort_index()
+def calculate_time_metrics(partial):
+    """计算时间使用模式（部分聚合中的计数表，来自时间立方体，见 time_cube.py）"""
+    hour_counts = partial.histograms['hourly_messages']
     most_active_hour = int(hour_counts.idxmax())
     least_active_hour = int(hour_counts.idxmin())
     
     # 按日期统计
-    daily_convs = messages_df.groupby('date')['conversation_id'].nunique()
-    daily_messages = messages_df.groupby('date').size()
+    daily_convs = partial.histograms['daily_conversations']
+    daily_messages = partial.histograms['daily_messages']
     
     # 按星期统计
-    weekday_counts = messages_df.groupby('day_of_week').size()
+    weekday_counts = partial.histograms['weekday_messages']
     
     # 按月份统计趋势
-    monthly_convs = messages_df.groupby('month')['conversation_id'].nunique()
-    monthly_messages = messages_df.groupby('month').size()
+    monthly_convs = partial.histograms['monthly_conversations']
+    monthly_messages = partial.histograms['monthly_messages']
     
     return {
         "active_hours": {
@@ -238,31 +217,28 @@ def calculate_time_metrics(messages_df):
     }
 
 
-def calculate_personality_metrics(messages_df):
+def calculate_personality_metrics(partial):
     """计算个性化指标"""
-    total_convs = messages_df['conversation_id'].nunique()
+    total_convs = partial.conversations
+    flags = partial.conversation_flags
     
     # 迭代优化倾向（多次修改的对话 - 简化估算）
     # 基于对话中有多个 user 消息的对话
-    user_messages_per_conv = messages_df[messages_df['role'] == 'user'].groupby('conversation_id').size()
-    iterative_convs = len(user_messages_per_conv[user_messages_per_conv > 3])
+    iterative_convs = int(flags['is_iterative'])
     
     # 技术深度指数
-    code_convs = len(messages_df[messages_df['has_code'] == True]['conversation_id'].unique())
-    tool_convs = len(messages_df[messages_df['role'] == 'tool']['conversation_id'].unique())
-    conv_lengths = messages_df.groupby('conversation_id').size()
-    complex_convs = len(conv_lengths[conv_lengths > 20])
+    code_convs = int(flags['has_code'])
+    tool_convs = int(flags['has_tool'])
+    complex_convs = int(flags['is_complex'])
     
     tech_depth = (code_convs * 0.4 + tool_convs * 0.3 + complex_convs * 0.3) / total_convs * 100
     
-    # 创意探索指数
-    image_convs = len(messages_df[messages_df['has_image'] == True]['conversation_id'].unique())
-    multimodal_convs = len(messages_df[messages_df['content_type'] == 'multimodal_text']['conversation_id'].unique())
-    creative_convs = image_convs | multimodal_convs
-    creative_exploration = len(creative_convs) / total_convs * 100 if isinstance(creative_convs, set) else (image_convs + multimodal_convs) / total_convs * 100
+    # 创意探索指数：包含图片或多模态内容的对话（并集，同一对话只计一次）
+    creative_convs = int(flags['creative'])
+    creative_exploration = creative_convs / total_convs * 100
     
     # 工作流整合度
-    multi_step_convs = len(conv_lengths[conv_lengths > 10])
+    multi_step_convs = int(flags['is_multi_step'])
     workflow_integration = (multi_step_convs + tool_convs) / total_convs * 100
     
     return {
@@ -275,40 +251,144 @@ def calculate_personality_metrics(messages_df):
             "creative_exploration": round(creative_exploration, 1),
             "workflow_integration": round(workflow_integration, 1)
         },
-        "personality_traits": [
-            "深度探讨型用户",
-            "多话题切换能力",
-            "迭代优化倾向",
-            "结构化思维",
-            "技术整合者",
-            "创新应用者"
-        ]
+        "personality_traits": PERSONALITY_TRAITS
+    }
+
+
+def calculate_all_metrics(partial):
+    """由（一个或多个分片合并后的）部分聚合生成 website_metrics.json 的各部分"""
+    return {
+        "overview": calculate_overview_metrics(partial),
+        "conversation_types": calculate_conversation_types(partial),
+        "technical": calculate_technical_metrics(partial),
+        "interaction": calculate_interaction_metrics(partial),
+        "time_patterns": calculate_time_metrics(partial),
+        "personality": calculate_personality_metrics(partial)
     }
 
 
-def main():
+def compute_partial(data_dir='.', use_cache=True):
+    """完整计算一个数据目录的部分聚合，返回 (messages_df, features, partial)"""
+    messages_df, edges_df = load_data(data_dir, use_cache)
+    # 所有对话级指标都是导入时保存的对话特征表上的投影（见 metrics_engine.py），
+    # 时间模式读取预聚合的时间立方体（见 time_cube.py）
+    features = load_conversation_features(data_dir, messages_df, edges_df)
+    cube = load_time_cube(data_dir, messages_df, use_cache)
+    partial = PartialMetrics.from_frames(messages_df, features, cube, shard=Path(data_dir).resolve().name)
+    return messages_df, features, partial
+
+
+def build_partial(data_dir='.', use_cache=True, save=False):
+    """
+    计算一个数据目录（一个导出 / 分片）的部分聚合
+
+    Args:
+        data_dir: 数据目录
+        use_cache: 是否使用派生数据缓存
+        save: 是否写入数据目录中的 PARTIAL_FILE，供之后 --merge 使用
+
+    Returns:
+        PartialMetrics（分片名为数据目录名）
+    """
+    partial = compute_partial(data_dir, use_cache)[2]
+    if save:
+        partial.save(Path(data_dir) / PARTIAL_FILE)
+    return partial
+
+
+def _build_shard(data_dir):
+    return build_partial(data_dir, save=True)
+
+
+def build_shard_partials(data_dirs, workers=None):
+    """各分片独立计算部分聚合（多进程，结果按输入顺序返回）"""
+    workers = workers or min(len(data_dirs), os.cpu_count() or 1)
+    if workers <= 1:
+        return [_build_shard(d) for d in data_dirs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_build_shard, data_dirs))
+
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="计算网站展示所需的指标数据")
+    parser.add_argument("--data-dir", default=".", help="数据目录（默认当前目录）")
+    parser.add_argument("--approx", action="store_true",
+                        help="近似模式：流式读取 messages 表，对话数用 HyperLogLog、"
+                             "对话长度分位数用 KLL 估计，内存占用与数据量无关（见 approx_metrics.py）")
+    parser.add_argument("--precision", type=int, default=14,
+                        help="近似模式下 HyperLogLog 的精度，相对误差约 1.04/sqrt(2^precision)（默认 14）")
+    parser.add_argument("--chunk-rows", type=int, default=500_000,
+                        help="近似模式下每块读取的行数（默认 500000）")
+    parser.add_argument("--incremental", action="store_true",
+                        help="增量模式：只读取上次运行后新增或变更的对话并合并进已保存的状态"
+                             "（见 incremental_metrics.py），首次运行时完整计算")
+    parser.add_argument("--shards", nargs="+", metavar="DATA_DIR",
+                        help="多个导出 / 分片的数据目录：各自独立计算部分聚合（写入其中的 "
+                             f"{PARTIAL_FILE}），再合并为整体指标和按用户的视图")
+    parser.add_argument("--merge", nargs="+", metavar="PARTIAL",
+                        help=f"只合并已有的部分聚合文件（或包含 {PARTIAL_FILE} 的数据目录）")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="--shards 模式下的进程数（默认为分片数与 CPU 数的较小值）")
+    parser.add_argument("-o", "--output", default=None,
+                        help="输出文件（默认 website_metrics.json，近似模式为 website_metrics_approx.json）")
+    parser.add_argument("--by-user-output", default="website_metrics_by_user.json",
+                        help="多分片时按用户（分片）的指标输出文件（默认 website_metrics_by_user.json）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     """主函数"""
+    args = parse_args(argv)
     print("正在计算网站展示指标...")
     
-    messages_df, edges_df = load_data()
-    
-    metrics = {
-        "generated_at": datetime.now().isoformat(),
-        "overview": calculate_overview_metrics(messages_df),
-        "conversation_types": calculate_conversation_types(messages_df),
-        "technical": calculate_technical_metrics(messages_df),
-        "interaction": calculate_interaction_metrics(messages_df, edges_df),
-        "time_patterns": calculate_time_metrics(messages_df),
-        "personality": calculate_personality_metrics(messages_df)
-    }
+    data_dir = args.data_dir
+    by_user = None
+    if args.approx:
+        state = None
+        for shard_dir in args.shards or [data_dir]:
+            state = calculate_approx_metrics(shard_dir, precision=args.precision,
+                                             chunk_rows=args.chunk_rows, state=state)
+        metrics = {"generated_at": datetime.now().isoformat(), **state.result()}
+        approx = metrics["approximation"]
+        print(f"   近似模式: 对话数相对标准误差 ±{approx['distinct_counts']['relative_standard_error']:.2%}，"
+              f"分位数秩误差 ±{approx['quantiles']['normalized_rank_error']:.2%}")
+    else:
+        # 每个分片先得到部分聚合（见 partial_metrics.py），指标都由合并后的聚合生成，
+        # 不需要拼接各分片的 messages 表
+        if args.merge:
+            partials = [PartialMetrics.load(path) for path in args.merge]
+        elif args.shards:
+            partials = build_shard_partials(args.shards, args.workers)
+        elif args.incremental:
+            partial, stats = incremental_partial(data_dir, lambda: compute_partial(data_dir))
+            if stats is None:
+                print("   增量模式: 没有可用的增量状态，已完整计算并保存状态")
+            else:
+                print(f"   增量模式: 新增 {stats['new']} 个, 变更 {stats['changed']} 个, "
+                      f"删除 {stats['removed']} 个对话")
+            partials = [partial]
+        else:
+            partials = [build_partial(data_dir)]
+        merged = PartialMetrics.merge_all(partials) if len(partials) > 1 else partials[0]
+        metrics = {"generated_at": datetime.now().isoformat(), **calculate_all_metrics(merged)}
+        if len(partials) > 1:
+            by_user = {}
+            for i, partial in enumerate(partials):
+                name = '+'.join(partial.shards)
+                by_user[name if name not in by_user else f"{name}#{i}"] = calculate_all_metrics(partial)
     
     # 保存为 JSON
-    output_file = "website_metrics.json"
+    output_file = args.output or ("website_metrics_approx.json" if args.approx else "website_metrics.json")
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(metrics, f, indent=2, ensure_ascii=False, default=str)
     
     print(f"\n✅ 指标计算完成！")
     print(f"   数据已保存到: {output_file}")
+    if by_user is not None:
+        with open(args.by_user_output, 'w', encoding='utf-8') as f:
+            json.dump(by_user, f, indent=2, ensure_ascii=False, default=str)
+        print(f"   按用户的指标（{len(by_user)} 个分片）已保存到: {args.by_user_output}")
     print(f"\n核心指标预览:")
     print(f"   总对话数: {metrics['overview']['total_conversations']}")
     print(f"   总消息数: {metrics['overview']['total_messages']}")
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+消息内容分类引擎
+
+对每条消息的 content 结构只遍历一次（不做 JSON 序列化），由一组可插拔的
+检测器（Detector）共同产出内容标签列：
+1. CodeDetector - has_code, code_languages（代码块语言、code 类型内容）
+2. ImageDetector - has_image, image_count, image_asset_ids（图片资源指针、image_url）
+3. LinkDetector - has_link, link_count（URL）
+
+同一套检测器也可以对已有数据集重新分类，无需重新导入：
+    python content_classifier.py [data_dir]
+重新分类的输入与导入时相同：由 messages 表的 content_type / parts_raw / content_raw
+还原每条消息的 content（见 stored_content），相同的 content 只遍历一次。
+"""
+
+import json
+import os
+import re
+import sys
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from blob_store import resolve
+from dataset_io import find_table, open_writer, read_table
+from metrics_engine import write_conversation_table
+
+
+# 代码块起止标记，捕获起始标记后的语言名（结束标记的语言名为空）
+FENCE_RE = re.compile(r"```[ \t]*([A-Za-z0-9_+#.\-]*)")
+URL_RE = re.compile(r"(?:https?://|www\.)[^\s<>\"'`)\]}]+", re.IGNORECASE)
+# 导出文件中的图片资源指针，例如 file-service://file-xxx、sediment://file_xxx
+IMAGE_POINTER_RE = re.compile(r"^(?:file-service|sediment)://", re.IGNORECASE)
+
+CODE_CONTENT_TYPES = {"code", "execution_output"}
+IMAGE_CONTENT_TYPES = {"image_asset_pointer", "image_url"}
+# 这些字段是标识符而不是正文，遍历时不做文本检测
+NON_TEXT_KEYS = {"content_type", "asset_pointer", "language", "id", "mime_type", "name"}
+
+
+def _fence_languages(matches: List[str]) -> List[str]:
+    """从所有 ``` 标记中取出起始标记（奇数个）的语言名，去重并保持顺序"""
+    languages = []
+    for lang in matches[::2]:
+        lang = lang.lower()
+        if lang and lang not in languages:
+            languages.append(lang)
+    return languages
+
+
+# 还原消息 content 需要的 messages 列（见 stored_content）
+STORED_CONTENT_COLUMNS = ["content_type", "parts_raw", "content_raw"]
+
+
+def stored_content(content_type: Optional[str], parts_raw: Optional[str],
+                   content_raw: Optional[str]) -> Any:
+    """
+    由 messages 表中保存的列还原导入时交给 classify_content 的 content
+
+    content 除 content_type / parts 外还有其他字段时导入时整个保存在 content_raw；
+    否则 content 为 {"content_type", "parts"}，parts 保存在 parts_raw。content 不是
+    字典时 parts_raw 保存的就是 content 本身。
+    """
+    if content_raw is not None:
+        return json.loads(content_raw)
+    parts = json.loads(parts_raw) if parts_raw is not None else None
+    if content_type is None:
+        return parts
+    content = {"content_type": content_type}
+    if parts is not None:
+        content["parts"] = parts
+    return content
+
+
+class Detector:
+    """检测器基类：声明产出的列及默认值，并在遍历 content 时更新结果"""
+
+    columns: Dict[str, Any] = {}
+
+    def on_dict(self, node: Dict[str, Any], result: Dict[str, Any]) -> None:
+        """遍历到一个字典节点时调用"""
+
+    def on_text(self, text: str, result: Dict[str, Any]) -> None:
+        """遍历到一段正文文本时调用"""
+
+
+class CodeDetector(Detector):
+    columns = {"has_code": False, "code_languages": list}
+
+    def on_dict(self, node, result):
+        if node.get("content_type") in CODE_CONTENT_TYPES or "language" in node:
+            result["has_code"] = True
+            lang = node.get("language")
+            if isinstance(lang, str) and lang and lang != "unknown":
+                lang = lang.lower()
+                if lang not in result["code_languages"]:
+                    result["code_languages"].append(lang)
+
+    def on_text(self, text, result):
+        if "```" not in text:
+            return
+        result["has_code"] = True
+        for lang in _fence_languages(FENCE_RE.findall(text)):
+            if lang not in result["code_languages"]:
+                result["code_languages"].append(lang)
+
+
+class ImageDetector(Detector):
+    columns = {"has_image": False, "image_count": 0, "image_asset_ids": list}
+
+    def on_dict(self, node, result):
+        pointer = node.get("asset_pointer")
+        match = IMAGE_POINTER_RE.match(pointer) if isinstance(pointer, str) else None
+        if node.get("content_type") in IMAGE_CONTENT_TYPES or "image_url" in node or match:
+            result["has_image"] = True
+            result["image_count"] += 1
+            if match:
+                result["image_asset_ids"].append(pointer[match.end():])
+
+
+class LinkDetector(Detector):
+    columns = {"has_link": False, "link_count": 0}
+
+    def on_text(self, text, result):
+        count = len(URL_RE.findall(text))
+        if count:
+            result["has_link"] = True
+            result["link_count"] += count
+
+
+DEFAULT_DETECTORS = (CodeDetector, ImageDetector, LinkDetector)
+
+
+class ContentClassifier:
+    """组合多个检测器，对消息 content 做一次遍历得到全部标签列"""
+
+    def __init__(self, detectors: Optional[List[Detector]] = None):
+        self.detectors = detectors if detectors is not None else [d() for d in DEFAULT_DETECTORS]
+
+    def empty_result(self) -> Dict[str, Any]:
+        """返回所有列的默认值（列表列每次新建）"""
+        result = {}
+        for detector in self.detectors:
+            for col, default in detector.columns.items():
+                result[col] = default() if callable(default) else default
+        return result
+
+    def classify(self, content: Any) -> Dict[str, Any]:
+        """
+        遍历消息的 content（字典、parts 列表或字符串），返回标签字典
+
+        Args:
+            content: message['content']，或其中的 parts 列表
+
+        Returns:
+            包含各检测器列的字典
+        """
+        result = self.empty_result()
+        stack = [content]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                for detector in self.detectors:
+                    detector.on_text(node, result)
+            elif isinstance(node, dict):
+                for detector in self.detectors:
+                    detector.on_dict(node, result)
+                for key, value in node.items():
+                    if key not in NON_TEXT_KEYS and isinstance(value, (str, dict, list)):
+                        stack.append(value)
+            elif isinstance(node, list):
+                # 逆序入栈，保证按原顺序遍历（影响 code_languages 的顺序）
+                stack.extend(reversed(node))
+        return result
+
+    def classify_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        对 messages 表重新分类（content 由 content_type / parts_raw / content_raw 还原）
+
+        分叉和重新生成的消息 content 相同，按这三列去重后每种 content 只遍历一次。
+
+        Returns:
+            与 df 索引一致、列为各检测器输出列的 DataFrame
+        """
+        keys = pd.DataFrame({
+            col: df[col].astype(object).where(df[col].notna(), None) if col in df else None
+            for col in STORED_CONTENT_COLUMNS
+        }, index=df.index)
+        codes = keys.groupby(STORED_CONTENT_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+        results = [self.classify(stored_content(*row))
+                   for row in keys.drop_duplicates().itertuples(index=False, name=None)]
+        classified = pd.DataFrame(results, columns=list(self.empty_result()))
+        return classified.iloc[codes].set_index(df.index)
+
+
+DEFAULT_CLASSIFIER = ContentClassifier()
+
+
+def classify_content(content: Any) -> Dict[str, Any]:
+    """使用默认检测器分类一条消息的 content"""
+    return DEFAULT_CLASSIFIER.classify(content)
+
+
+def reclassify_dataset(data_dir: str = ".") -> int:
+    """
+    重新计算数据集中 messages 表的内容标签列，按原格式写回，返回行数
+
+    conversations 表中的 code_messages / image_messages / link_messages 由这些列
+    聚合而来，已有该表时一并重建（sqlite 中各表在同一个文件里，无法靠修改时间
+    判断该表是否过期）。
+    """
+    path = find_table("messages", data_dir)
+    fmt = path.suffix.lstrip(".")
+    print(f"正在读取: {path}")
+    # 去重格式的表保持哈希引用不变，只为分类临时还原需要的正文列
+    messages_df = read_table("messages", data_dir, fmt=fmt, resolve_blobs=False)
+    work_df = resolve(messages_df, ["parts_raw", "content_raw"], data_dir, fmt=fmt)
+    classified = DEFAULT_CLASSIFIER.classify_frame(work_df)
+    if "content_raw" in work_df.columns:
+        update = pd.Series(True, index=messages_df.index)
+    else:
+        # 旧版本导入没有保存 content_raw：content 不在 parts 中的消息（代码、工具结果等）
+        # 无法还原，保留导入时的结果
+        update = work_df["parts_raw"].notna()
+        print(f"提示: messages 表没有 content_raw 列（旧版本导入），{int((~update).sum())} 条 "
+              f"content 不在 parts 中的消息保留原有标签；重新导入后可完整重新分类")
+    for col in DEFAULT_CLASSIFIER.empty_result():
+        if col in messages_df.columns:
+            messages_df[col] = classified[col].where(update, messages_df[col])
+        else:
+            messages_df[col] = classified[col]
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    writer = open_writer(data_dir, "messages", fmt, path=tmp_path, columns=list(messages_df.columns))
+    try:
+        writer.write(messages_df)
+    finally:
+        writer.close()
+    os.replace(tmp_path, path)
+    print(f"已重新分类 {writer.rows} 条消息: {path}")
+    try:
+        find_table("conversations", data_dir)
+    except FileNotFoundError:
+        return writer.rows
+    rows = write_conversation_table(data_dir, fmt)
+    print(f"已重建对话特征表 {rows} 行")
+    return writer.rows
+
+
+def main():
+    """主函数"""
+    data_dir = sys.argv[1] if len(sys.argv) > 1 else "."
+    reclassify_dataset(data_dir)
+
+
+if __name__ == "__main__":
+    main()
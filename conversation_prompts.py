@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+把对话格式化为总结提示词中的文本（generate_conversation_summaries.py 与
+test_single_batch.py 共用）
+
+每个对话的文本为：
+    对话标题: <标题>
+    对话ID: <ID>
+
+    USER: <正文> [代码, 图片]
+    ASSISTANT: <正文>
+    ...
+
+只保留有角色、正文（去掉首尾空白后）不少于 10 个字符的消息，正文超过 500 个字符
+时截断。过滤、截断和标签都是整列的向量化操作；整表输入时只排序、分组一次，
+再按对话逐个产出文本，而不是每个对话扫描一遍整张表。
+
+用法示例：
+    messages_df = read_table('messages', columns=PROMPT_COLUMNS)
+    for conv_id, text in iter_conversation_texts(messages_df):
+        ...
+"""
+
+from typing import Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from conversation_store import open_store
+from dataset_io import find_table, read_table
+
+
+# 构建对话文本所需的 messages 列
+PROMPT_COLUMNS = [
+    'conversation_id', 'conversation_title', 'create_time', 'role',
+    'content_type', 'text', 'has_code', 'has_image', 'has_link',
+]
+MIN_TEXT_LENGTH = 10
+MAX_TEXT_LENGTH = 500
+TRUNCATION_SUFFIX = "...[已截断]"
+# 消息标签：列 -> 标签名（按此顺序出现在 [..] 中）
+MESSAGE_TAGS = [('has_code', '代码'), ('has_image', '图片'), ('has_link', '链接')]
+
+
+def _header(title, conv_id: str) -> str:
+    if title is None or pd.isna(title) or title == "":
+        title = "无标题"
+    return f"对话标题: {title}\n对话ID: {conv_id}\n\n"
+
+
+def format_message_lines(messages_df: pd.DataFrame) -> pd.Series:
+    """
+    把消息格式化为 "ROLE: 正文 [标签]\\n" 行（向量化）
+
+    Args:
+        messages_df: messages 表（需要 role / text 和标签列）
+
+    Returns:
+        保留下来的消息的行文本，索引与 messages_df 一致
+    """
+    role = messages_df['role'].astype(object)
+    text = messages_df['text'].astype(object)
+    text = text.where(text.notna(), "").astype(str)
+    keep = role.notna() & (text.str.strip().str.len() >= MIN_TEXT_LENGTH)
+    frame, role, text = messages_df[keep], role[keep].astype(str), text[keep]
+    if frame.empty:
+        return pd.Series([], index=frame.index, dtype=object)
+
+    text = text.where(text.str.len() <= MAX_TEXT_LENGTH, text.str.slice(0, MAX_TEXT_LENGTH) + TRUNCATION_SUFFIX)
+
+    tags = pd.Series("", index=frame.index, dtype=object)
+    for col, name in MESSAGE_TAGS:
+        # 与 `if value:` 的判断一致：空值也算真
+        flag = frame[col].astype(object).fillna(True).astype(bool).to_numpy()
+        tags = tags + np.where(flag, name + ", ", "")
+    tags = tags.str.slice(0, -2)
+    suffix = tags.where(tags == "", "[" + tags + "]")
+
+    return role.str.upper() + ": " + text + " " + suffix + "\n"
+
+
+def prepare_conversation_summary(messages_df: pd.DataFrame, conv_id: str) -> str:
+    """
+    为单个对话准备摘要文本
+
+    Args:
+        messages_df: 消息 DataFrame（可以是整表，也可以只含该对话）
+        conv_id: 对话 ID
+
+    Returns:
+        格式化的对话摘要文本；对话不存在时为空字符串
+    """
+    conv_messages = messages_df[messages_df['conversation_id'] == conv_id]
+    if len(conv_messages) == 0:
+        return ""
+    header = _header(conv_messages['conversation_title'].iloc[0], conv_id)
+    lines = format_message_lines(conv_messages.sort_values('create_time', kind='stable'))
+    return "\n".join([header] + lines.tolist())
+
+
+def iter_conversation_texts(messages_df: pd.DataFrame,
+                            conversation_ids: Optional[Iterable[str]] = None
+                            ) -> Iterator[Tuple[str, str]]:
+    """
+    按对话产出摘要文本（整表只排序、分组一次）
+
+    Args:
+        messages_df: 整张 messages 表
+        conversation_ids: 需要的对话及顺序（默认按在表中首次出现的顺序）
+
+    Yields:
+        (对话 ID, 摘要文本)，不存在的对话跳过
+    """
+    if conversation_ids is not None:
+        conversation_ids = list(conversation_ids)
+        messages_df = messages_df[messages_df['conversation_id'].isin(conversation_ids)]
+    else:
+        messages_df = messages_df[messages_df['conversation_id'].notna()]
+    conv = messages_df['conversation_id'].astype(object)
+    first = messages_df.drop_duplicates('conversation_id')
+    titles = dict(zip(first['conversation_id'].astype(object), first['conversation_title'].astype(object)))
+
+    # 稳定排序后分组，组内保持按时间的顺序
+    lines = format_message_lines(messages_df.sort_values('create_time', kind='stable'))
+    bodies = lines.groupby(conv.loc[lines.index], sort=False).agg("\n".join)
+
+    for conv_id in titles if conversation_ids is None else conversation_ids:
+        if conv_id not in titles:
+            continue
+        header = _header(titles[conv_id], conv_id)
+        body = bodies.get(conv_id)
+        yield conv_id, header if body is None else header + "\n" + body
+
+
+def load_conversation_texts(data_dir: str = ".", limit: Optional[int] = None):
+    """
+    打开数据目录，返回对话 ID 列表和惰性产出 (对话 ID, 摘要文本) 的生成器
+
+    有 dataset.sqlite 时按对话索引逐个查询（内存中只有一个对话），否则整表读入后
+    分组一次。
+
+    Args:
+        data_dir: 数据目录
+        limit: 只取前 limit 个对话（None 表示全部）
+
+    Returns:
+        (conversation_ids, 生成器)
+    """
+    store = open_store(data_dir)
+    if store is not None:
+        print(f"\n正在读取 {store.path}（按对话查询）...")
+        conversation_ids = store.conversation_ids()[:limit]
+        texts = ((conv_id, prepare_conversation_summary(store.get_messages(conv_id, PROMPT_COLUMNS), conv_id))
+                 for conv_id in conversation_ids)
+    else:
+        print(f"\n正在读取 {find_table('messages', data_dir)}...")
+        messages_df = read_table('messages', data_dir, columns=PROMPT_COLUMNS)
+        print(f"总消息数: {len(messages_df)}")
+        conversation_ids = messages_df['conversation_id'].dropna().unique().tolist()[:limit]
+        texts = iter_conversation_texts(messages_df, conversation_ids)
+    return conversation_ids, ((conv_id, text) for conv_id, text in texts if text)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+按对话查询 dataset.sqlite（json_to_dataset.py --format sqlite 的输出）
+
+messages 表在 conversation_id 上有索引，取单个对话的消息是一次索引查找，
+不需要把整张表读进内存，也不需要每个对话全表扫描一次。
+
+用法示例：
+    store = open_store('.')
+    if store is not None:
+        for conv_id in store.conversation_ids():
+            conv_df = store.get_messages(conv_id, ['role', 'text'])
+"""
+
+import sqlite3
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from blob_store import BLOB_FIELDS, HASH_FIELDS, is_deduped
+from dataset_io import from_sqlite_frame, table_columns, table_path
+
+
+class ConversationStore:
+    """dataset.sqlite 的只读查询接口"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"未找到数据库: {self.path}")
+        self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        self.columns = table_columns(self.path, "messages")
+        self.deduped = is_deduped(self.columns)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _select(self, columns: Optional[List[str]]) -> Tuple[str, str]:
+        """构造 SELECT 列表；去重格式下正文列通过 LEFT JOIN blobs 还原"""
+        if columns is None:
+            columns = [HASH_FIELDS.get(c, c) for c in self.columns]
+
+        select, joins = [], []
+        for col in columns:
+            hash_col = BLOB_FIELDS.get(col)
+            if self.deduped and hash_col in self.columns:
+                alias = f"b_{col}"
+                joins.append(f'LEFT JOIN blobs {alias} ON {alias}.hash = m."{hash_col}"')
+                select.append(f'{alias}.content AS "{col}"')
+            elif col in self.columns:
+                select.append(f'm."{col}"')
+        return ", ".join(select), " ".join(joins)
+
+    def conversation_ids(self) -> List[str]:
+        """按首次出现的顺序返回所有对话 ID（与 messages 表中 unique() 的顺序一致）"""
+        rows = self._conn.execute(
+            "SELECT conversation_id FROM messages GROUP BY conversation_id ORDER BY MIN(rowid)"
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_messages(self, conv_id: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        取出单个对话的消息（走 conversation_id 索引）
+
+        Args:
+            conv_id: 对话 ID
+            columns: 需要的列（可以包含 text 等正文列，去重格式会自动还原）
+
+        Returns:
+            该对话的消息 DataFrame，按原始行顺序
+        """
+        select, joins = self._select(columns)
+        query = f"SELECT {select} FROM messages m {joins} WHERE m.conversation_id = ? ORDER BY m.rowid"
+        df = pd.read_sql_query(query, self._conn, params=(conv_id,))
+        return from_sqlite_frame(df)
+
+    def get_edges(self, conv_id: str) -> pd.DataFrame:
+        """取出单个对话的边"""
+        return pd.read_sql_query(
+            "SELECT * FROM edges WHERE conversation_id = ? ORDER BY rowid", self._conn, params=(conv_id,)
+        )
+
+    def iter_conversations(self, columns: Optional[List[str]] = None
+                           ) -> Iterator[Tuple[str, pd.DataFrame]]:
+        """逐个产出 (conversation_id, 消息 DataFrame)，内存中只保留一个对话"""
+        for conv_id in self.conversation_ids():
+            yield conv_id, self.get_messages(conv_id, columns)
+
+
+def open_store(data_dir: str = ".") -> Optional[ConversationStore]:
+    """数据目录中存在 dataset.sqlite 时打开它，否则返回 None"""
+    path = table_path(data_dir, "messages", "sqlite")
+    if not path.exists():
+        return None
+    return ConversationStore(str(path))
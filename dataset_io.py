@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+"""
+数据集读写层
+
+json_to_dataset.py 产出的 messages / edges 表可以保存为四种格式：
+1. csv - 兼容旧流程，所有列都是文本，读取时需要重新推断类型
+2. parquet - 列式存储，带类型（列表列、布尔列、整数列、时间戳列），可只读部分列
+3. feather - Arrow IPC 文件，读取几乎零解析
+4. sqlite - 单个 dataset.sqlite 文件，所有表在同一个库中，带 conversation_id /
+   role / create_time 索引，可按对话查询而不加载整表（见 conversation_store.py）
+
+所有分析脚本都通过 read_table 读取数据，会优先选择 parquet/feather。
+load_prepared 在此基础上加入派生列（时间、子节点数），并把结果缓存到
+数据目录的 .dataset_cache/ 中，源文件不变时后续运行直接加载缓存。
+"""
+
+import ast
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+# 消息表与边表的固定列顺序（流式分块写出时保证每块列一致）
+MESSAGE_COLUMNS = [
+    "conversation_id", "conversation_title", "node_id", "parent_id", "children_ids",
+    "root_id", "depth", "sibling_index", "is_leaf", "subtree_size",
+    "create_time", "update_time", "role", "content_type", "parts_raw", "content_raw", "text",
+    "has_code", "has_image", "has_link", "code_languages", "image_count", "image_asset_ids",
+    "link_count", "model_slug", "default_model_slug", "finish_reason", "recipient", "tool_name",
+    "is_visually_hidden", "citations_count", "metadata_raw",
+]
+EDGE_COLUMNS = ["conversation_id", "parent_id", "child_id"]
+
+# 去重模式下的内容表（见 blob_store.py）
+BLOB_COLUMNS = ["hash", "content"]
+# 导出压缩包中的附件索引（见 export_archive.py）
+ASSET_COLUMNS = ["asset_id", "filename", "size_bytes"]
+
+# 每个对话一行的特征表（见 metrics_engine.py，导入时写出）
+CONVERSATION_COLUMNS = [
+    "conversation_id", "message_count", "user_messages", "assistant_messages", "tool_messages",
+    "code_messages", "image_messages", "multimodal_messages", "link_messages",
+    "title", "first_message_time", "last_message_time", "model",
+    "has_code", "has_image", "has_tool", "is_multimodal", "is_complex", "is_multi_step",
+    "is_iterative", "is_business",
+    "max_depth", "mean_depth", "median_depth", "node_count", "branching_factor", "branch_points",
+]
+
+TABLE_COLUMNS = {
+    "messages": MESSAGE_COLUMNS,
+    "edges": EDGE_COLUMNS,
+    "blobs": BLOB_COLUMNS,
+    "assets": ASSET_COLUMNS,
+    "conversations": CONVERSATION_COLUMNS,
+}
+
+# 列类型：未列出的列均按字符串处理
+LIST_COLUMNS = {"children_ids", "code_languages", "image_asset_ids"}
+BOOL_COLUMNS = {
+    "has_code", "has_image", "has_link", "is_leaf", "is_visually_hidden",
+    "has_tool", "is_multimodal", "is_complex", "is_multi_step", "is_iterative", "is_business",
+}
+INT_COLUMNS = {
+    "image_count", "link_count", "depth", "sibling_index", "subtree_size", "size_bytes",
+    "citations_count",
+    "message_count", "user_messages", "assistant_messages", "tool_messages", "code_messages",
+    "image_messages", "multimodal_messages", "link_messages", "max_depth", "node_count", "branch_points",
+}
+FLOAT_COLUMNS = {"mean_depth", "median_depth", "branching_factor"}
+# 在每行重复出现的字符串列做字典编码（Arrow dictionary / pandas category），
+# 内存随不同取值的数量增长而不是随消息数增长，groupby/value_counts 也在整数编码上进行
+CATEGORY_COLUMNS = {
+    "conversation_id", "conversation_title", "role", "content_type",
+    "model_slug", "default_model_slug", "finish_reason", "recipient", "tool_name",
+    "title", "model",
+}
+TIMESTAMP_COLUMNS = {"create_time", "update_time", "first_message_time", "last_message_time"}
+
+FORMATS = ("csv", "parquet", "feather", "sqlite")
+FORMAT_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather", "sqlite": ".sqlite"}
+# 读取时的格式优先级：类型化的列式格式优先
+READ_PREFERENCE = ("parquet", "feather", "sqlite", "csv")
+
+# sqlite 格式下所有表保存在同一个数据库文件中
+SQLITE_FILE = "dataset.sqlite"
+SQLITE_INDEXES = {
+    "messages": ["conversation_id", "role", "create_time"],
+    "edges": ["conversation_id"],
+    "blobs": ["hash"],
+    "assets": ["asset_id"],
+    "conversations": ["conversation_id"],
+}
+
+# 派生数据缓存（load_prepared、time_cube 等，见 cached_build）；
+# 派生逻辑变化时递增版本号使旧缓存失效
+PREPARED_CACHE_DIR = ".dataset_cache"
+PREPARED_CACHE_VERSION = 2
+
+
+def _require_pyarrow():
+    """导入 pyarrow，未安装时给出明确提示"""
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("parquet/feather 格式需要 pyarrow，请运行: pip install pyarrow")
+    return pyarrow
+
+
+def arrow_schema(name: str, columns: Optional[List[str]] = None, dictionary: bool = True):
+    """
+    返回指定表的 Arrow schema
+
+    dictionary=False 时 CATEGORY_COLUMNS 按普通字符串存储（Arrow IPC 文件不支持
+    跨批次替换字典，feather 分块写出时使用，读取时再转为 category）。
+    """
+    pa = _require_pyarrow()
+    fields = []
+    for col in columns or TABLE_COLUMNS[name]:
+        if col in LIST_COLUMNS:
+            fields.append(pa.field(col, pa.list_(pa.string())))
+        elif col in BOOL_COLUMNS:
+            fields.append(pa.field(col, pa.bool_()))
+        elif col in INT_COLUMNS:
+            fields.append(pa.field(col, pa.int32()))
+        elif col in FLOAT_COLUMNS:
+            fields.append(pa.field(col, pa.float64()))
+        elif col in TIMESTAMP_COLUMNS:
+            fields.append(pa.field(col, pa.timestamp("us")))
+        elif col in CATEGORY_COLUMNS and dictionary:
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def table_path(data_dir: str, name: str, fmt: str) -> Path:
+    """返回表文件路径，例如 ./output/messages.parquet"""
+    if fmt not in FORMAT_SUFFIXES:
+        raise ValueError(f"不支持的格式: {fmt}，可选: {', '.join(FORMATS)}")
+    if fmt == "sqlite":
+        return Path(data_dir) / SQLITE_FILE
+    return Path(data_dir) / f"{name}{FORMAT_SUFFIXES[fmt]}"
+
+
+def _sqlite_has_table(path: Path, name: str) -> bool:
+    with sqlite3.connect(str(path)) as conn:
+        row = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone()
+    return row is not None
+
+
+def find_table(name: str, data_dir: str = ".") -> Path:
+    """按 READ_PREFERENCE 查找已存在的表文件"""
+    for fmt in READ_PREFERENCE:
+        path = table_path(data_dir, name, fmt)
+        if path.exists() and (fmt != "sqlite" or _sqlite_has_table(path, name)):
+            return path
+    raise FileNotFoundError(f"在 {data_dir} 中未找到 {name} 表（支持 {', '.join(FORMATS)}）")
+
+
+def to_datetime(series: pd.Series) -> pd.Series:
+    """把 create_time 列统一转换为 datetime（兼容 CSV 中的 Unix 秒和列式格式中的时间戳）"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    return pd.to_datetime(pd.to_numeric(series, errors="coerce"), unit="s", errors="coerce")
+
+
+def _to_unix_seconds(series: pd.Series) -> pd.Series:
+    """时间列转为 Unix 秒（浮点数，空值保持为空），用于 CSV / sqlite 存储"""
+    seconds = to_datetime(series).astype("datetime64[us]").astype("int64") / 1e6
+    return seconds.where(series.notna())
+
+
+def _parse_list(value: Any) -> List[str]:
+    """把 CSV 中的列表字符串（如 "['a', 'b']"）安全地解析回列表"""
+    if isinstance(value, list):
+        return value
+    if isinstance(value, (tuple, np.ndarray)):
+        return list(value)
+    if not isinstance(value, str) or value in ("", "nan"):
+        return []
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return []
+    return list(parsed) if isinstance(parsed, (list, tuple)) else []
+
+
+def _to_arrow_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """按 schema 规整列类型，保证每个分块写出的类型一致"""
+    df = df.copy()
+    for col in df.columns:
+        if col in TIMESTAMP_COLUMNS:
+            df[col] = to_datetime(df[col]).astype("datetime64[us]")
+        elif col in BOOL_COLUMNS:
+            df[col] = df[col].fillna(False).astype(bool)
+        elif col in INT_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype("int32")
+        elif col in FLOAT_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+        elif col in LIST_COLUMNS:
+            df[col] = df[col].apply(lambda x: [str(v) for v in _parse_list(x)])
+        elif col in CATEGORY_COLUMNS:
+            df[col] = df[col].astype("string").astype("category")
+    return df
+
+
+class CsvTableWriter:
+    """按块追加写出 CSV，只在第一块写表头"""
+
+    def __init__(self, path: Path, columns: List[str]):
+        self.path = path
+        self.columns = columns
+        self.rows = 0
+        self._f = open(path, "w", encoding="utf-8-sig", newline="")
+        self._header = True
+
+    def write(self, records) -> None:
+        if len(records) == 0 and not self._header:
+            return
+        df = pd.DataFrame(records, columns=self.columns)
+        for col in TIMESTAMP_COLUMNS & set(df.columns):
+            # 与导出文件中的 create_time 一致，CSV 中的时间统一存为 Unix 秒
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = _to_unix_seconds(df[col])
+        df.to_csv(self._f, index=False, header=self._header)
+        self._header = False
+        self.rows += len(records)
+
+    def close(self) -> None:
+        if self._header:
+            self.write([])
+        self._f.close()
+
+
+class ParquetTableWriter:
+    """按块写出 Parquet，每块成为一个 row group"""
+
+    def __init__(self, path: Path, columns: List[str], name: str):
+        _require_pyarrow()
+        import pyarrow.parquet as pq
+        self.path = path
+        self.columns = columns
+        self.rows = 0
+        self.schema = arrow_schema(name, columns)
+        self._writer = pq.ParquetWriter(str(path), self.schema, compression="zstd")
+
+    def _table(self, records):
+        import pyarrow as pa
+        df = _to_arrow_frame(pd.DataFrame(records, columns=self.columns))
+        return pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+
+    def write(self, records) -> None:
+        if len(records) == 0:
+            return
+        self._writer.write_table(self._table(records))
+        self.rows += len(records)
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class FeatherTableWriter(ParquetTableWriter):
+    """按块写出 Feather（Arrow IPC 文件格式）"""
+
+    def __init__(self, path: Path, columns: List[str], name: str):
+        pa = _require_pyarrow()
+        self.path = path
+        self.columns = columns
+        self.rows = 0
+        self.schema = arrow_schema(name, columns, dictionary=False)
+        self._writer = pa.ipc.new_file(str(path), self.schema)
+
+    def _table(self, records):
+        import pyarrow as pa
+        df = _to_arrow_frame(pd.DataFrame(records, columns=self.columns))
+        for col in CATEGORY_COLUMNS & set(df.columns):
+            df[col] = df[col].astype(object)
+        return pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+
+
+def sqlite_insert(conn: sqlite3.Connection, name: str, records, columns: List[str]) -> int:
+    """
+    把记录插入 sqlite 中已存在的表，返回行数
+
+    不提交：由调用方决定事务边界（增量导入在一个事务中删除旧行并插入新行）。
+    """
+    if len(records) == 0:
+        return 0
+    df = pd.DataFrame(records, columns=columns)
+    for col in df.columns:
+        if col in TIMESTAMP_COLUMNS:
+            # 统一存为 Unix 秒，索引和范围查询都在数值上进行
+            df[col] = _to_unix_seconds(df[col])
+        elif col in LIST_COLUMNS:
+            df[col] = df[col].apply(lambda x: json.dumps(_parse_list(x), ensure_ascii=False))
+        elif col in BOOL_COLUMNS:
+            df[col] = df[col].fillna(False).astype(bool).astype(int)
+        elif col in INT_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(int)
+    df = df.astype(object).where(df.notna(), None)
+    placeholders = ", ".join("?" for _ in columns)
+    conn.executemany(f'INSERT INTO "{name}" VALUES ({placeholders})', df.itertuples(index=False, name=None))
+    return len(df)
+
+
+class SqliteTableWriter:
+    """
+    按块写入 dataset.sqlite 中的一张表（重建该表），关闭时建立索引
+
+    path 与 base_path 不同时（写临时文件再替换），先复制现有数据库，
+    这样替换后同一库中的其他表保持不变。
+    """
+
+    def __init__(self, path: Path, columns: List[str], name: str,
+                 base_path: Optional[Path] = None):
+        if base_path is not None and path != base_path and base_path.exists() and not path.exists():
+            shutil.copyfile(base_path, path)
+        self.path = path
+        self.name = name
+        self.columns = columns
+        self.rows = 0
+        self._conn = sqlite3.connect(str(path))
+        column_defs = ", ".join(f'"{col}" {self._sql_type(col)}' for col in columns)
+        self._conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+        self._conn.execute(f'CREATE TABLE "{name}" ({column_defs})')
+        self._conn.commit()
+
+    @staticmethod
+    def _sql_type(col: str) -> str:
+        if col in BOOL_COLUMNS or col in INT_COLUMNS:
+            return "INTEGER"
+        if col in TIMESTAMP_COLUMNS or col in FLOAT_COLUMNS:
+            return "REAL"
+        return "TEXT"
+
+    def write(self, records) -> None:
+        if len(records) == 0:
+            return
+        self.rows += sqlite_insert(self._conn, self.name, records, self.columns)
+        # 每块提交一次，释放写锁（同一个库可能同时有多个表在写）
+        self._conn.commit()
+
+    def close(self) -> None:
+        try:
+            for col in SQLITE_INDEXES.get(self.name, []):
+                if col in self.columns:
+                    self._conn.execute(
+                        f'CREATE INDEX IF NOT EXISTS "idx_{self.name}_{col}" ON "{self.name}" ("{col}")'
+                    )
+            self._conn.commit()
+        finally:
+            self._conn.close()
+
+
+def open_writer(output_dir: str, name: str, fmt: str = "csv",
+                path: Optional[Path] = None, columns: Optional[List[str]] = None):
+    """
+    为指定表创建分块写出器
+
+    写出器的 write() 接受记录字典列表或 DataFrame；path 用于写到临时文件再替换，
+    columns 用于覆盖默认列（如去重格式的 messages 表）。
+    """
+    path = path or table_path(output_dir, name, fmt)
+    columns = columns or TABLE_COLUMNS[name]
+    if fmt == "csv":
+        return CsvTableWriter(path, columns)
+    if fmt == "parquet":
+        return ParquetTableWriter(path, columns, name)
+    if fmt == "sqlite":
+        return SqliteTableWriter(path, columns, name, base_path=table_path(output_dir, name, fmt))
+    return FeatherTableWriter(path, columns, name)
+
+
+def table_columns(path: Path, name: Optional[str] = None) -> List[str]:
+    """读取表文件的列名（不读取数据）；sqlite 需要指定表名"""
+    if path.suffix == ".sqlite":
+        with sqlite3.connect(str(path)) as conn:
+            return [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')]
+    if path.suffix == ".parquet":
+        _require_pyarrow()
+        import pyarrow.parquet as pq
+        return pq.read_schema(str(path)).names
+    if path.suffix == ".feather":
+        pa = _require_pyarrow()
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).schema.names
+    return pd.read_csv(path, nrows=0, encoding="utf-8-sig").columns.tolist()
+
+
+def read_table(name: str, data_dir: str = ".",
+               columns: Optional[List[str]] = None,
+               fmt: Optional[str] = None,
+               resolve_blobs: bool = True,
+               conversation_ids: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    读取 messages/edges 表，优先使用 parquet/feather
+
+    Args:
+        name: 表名（'messages' 或 'edges'）
+        data_dir: 数据目录
+        columns: 只读取这些列；表中不存在的列会被忽略
+        fmt: 指定读取的格式；默认按 READ_PREFERENCE 自动选择
+        resolve_blobs: 对去重格式的 messages 表，是否把哈希引用还原为正文列
+        conversation_ids: 只读取这些对话的行（parquet 下推过滤、feather 在 Arrow 上过滤、
+            sqlite 走 conversation_id 索引，csv 分块过滤），增量计算时使用
+
+    Returns:
+        DataFrame，其中列表列为 Python 列表，布尔列为 bool，CATEGORY_COLUMNS 为 category
+    """
+    path = table_path(data_dir, name, fmt) if fmt else find_table(name, data_dir)
+    available = table_columns(path, name)
+
+    # 旧数据集没有 metadata 派生列时，读取 metadata_raw 临时补齐
+    promote_fields = []
+    if name == "messages" and columns is not None:
+        from metadata_fields import METADATA_ONLY_COLUMNS
+        promote_fields = [c for c in METADATA_ONLY_COLUMNS if c in columns and c not in available]
+        drop_raw = "metadata_raw" not in columns
+        if promote_fields and drop_raw:
+            columns = list(columns) + ["metadata_raw"]
+
+    resolve_fields = []
+    if resolve_blobs and name == "messages":
+        from blob_store import BLOB_FIELDS, is_deduped
+        if is_deduped(available):
+            wanted = columns if columns is not None else available
+            resolve_fields = [f for f, h in BLOB_FIELDS.items()
+                              if h in available and (columns is None or f in wanted)]
+            if columns is not None:
+                columns = list(columns) + [BLOB_FIELDS[f] for f in resolve_fields]
+
+    if columns is not None:
+        requested = set(columns)
+        columns = [c for c in available if c in requested]
+
+    if conversation_ids is not None:
+        df = _read_conversations(path, name, columns or available, list(conversation_ids))
+    elif path.suffix == ".parquet":
+        _require_pyarrow()
+        df = pd.read_parquet(path, columns=columns)
+    elif path.suffix == ".feather":
+        _require_pyarrow()
+        df = pd.read_feather(path, columns=columns)
+    elif path.suffix == ".sqlite":
+        df = _read_sqlite(path, name, columns or available)
+    else:
+        dtype = {col: "category" for col in CATEGORY_COLUMNS}
+        df = pd.read_csv(path, usecols=columns, dtype=dtype, encoding="utf-8-sig")
+
+    for col in LIST_COLUMNS & set(df.columns):
+        df[col] = df[col].apply(_parse_list)
+    for col in CATEGORY_COLUMNS & set(df.columns):
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+
+    if resolve_fields:
+        from blob_store import resolve
+        df = resolve(df, resolve_fields, data_dir, fmt=path.suffix.lstrip("."))
+    if promote_fields:
+        from metadata_fields import promote_metadata
+        df = promote_metadata(df, promote_fields)
+        for col in CATEGORY_COLUMNS & set(promote_fields):
+            df[col] = df[col].astype("category")
+        if drop_raw and "metadata_raw" in df.columns:
+            del df["metadata_raw"]
+    return df
+
+
+def iter_table(name: str, data_dir: str = ".",
+               columns: Optional[List[str]] = None,
+               chunk_rows: int = 500_000,
+               fmt: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    分块读取一张表，内存占用与块大小而不是表大小相关
+
+    与 read_table 的区别：不还原去重格式的正文列，不从 metadata_raw 补齐
+    metadata 派生列，字符串列不统一转为 category（各块的类别不同）。
+    parquet 按 row group 内的批次读取，feather 按写出时的记录批次读取，
+    因此实际块大小可能与 chunk_rows 不同。
+
+    Args:
+        name: 表名
+        data_dir: 数据目录
+        columns: 只读取这些列；表中不存在的列会被忽略
+        chunk_rows: 每块的行数（csv / sqlite / parquet）
+        fmt: 指定读取的格式；默认按 READ_PREFERENCE 自动选择
+
+    Yields:
+        列类型与 read_table 一致的 DataFrame 分块
+    """
+    path = table_path(data_dir, name, fmt) if fmt else find_table(name, data_dir)
+    available = table_columns(path, name)
+    if columns is not None:
+        requested = set(columns)
+        columns = [c for c in available if c in requested]
+
+    if path.suffix == ".parquet":
+        _require_pyarrow()
+        import pyarrow.parquet as pq
+        batches = (batch.to_pandas() for batch in
+                   pq.ParquetFile(str(path)).iter_batches(batch_size=chunk_rows, columns=columns))
+    elif path.suffix == ".feather":
+        pa = _require_pyarrow()
+
+        def read_batches():
+            with pa.memory_map(str(path)) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    yield (batch.select(columns) if columns is not None else batch).to_pandas()
+        batches = read_batches()
+    elif path.suffix == ".sqlite":
+        select = ", ".join(f'"{col}"' for col in columns or available)
+
+        def read_batches():
+            with sqlite3.connect(str(path)) as conn:
+                for chunk in pd.read_sql_query(f'SELECT {select} FROM "{name}"', conn, chunksize=chunk_rows):
+                    yield from_sqlite_frame(chunk)
+        batches = read_batches()
+    else:
+        batches = pd.read_csv(path, usecols=columns, chunksize=chunk_rows, encoding="utf-8-sig")
+
+    for df in batches:
+        for col in LIST_COLUMNS & set(df.columns):
+            df[col] = df[col].apply(_parse_list)
+        yield df
+
+
+def _read_conversations(path: Path, name: str, columns: List[str],
+                        conversation_ids: List[str]) -> pd.DataFrame:
+    """只读取指定对话的行（列类型还原由 read_table 完成）"""
+    read_columns = columns if "conversation_id" in columns else columns + ["conversation_id"]
+    if path.suffix in (".parquet", ".feather"):
+        pa = _require_pyarrow()
+        import pyarrow.compute as pc
+        if path.suffix == ".parquet":
+            import pyarrow.parquet as pq
+            # 按 row group 统计信息跳过不含这些对话的块，剩余的行再精确过滤
+            filters = [("conversation_id", "in", conversation_ids)] if conversation_ids else None
+            table = pq.read_table(str(path), columns=read_columns, filters=filters)
+        else:
+            import pyarrow.feather as feather
+            table = feather.read_table(str(path), columns=read_columns, memory_map=True)
+        ids = table.column("conversation_id")
+        if pa.types.is_dictionary(ids.type):
+            ids = ids.cast(pa.string())
+        df = table.filter(pc.is_in(ids, value_set=pa.array(conversation_ids, pa.string()))).to_pandas()
+    elif path.suffix == ".sqlite":
+        # 分批绑定参数，避免超过 sqlite 的变量个数上限
+        batches = [conversation_ids[i:i + 500] for i in range(0, len(conversation_ids), 500)] or [[]]
+        df = pd.concat([
+            _read_sqlite(path, name, read_columns,
+                         f'WHERE "conversation_id" IN ({", ".join("?" for _ in batch)})', tuple(batch))
+            for batch in batches
+        ], ignore_index=True)
+    else:
+        dtype = {col: "category" for col in CATEGORY_COLUMNS}
+        wanted = set(conversation_ids)
+        chunks = pd.read_csv(path, usecols=read_columns, dtype=dtype, encoding="utf-8-sig", chunksize=500_000)
+        df = pd.concat([chunk[chunk["conversation_id"].astype(object).isin(wanted)] for chunk in chunks],
+                       ignore_index=True)
+    return df[columns]
+
+
+def _read_sqlite(path: Path, name: str, columns: List[str],
+                 where: str = "", params: tuple = ()) -> pd.DataFrame:
+    """从 dataset.sqlite 读取一张表（可带 WHERE 条件），并还原列类型"""
+    select = ", ".join(f'"{col}"' for col in columns)
+    with sqlite3.connect(str(path)) as conn:
+        df = pd.read_sql_query(f'SELECT {select} FROM "{name}" {where}', conn, params=params)
+    return from_sqlite_frame(df)
+
+
+def from_sqlite_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """把从 sqlite 查询得到的 DataFrame 还原为与其他格式一致的类型"""
+    for col in df.columns:
+        if col in BOOL_COLUMNS:
+            df[col] = df[col].fillna(0).astype(bool)
+        elif col in TIMESTAMP_COLUMNS:
+            df[col] = to_datetime(df[col])
+        elif col in LIST_COLUMNS:
+            df[col] = df[col].apply(lambda x: json.loads(x) if isinstance(x, str) else [])
+    return df
+
+
+def read_dataset(data_dir: str = ".",
+                 message_columns: Optional[List[str]] = None,
+                 edge_columns: Optional[List[str]] = None):
+    """同时读取 messages 和 edges 表"""
+    messages_df = read_table("messages", data_dir, message_columns)
+    edges_df = read_table("edges", data_dir, edge_columns)
+    return messages_df, edges_df
+
+
+def add_derived_columns(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    添加分析脚本共用的派生列（原地修改并返回）
+
+    datetime / date / hour / day_of_week / month 由 create_time 得到；
+    messages 含 children_ids 时再加 children_count 和 has_branch。
+    """
+    messages_df["datetime"] = to_datetime(messages_df["create_time"])
+    messages_df["date"] = messages_df["datetime"].dt.date
+    messages_df["hour"] = messages_df["datetime"].dt.hour
+    messages_df["day_of_week"] = messages_df["datetime"].dt.day_name()
+    messages_df["month"] = messages_df["datetime"].dt.to_period("M")
+    if "children_ids" in messages_df.columns:
+        messages_df["children_count"] = messages_df["children_ids"].str.len().fillna(0).astype(int)
+        messages_df["has_branch"] = messages_df["children_count"] > 1
+    return messages_df
+
+
+def _file_digest(path: Path) -> str:
+    """分块计算文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_files(data_dir: str) -> List[Path]:
+    """派生数据缓存依赖的源文件（messages、edges 以及去重格式的 blobs 表、zip 导入的 assets 表）"""
+    paths = [find_table("messages", data_dir), find_table("edges", data_dir)]
+    for name in ("blobs", "assets"):
+        try:
+            paths.append(find_table(name, data_dir))
+        except FileNotFoundError:
+            pass
+    return list(dict.fromkeys(paths))
+
+
+def cached_build(data_dir: str, name: str, params: Any, build: Callable[[], Any]) -> Any:
+    """
+    以数据集源文件为依赖的 pickle 缓存
+
+    缓存按源文件的大小和修改时间校验；修改时间变了但内容哈希相同（例如文件被
+    touch 或重新复制）时仍然复用缓存。
+
+    Args:
+        data_dir: 数据目录（缓存写入其中的 PREPARED_CACHE_DIR）
+        name: 缓存名称，如 'prepared'、'time_cube'
+        params: 影响结果的参数（可 JSON 序列化），不同参数各自一份缓存
+        build: 缓存失效时调用，返回需要缓存的对象
+
+    Returns:
+        缓存或新构建的对象
+    """
+    sources = _source_files(data_dir)
+    key = hashlib.blake2b(json.dumps(
+        [PREPARED_CACHE_VERSION, [p.name for p in sources], params]
+    ).encode("utf-8"), digest_size=8).hexdigest()
+    cache_dir = Path(data_dir) / PREPARED_CACHE_DIR
+    cache_path = cache_dir / f"{name}_{key}.pkl"
+    meta_path = cache_dir / f"{name}_{key}.json"
+
+    stats = {p.name: [p.stat().st_size, p.stat().st_mtime_ns] for p in sources}
+    meta = None
+    if cache_path.exists() and meta_path.exists():
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("stats") != stats:
+            # 大小或修改时间变了：用内容哈希确认是否真的有变化
+            hashes = {p.name: _file_digest(p) for p in sources}
+            meta = {"stats": stats, "hashes": hashes} if meta.get("hashes") == hashes else None
+            if meta is not None:
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump(meta, f)
+        if meta is not None:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+    result = build()
+    meta = {"stats": stats, "hashes": {p.name: _file_digest(p) for p in sources}}
+    try:
+        cache_dir.mkdir(exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+    except OSError as e:
+        print(f"警告: 无法写入缓存 {cache_path}: {e}")
+    return result
+
+
+def load_prepared(data_dir: str = ".",
+                  message_columns: Optional[List[str]] = None,
+                  edge_columns: Optional[List[str]] = None,
+                  use_cache: bool = True):
+    """
+    读取 messages/edges 表并添加派生列，结果通过 cached_build 缓存
+
+    Args:
+        data_dir: 数据目录
+        message_columns: 只读取这些 messages 列
+        edge_columns: 只读取这些 edges 列
+        use_cache: False 时不读也不写缓存
+
+    Returns:
+        (messages_df, edges_df)，messages_df 带有 add_derived_columns 的派生列；
+        读取了 image_asset_ids 且存在 assets 表（zip 导入）时还带有
+        export_archive.attach_asset_sizes 的 image_bytes / missing_asset_count 列
+    """
+    def build():
+        messages_df, edges_df = read_dataset(data_dir, message_columns, edge_columns)
+        if "image_asset_ids" in messages_df.columns:
+            try:
+                assets_df = read_table("assets", data_dir)
+            except FileNotFoundError:
+                pass
+            else:
+                from export_archive import attach_asset_sizes
+                messages_df = attach_asset_sizes(messages_df, assets_df)
+        return add_derived_columns(messages_df), edges_df
+
+    if not use_cache:
+        return build()
+    return cached_build(data_dir, "prepared", [message_columns, edge_columns], build)
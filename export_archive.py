@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+直接读取官方导出压缩包
+
+ChatGPT 导出是一个 zip，其中包含 conversations.json 和上传/生成的附件文件。
+这里不解压到磁盘，而是：
+1. open_export - 把 conversations.json 成员（或 .json.gz）作为文本流交给解析器
+2. iter_assets - 只读取 zip 目录区，列出附件文件的 asset_id、文件名和大小
+
+附件文件名以资源 ID 开头（如 file-AbC123-photo.png、file_00000000abcd-xxx.webp），
+与消息中的图片资源指针（file-service://file-AbC123、sediment://file_00000000abcd）对应，
+写入 assets 表后，load_prepared 读取 image_asset_ids 时会用 attach_asset_sizes 为
+has_image 的消息补上真实附件大小。
+"""
+
+import gzip
+import io
+import re
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import Any, Dict, Iterator, Optional, TextIO
+
+import pandas as pd
+
+
+CONVERSATIONS_MEMBER = "conversations.json"
+# 压缩包中文件名开头的资源 ID
+ASSET_ID_RE = re.compile(r"^(file[-_][A-Za-z0-9]+)")
+
+
+def has_assets(path: str) -> bool:
+    """是否为带附件的 zip 导出包（.json / .json.gz 只有对话本身）"""
+    return Path(path).suffix.lower() == ".zip"
+
+
+def _find_member(zf: zipfile.ZipFile) -> zipfile.ZipInfo:
+    """在 zip 中查找 conversations.json（可能位于子目录中）"""
+    candidates = [info for info in zf.infolist()
+                  if PurePosixPath(info.filename).name == CONVERSATIONS_MEMBER]
+    if not candidates:
+        raise ValueError(f"压缩包中没有找到 {CONVERSATIONS_MEMBER}")
+    # 多个同名成员时取目录层级最浅的
+    return min(candidates, key=lambda info: info.filename.count("/"))
+
+
+@contextmanager
+def open_export(path: str) -> Iterator[TextIO]:
+    """
+    以文本流打开导出文件，支持 .json、.json.gz 和 .zip
+
+    zip 和 gzip 都是边读边解压，不会在磁盘上产生解压后的副本。
+
+    Args:
+        path: 导出文件路径
+
+    Returns:
+        UTF-8 文本流（上下文管理器）
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".zip":
+        with zipfile.ZipFile(path) as zf:
+            with zf.open(_find_member(zf)) as raw:
+                yield io.TextIOWrapper(raw, encoding="utf-8")
+    elif suffix == ".gz":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            yield f
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield f
+
+
+def asset_id_from_name(filename: str) -> Optional[str]:
+    """从附件文件名中取出资源 ID；不是附件时返回 None"""
+    match = ASSET_ID_RE.match(PurePosixPath(filename).name)
+    return match.group(1) if match else None
+
+
+def iter_assets(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    列出 zip 中的附件文件（只读取目录区，不解压内容）
+
+    Args:
+        path: 导出文件路径；不是 zip 时不产出任何记录
+
+    Returns:
+        每个附件一条 {'asset_id', 'filename', 'size_bytes'} 记录
+    """
+    if not has_assets(path):
+        return
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            asset_id = asset_id_from_name(info.filename)
+            if asset_id is None:
+                continue
+            yield {"asset_id": asset_id, "filename": info.filename, "size_bytes": info.file_size}
+
+
+def attach_asset_sizes(messages_df: pd.DataFrame, assets_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    按 image_asset_ids 关联 assets 表，为每条消息加上附件大小列
+
+    Returns:
+        原表的副本，新增 image_bytes（找到的附件总字节数）和
+        missing_asset_count（压缩包中找不到的附件数）
+    """
+    df = messages_df.copy()
+    sizes = assets_df.drop_duplicates("asset_id").set_index("asset_id")["size_bytes"]
+    exploded = df["image_asset_ids"].explode()
+    matched = exploded.map(sizes)
+    df["image_bytes"] = matched.groupby(level=0).sum(min_count=1).fillna(0).astype("int64")
+    df["missing_asset_count"] = (exploded.notna() & matched.isna()).groupby(level=0).sum().astype("int64")
+    return df
@@ -3,20 +3,30 @@
 为每个对话生成总结，并分析整体趋势
 
 功能：
-1. 读取 messages.csv，按对话分组
-2. 为每个对话构建摘要文本
-3. 每 30 个对话打包，调用 deepseek API 生成总结
+1. 读取 messages 表，按对话分组
+2. 为每个对话构建摘要文本（见 conversation_prompts.py）
+3. 按 token 预算把对话打包成批次（见 batch_packing.py），调用 deepseek API 生成总结
+   （asyncio 并发，按 RPM / TPM 限流，结果仍按批次顺序写出）；每个批次完成后写入断点文件，
+   中断或有批次失败时可用 --resume 继续（见 summary_checkpoint.py）
 4. 最后分析所有对话的整体趋势和脉络
+
+API 地址可以用环境变量 AI_BUILDER_BASE_URL 覆盖（例如指向本地的 OpenAI 兼容服务做测试）。
 """
 
-import pandas as pd
-import json
+import argparse
+import asyncio
 import os
-import time
+import sqlite3
 from datetime import datetime
-from typing import List, Dict, Any
-from openai import OpenAI
+from typing import List, Optional
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
+
+from conversation_prompts import load_conversation_texts
+from llm_cache import cache_summary, chat_completion, disable_cache, lookup, store
+from batch_packing import Batch, BatchPacker
+from rate_limiter import RateLimiter, estimate_tokens
+from summary_checkpoint import SummaryCheckpoint, is_failed_summary, prompt_hash
 import sys
 
 
@@ -24,7 +34,7 @@ import sys
 load_dotenv()
 
 # 初始化 OpenAI 客户端（使用 AI Builders API）
-API_BASE_URL = "https://space.ai-builders.com/backend/v1"
+API_BASE_URL = os.getenv("AI_BUILDER_BASE_URL", "https://space.ai-builders.com/backend/v1")
 api_key = os.getenv("AI_BUILDER_TOKEN")
 
 if not api_key:
@@ -34,76 +44,36 @@ client = OpenAI(
     base_url=API_BASE_URL,
     api_key=api_key
 )
+async_client = AsyncOpenAI(
+    base_url=API_BASE_URL,
+    api_key=api_key
+)
 
+# 批次总结请求的参数
+SUMMARY_MODEL = "deepseek"
+SUMMARY_SYSTEM_PROMPT = "你是一个专业的对话分析专家，擅长从对话中提取关键信息和用户行为模式。"
+SUMMARY_TEMPERATURE = 0.7
+SUMMARY_MAX_TOKENS = 4000
 
-def prepare_conversation_summary(messages_df: pd.DataFrame, conv_id: str) -> str:
-    """
-    为单个对话准备摘要文本
-    
-    Args:
-        messages_df: 消息 DataFrame
-        conv_id: 对话 ID
-        
-    Returns:
-        格式化的对话摘要文本
-    """
-    conv_messages = messages_df[messages_df['conversation_id'] == conv_id].copy()
-    
-    if len(conv_messages) == 0:
-        return ""
-    
-    # 获取对话标题
-    title = conv_messages.iloc[0]['conversation_title'] or "无标题"
-    
-    # 按时间排序
-    conv_messages = conv_messages.sort_values('create_time')
-    
-    # 提取主要消息（用户和助手）
-    summary_parts = [f"对话标题: {title}\n对话ID: {conv_id}\n\n"]
-    
-    for idx, msg in conv_messages.iterrows():
-        role = msg['role']
-        if pd.isna(role):
-            continue
-            
-        text = str(msg['text']) if pd.notna(msg['text']) else ""
-        content_type = str(msg['content_type']) if pd.notna(msg['content_type']) else ""
-        
-        # 只保留有意义的文本（长度大于 10）
-        if len(text.strip()) < 10:
-            continue
-        
-        # 截断过长的文本（保留前 500 字符）
-        if len(text) > 500:
-            text = text[:500] + "...[已截断]"
-        
-        # 添加标签
-        tags = []
-        if msg['has_code']:
-            tags.append("代码")
-        if msg['has_image']:
-            tags.append("图片")
-        if msg['has_link']:
-            tags.append("链接")
-        tag_str = f"[{', '.join(tags)}]" if tags else ""
-        
-        summary_parts.append(f"{role.upper()}: {text} {tag_str}\n")
-    
-    return "\n".join(summary_parts)
+# 默认并发数和限流（每分钟请求数 / token 数，0 表示不限）
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RPM = 30
+DEFAULT_TPM = 0
 
+# 批次装箱：每个请求的输入 token 预算，以及每个对话总结预计的输出 token 数
+DEFAULT_MAX_INPUT_TOKENS = 24000
+DEFAULT_OUTPUT_TOKENS_PER_CONVERSATION = 120
 
-def generate_batch_summaries(conversations_text: List[str], batch_num: int) -> str:
+def build_batch_prompt(conversations_text: List[str]) -> str:
     """
-    调用 API 为一批对话生成总结
+    构建一批对话的总结提示词
     
     Args:
         conversations_text: 对话文本列表
-        batch_num: 批次编号
         
     Returns:
-        API 返回的总结文本
+        提示词
     """
-    # 构建提示词
     conversations_combined = "\n\n" + "="*80 + "\n\n".join(
         f"【对话 {i+1}】\n{conv}" 
         for i, conv in enumerate(conversations_text)
@@ -130,26 +100,107 @@ def generate_batch_summaries(conversations_text: List[str], batch_num: int) -> s
 ...（依此类推）
 
 保持总结简洁但信息丰富，能够体现用户的 AI 使用习惯和偏好。"""
+    return prompt
+
+
+async def generate_batch_summaries(conversations_text: List[str], batch_num: int,
+                                   limiter: Optional[RateLimiter] = None) -> str:
+    """
+    调用 API 为一批对话生成总结
+    
+    Args:
+        conversations_text: 对话文本列表
+        batch_num: 批次编号
+        limiter: 限流器（为 None 时不限流）
+        
+    Returns:
+        API 返回的总结文本
+    """
+    prompt = build_batch_prompt(conversations_text)
+    request = dict(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=SUMMARY_TEMPERATURE,
+        max_tokens=SUMMARY_MAX_TOKENS
+    )
+    # 提示词没有变化的批次直接使用缓存，不占用限流额度；缓存出错时照常请求 API
+    try:
+        summary = lookup(**request)
+    except sqlite3.Error as e:
+        print(f"  ⚠️ 批次 {batch_num} 读取响应缓存出错，改为请求 API: {e}")
+        summary = None
+    if summary is not None:
+        print(f"  ✓ 批次 {batch_num} 使用缓存")
+        return summary
+
+    if limiter is not None:
+        # 按提示词加最大输出估计这次请求的 token 用量
+        tokens = estimate_tokens(SUMMARY_SYSTEM_PROMPT + prompt) + SUMMARY_MAX_TOKENS
+        waited = await limiter.acquire(tokens)
+        if waited > 0:
+            print(f"  批次 {batch_num} 限流等待 {waited:.1f} 秒")
 
     print(f"  正在调用 API 生成批次 {batch_num} 的总结（{len(conversations_text)} 个对话）...")
     
     try:
-        response = client.chat.completions.create(
-            model="deepseek",
-            messages=[
-                {"role": "system", "content": "你是一个专业的对话分析专家，擅长从对话中提取关键信息和用户行为模式。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=4000
-        )
+        response = await async_client.chat.completions.create(**request)
         
         summary = response.choices[0].message.content
-        return summary
+        if not summary:
+            # 空回复或被过滤的回复（content=None）按失败处理，--resume 时重试
+            print(f"  ⚠️ 批次 {batch_num} API 返回空内容")
+            return f"[批次 {batch_num} 生成失败: API 返回空内容]"
         
     except Exception as e:
-        print(f"  ⚠️ API 调用出错: {e}")
+        print(f"  ⚠️ 批次 {batch_num} API 调用出错: {e}")
         return f"[批次 {batch_num} 生成失败: {str(e)}]"
+    
+    try:
+        store(summary, **request)
+    except sqlite3.Error as e:
+        print(f"  ⚠️ 批次 {batch_num} 写入响应缓存出错: {e}")
+    print(f"  ✓ 批次 {batch_num} 完成")
+    return summary
+
+
+def batch_prompt_hash(batch: Batch) -> str:
+    """批次提示词的哈希（断点文件中用来判断批次内容是否变化）"""
+    return prompt_hash(build_batch_prompt(batch.texts))
+
+
+async def summarize_batches(batches: List[Batch], concurrency: int = DEFAULT_CONCURRENCY,
+                            rpm: float = DEFAULT_RPM, tpm: float = DEFAULT_TPM,
+                            checkpoint: Optional[SummaryCheckpoint] = None) -> List[str]:
+    """
+    并发生成所有批次的总结
+    
+    最多同时有 concurrency 个请求在进行，发出请求前按 RPM / TPM 限流。
+    
+    Args:
+        batches: 待生成的批次（见 batch_packing.py）
+        concurrency: 最大并发请求数
+        rpm: 每分钟最多请求数（0 表示不限）
+        tpm: 每分钟最多 token 数（0 表示不限）
+        checkpoint: 断点文件，每个批次完成后立即追加记录
+        
+    Returns:
+        与 batches 顺序一致的总结列表
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+
+    async def run(batch: Batch) -> str:
+        async with semaphore:
+            summary = await generate_batch_summaries(batch.texts, batch.number, limiter)
+        if checkpoint is not None:
+            checkpoint.record(batch.number, batch.conversation_ids, batch_prompt_hash(batch), summary)
+        return summary
+
+    # gather 按参数顺序返回结果，与完成先后无关
+    return await asyncio.gather(*(run(batch) for batch in batches))
 
 
 def analyze_overall_trends(all_summaries: List[str]) -> str:
@@ -204,7 +255,8 @@ def analyze_overall_trends(all_summaries: List[str]) -> str:
     print("\n正在分析整体趋势和脉络...")
     
     try:
-        response = client.chat.completions.create(
+        analysis = chat_completion(
+            client,
             model="deepseek",
             messages=[
                 {"role": "system", "content": "你是一个专业的行为分析专家，擅长从大量数据中提取用户行为模式和趋势。"},
@@ -213,8 +265,6 @@ def analyze_overall_trends(all_summaries: List[str]) -> str:
             temperature=0.8,
             max_tokens=4000
         )
-        
-        analysis = response.choices[0].message.content
         return analysis
         
     except Exception as e:
@@ -222,60 +272,98 @@ def analyze_overall_trends(all_summaries: List[str]) -> str:
         return f"[整体趋势分析失败: {str(e)}]"
 
 
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="为每个对话生成总结，并分析整体趋势")
+    parser.add_argument("--data-dir", default=".", help="数据目录（默认当前目录）")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="每批最多对话数（默认 0，即只受 token 预算限制）")
+    parser.add_argument("--max-input-tokens", type=int, default=DEFAULT_MAX_INPUT_TOKENS,
+                        help=f"每个请求的输入 token 预算，含提示词模板（默认 {DEFAULT_MAX_INPUT_TOKENS}）")
+    parser.add_argument("--output-tokens-per-conversation", type=int,
+                        default=DEFAULT_OUTPUT_TOKENS_PER_CONVERSATION,
+                        help=f"每个对话总结预计的输出 token 数，与 max_tokens={SUMMARY_MAX_TOKENS} "
+                             f"一起决定每批对话数上限（默认 {DEFAULT_OUTPUT_TOKENS_PER_CONVERSATION}）")
+    parser.add_argument("-o", "--output", default="conversation_summaries_and_trends.md",
+                        help="输出报告路径（默认 conversation_summaries_and_trends.md）")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help=f"同时进行的 API 请求数（默认 {DEFAULT_CONCURRENCY}；1 即逐批串行）")
+    parser.add_argument("--rpm", type=float, default=DEFAULT_RPM,
+                        help=f"每分钟最多请求数（默认 {DEFAULT_RPM}，0 表示不限）")
+    parser.add_argument("--tpm", type=float, default=DEFAULT_TPM,
+                        help="每分钟最多 token 数，按提示词估计值加最大输出计（默认 0，即不限）")
+    parser.add_argument("--checkpoint", default=None,
+                        help="断点文件路径（默认为 <输出报告>.checkpoint.jsonl），每个批次完成后追加一行；"
+                             "文件只追加不清空")
+    parser.add_argument("--resume", action="store_true",
+                        help="从断点文件恢复：跳过已成功的批次，只重试失败和未完成的批次")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不使用 API 响应缓存，全部重新请求（见 llm_cache.py）")
+    return parser.parse_args(argv)
+
+
 def main():
     """主函数"""
+    args = parse_args()
+    if args.no_cache:
+        disable_cache()
     print("="*80)
     print("对话总结生成工具")
     print("="*80)
     
     # 参数
-    messages_file = "messages.csv"
-    batch_size = 30
-    output_file = "conversation_summaries_and_trends.md"
+    data_dir = args.data_dir
+    batch_size = args.batch_size
+    output_file = args.output
     
-    # 读取数据
-    print(f"\n正在读取 {messages_file}...")
-    messages_df = pd.read_csv(messages_file)
-    print(f"总消息数: {len(messages_df)}")
+    # 读取数据：有 dataset.sqlite 时按对话索引查询，否则整表读入后分组一次
+    conversation_ids, conversation_texts = load_conversation_texts(data_dir)
     
-    # 获取所有对话 ID
-    conversation_ids = messages_df['conversation_id'].unique().tolist()
     total_conversations = len(conversation_ids)
     print(f"总对话数: {total_conversations}")
     
-    # 准备对话摘要
-    print(f"\n正在准备对话摘要（批量大小: {batch_size}）...")
-    conversation_summaries = []
+    # 准备对话摘要，并按 token 预算装箱（见 batch_packing.py）
+    packer = BatchPacker(
+        max_input_tokens=args.max_input_tokens,
+        max_output_tokens=SUMMARY_MAX_TOKENS,
+        output_tokens_per_item=args.output_tokens_per_conversation,
+        overhead_tokens=estimate_tokens(SUMMARY_SYSTEM_PROMPT + build_batch_prompt([])),
+        max_items=batch_size,
+    )
+    print(f"\n正在准备对话摘要（每批输入预算 {args.max_input_tokens} tokens, "
+          f"最多 {packer.items_per_batch} 个对话）...")
+    batches = []
+    truncated = 0
+    for batch in packer.pack(conversation_texts):
+        print(f"准备批次 {batch.number}: {len(batch)} 个对话, 约 {batch.input_tokens} tokens")
+        for conv_id in batch.truncated:
+            print(f"  ⚠️ 对话 {conv_id} 超出输入预算，已截断")
+        truncated += len(batch.truncated)
+        batches.append(batch)
     
-    # 分批处理
-    num_batches = (total_conversations + batch_size - 1) // batch_size
+    # 断点续跑：提示词未变且已成功的批次直接使用断点中的结果
+    checkpoint_path = args.checkpoint or f"{output_file}.checkpoint.jsonl"
+    checkpoint = SummaryCheckpoint(checkpoint_path, resume=args.resume)
+    results = {}
+    pending = []
+    for batch in batches:
+        summary = checkpoint.completed(batch.conversation_ids, batch_prompt_hash(batch)) if args.resume else None
+        if summary is None:
+            pending.append(batch)
+        else:
+            results[batch.number] = summary
+    if args.resume:
+        print(f"\n从断点 {checkpoint_path} 恢复: 已完成 {len(results)} 个批次，"
+              f"需要生成 {len(pending)} 个（含之前失败的批次）")
     
-    for batch_idx in range(num_batches):
-        start_idx = batch_idx * batch_size
-        end_idx = min((batch_idx + 1) * batch_size, total_conversations)
-        batch_ids = conversation_ids[start_idx:end_idx]
-        
-        print(f"\n处理批次 {batch_idx + 1}/{num_batches} (对话 {start_idx + 1}-{end_idx})")
-        
-        # 准备这批对话的文本
-        batch_texts = []
-        for conv_id in batch_ids:
-            conv_text = prepare_conversation_summary(messages_df, conv_id)
-            if conv_text:
-                batch_texts.append(conv_text)
-        
-        if not batch_texts:
-            print(f"  批次 {batch_idx + 1} 没有有效对话，跳过")
-            continue
-        
-        # 调用 API 生成总结
-        batch_summary = generate_batch_summaries(batch_texts, batch_idx + 1)
-        conversation_summaries.append(batch_summary)
-        
-        # 避免 API 限流
-        if batch_idx < num_batches - 1:
-            print(f"  等待 2 秒...")
-            time.sleep(2)
+    # 调用 API 生成总结（并发 + 限流，结果按批次顺序排列）
+    print(f"\n正在生成 {len(pending)} 个批次的总结（并发 {args.concurrency}, "
+          f"RPM {args.rpm or '不限'}, TPM {args.tpm or '不限'}）...")
+    summaries = asyncio.run(
+        summarize_batches(pending, args.concurrency, args.rpm, args.tpm, checkpoint))
+    results.update((batch.number, summary) for batch, summary in zip(pending, summaries))
+    conversation_summaries = [results[batch.number] for batch in batches]
+    failed = sum(is_failed_summary(summary) for summary in conversation_summaries)
     
     print(f"\n共生成 {len(conversation_summaries)} 个批次的总结")
     
@@ -307,6 +395,11 @@ def main():
     print(f"\n✅ 完成！报告已保存到: {output_file}")
     print(f"   总对话数: {total_conversations}")
     print(f"   生成批次: {len(conversation_summaries)}")
+    if failed:
+        print(f"   ⚠️ 失败批次: {failed}（可用 --resume 只重试这些批次）")
+    if truncated:
+        print(f"   截断的超长对话: {truncated}")
+    print(f"   {cache_summary()}")
     print(f"   最终报告包含:")
     print(f"   - 所有对话的详细总结")
     print(f"   - 整体使用趋势和用户画像分析")
@@ -3,14 +3,17 @@
 使用 AI 生成详细的指标说明和解释
 """
 
+import argparse
 import pandas as pd
 import json
 import os
 from openai import OpenAI
 from dotenv import load_dotenv
-from collections import Counter
 import re
 
+from dataset_io import read_table
+from llm_cache import cache_summary, chat_completion, disable_cache
+
 load_dotenv()
 
 # 初始化客户端
@@ -23,7 +26,10 @@ client = OpenAI(
 )
 
 # 读取数据
-messages_df = pd.read_csv('messages.csv')
+messages_df = read_table('messages', columns=[
+    'conversation_id', 'conversation_title', 'role', 'content_type', 'text', 'has_code',
+    'tool_name',
+])
 with open('website_metrics.json', 'r') as f:
     metrics = json.load(f)
 with open('conversation_summaries_and_trends.md', 'r', encoding='utf-8') as f:
@@ -66,14 +72,11 @@ def analyze_tool_usage():
     """分析工具使用情况"""
     tool_messages = messages_df[messages_df['role'] == 'tool']
     
-    # 从 metadata 或 content_type 分析工具类型
-    tool_types = []
-    for _, msg in tool_messages.iterrows():
-        if pd.notna(msg.get('content_type')):
-            tool_types.append(str(msg['content_type']))
-    
-    tool_counter = Counter(tool_types)
-    return dict(tool_counter.most_common(10))
+    # 工具类型：优先使用工具名（author.name），旧数据集没有该列时退回到 content_type
+    tool_types = tool_messages['content_type'].astype(object)
+    if 'tool_name' in tool_messages.columns:
+        tool_types = tool_messages['tool_name'].astype(object).fillna(tool_types)
+    return tool_types.value_counts().head(10).to_dict()
 
 def analyze_interaction_patterns():
     """分析交互模式的具体内容"""
@@ -81,8 +84,10 @@ def analyze_interaction_patterns():
     # 通过对话长度和消息类型来判断
     conv_stats = []
     
-    for conv_id in messages_df['conversation_id'].unique()[:100]:  # 采样分析
-        conv_msgs = messages_df[messages_df['conversation_id'] == conv_id]
+    sample_ids = messages_df['conversation_id'].unique()[:100]  # 采样分析
+    sample_df = messages_df[messages_df['conversation_id'].isin(sample_ids)]
+    # 一次分组代替逐个对话全表过滤（sort=False 保持对话首次出现的顺序）
+    for conv_id, conv_msgs in sample_df.groupby('conversation_id', sort=False, observed=True):
         user_msgs = conv_msgs[conv_msgs['role'] == 'user']
         assistant_msgs = conv_msgs[conv_msgs['role'] == 'assistant']
         
@@ -250,7 +255,8 @@ def call_ai_for_explanations(context_data):
 }}"""
 
     try:
-        response = client.chat.completions.create(
+        result_text = chat_completion(
+            client,
             model="gemini-2.5-pro",
             messages=[
                 {"role": "system", "content": "你是一个专业的数据分析专家，擅长从数据中提取洞察并生成清晰、具体的解释说明。"},
@@ -260,8 +266,6 @@ def call_ai_for_explanations(context_data):
             max_tokens=4000
         )
         
-        result_text = response.choices[0].message.content
-        
         # 尝试提取 JSON
         json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
         if json_match:
@@ -275,6 +279,11 @@ def call_ai_for_explanations(context_data):
         return None
 
 def main():
+    parser = argparse.ArgumentParser(description="使用 AI 生成详细的指标说明和解释")
+    parser.add_argument("--no-cache", action="store_true", help="不使用 API 响应缓存（见 llm_cache.py）")
+    if parser.parse_args().no_cache:
+        disable_cache()
+    
     print("正在分析数据...")
     
     # 分析关键词
@@ -298,6 +307,7 @@ def main():
         print(f"✅ 详细解释已保存到: {output_file}")
     else:
         print("❌ 生成失败")
+    print(cache_summary())
 
 if __name__ == "__main__":
     main()
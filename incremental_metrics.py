@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+网站指标的增量更新
+
+第一次运行时完整计算一次，并在数据目录的 .dataset_cache/ 中保存增量状态：
+1. partial - 全部对话的部分聚合（PartialMetrics，见 partial_metrics.py），
+   website_metrics.json 的所有数值都由它得到
+2. features - 每个对话一行的特征（conversations 表中的列）
+3. activity - 每个对话在每个 (日期, 小时) 的消息数（conversation_activity）
+4. signatures - 当时 ingest_manifest.json 中每个对话的变更签名（见 json_to_dataset.py）
+
+之后每次运行（例如每晚 json_to_dataset.py --incremental 导入新数据后）：
+对比 conversations 表与状态中的对话找出新增和删除的对话，对比增量导入清单中的
+签名（update_time 或内容哈希）找出变更的对话；从 partial 中减去变更 / 删除对话
+原有的贡献，只读取新增 / 变更对话的 messages 行并加回。耗时与当天变化的对话数
+成正比，而不是与全部历史成正比。
+
+数据集没有 conversations 表（旧版本导入）或状态不可用时退回完整计算。没有可用的
+清单（不是增量导入的数据集，或之后又做过全量导入）时，退回比较两次的特征表：
+特征完全不变、只改动了消息时间的对话不会被识别，这种情况下删除 .dataset_cache/
+中的 website_state.pkl 即可完整重算。
+"""
+
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+from dataset_io import PREPARED_CACHE_DIR, add_derived_columns, find_table, read_table
+from json_to_dataset import MANIFEST_FILE
+from metrics_engine import _conversation_table_fresh, load_conversation_features
+from partial_metrics import PartialMetrics, conversation_activity
+
+
+STATE_VERSION = 2
+STATE_FILE = 'website_state.pkl'
+# 增量读取新增 / 变更对话时需要的 messages 列
+ACTIVITY_COLUMNS = ['conversation_id', 'create_time']
+
+
+class MetricsState:
+    """增量状态：部分聚合 + 每个对话的特征、时间分布和导入清单签名"""
+
+    def __init__(self, partial: PartialMetrics, features: pd.DataFrame, activity: pd.DataFrame,
+                 signatures: Optional[Dict[str, Any]] = None):
+        self.partial = partial
+        self.features = features
+        self.activity = activity
+        self.signatures = signatures
+
+    @staticmethod
+    def path(data_dir: str) -> Path:
+        return Path(data_dir) / PREPARED_CACHE_DIR / STATE_FILE
+
+    @classmethod
+    def load(cls, data_dir: str) -> Optional['MetricsState']:
+        """读取增量状态；不存在或版本不一致时返回 None"""
+        path = cls.path(data_dir)
+        if not path.exists():
+            return None
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != STATE_VERSION:
+            return None
+        return cls(PartialMetrics.from_dict(data['partial']), data['features'], data['activity'],
+                   data['signatures'])
+
+    def save(self, data_dir: str) -> None:
+        path = self.path(data_dir)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'version': STATE_VERSION,
+                'partial': self.partial.to_dict(),
+                'features': self.features,
+                'activity': self.activity,
+                'signatures': self.signatures,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+def load_signatures(data_dir: str) -> Optional[Dict[str, Any]]:
+    """
+    读取增量导入清单中的对话签名
+
+    清单不存在、无法读取，或早于 messages 表（之后又做过全量导入，清单已过期）时返回 None
+    """
+    path = Path(data_dir) / MANIFEST_FILE
+    try:
+        if path.stat().st_mtime_ns < find_table('messages', data_dir).stat().st_mtime_ns:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)['conversations']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _changed_by_signature(common: pd.Index, old: Dict[str, Any], new: Dict[str, Any]) -> pd.Index:
+    """两次清单中签名不同的对话（清单中没有的对话，如缺少 ID 的，每次增量导入都会重写）"""
+    return common[[cid not in new or old.get(cid) != new[cid] for cid in common]]
+
+
+def _changed_conversations(old: pd.DataFrame, new: pd.DataFrame) -> pd.Index:
+    """两张特征表中都存在、但任一列取值不同的对话"""
+    common = old.index.intersection(new.index)
+    before, after = old.loc[common], new.loc[common, old.columns]
+    changed = pd.Series(False, index=common)
+    for col in old.columns:
+        a, b = before[col].astype(object), after[col].astype(object)
+        changed |= ~((a == b) | (a.isna() & b.isna()))
+    return common[changed.to_numpy()]
+
+
+def update_state(data_dir: str, state: MetricsState) -> Tuple[MetricsState, dict]:
+    """
+    把数据目录中的新数据合并进增量状态
+
+    Args:
+        data_dir: 数据目录（需要有 conversations 表）
+        state: 上次保存的状态
+
+    Returns:
+        (新状态, 统计)，统计中为新增 / 变更 / 删除的对话数
+    """
+    current = load_conversation_features(data_dir, None)
+    old = state.features
+    added = current.index.difference(old.index)
+    removed = old.index.difference(current.index)
+    signatures = load_signatures(data_dir)
+    if state.signatures is not None and signatures is not None:
+        changed = _changed_by_signature(old.index.intersection(current.index), state.signatures, signatures)
+    else:
+        changed = _changed_conversations(old, current)
+    stats = {'new': len(added), 'changed': len(changed), 'removed': len(removed)}
+
+    partial = state.partial
+    shards = partial.shards
+    stale = removed.union(changed)
+    if len(stale):
+        stale_activity = state.activity['conversation_id'].isin(stale)
+        partial.subtract(PartialMetrics.from_activity(old.loc[stale], state.activity[stale_activity]))
+        activity = state.activity[~stale_activity]
+    else:
+        activity = state.activity
+
+    fresh = added.union(changed)
+    if len(fresh):
+        messages_df = read_table('messages', data_dir, ACTIVITY_COLUMNS, conversation_ids=list(fresh))
+        fresh_activity = conversation_activity(add_derived_columns(messages_df))
+        partial.merge(PartialMetrics.from_activity(current.loc[fresh], fresh_activity))
+        partial.shards = shards
+        activity = pd.concat([activity, fresh_activity], ignore_index=True)
+
+    # 最早 / 最晚时间不能相减，直接取各对话起止时间的最值
+    if len(current):
+        partial.first_time = pd.Timestamp(current['first_message_time'].min())
+        partial.last_time = pd.Timestamp(current['last_message_time'].max())
+    return MetricsState(partial, current, activity, signatures), stats
+
+
+def incremental_partial(data_dir: str, build_full) -> Tuple[PartialMetrics, Optional[dict]]:
+    """
+    增量计算数据目录的部分聚合，并保存新状态
+
+    Args:
+        data_dir: 数据目录
+        build_full: 无可用状态时调用，返回 (messages_df, features, partial) 的完整计算
+
+    Returns:
+        (部分聚合, 统计)；完整计算时统计为 None
+    """
+    state = MetricsState.load(data_dir) if _conversation_table_fresh(data_dir) else None
+    if state is None:
+        messages_df, features, partial = build_full()
+        state = MetricsState(partial, features, conversation_activity(messages_df), load_signatures(data_dir))
+        stats = None
+    else:
+        state, stats = update_state(data_dir, state)
+    if _conversation_table_fresh(data_dir):
+        state.save(data_dir)
+    return state.partial, stats
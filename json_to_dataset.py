@@ -5,14 +5,42 @@
 产出两张表：
 1. messages - 每条消息一行，包含所有字段
 2. edges - 每条父子关系一行，用于树可视化
+
+输入可以是 conversations.json，也可以直接是官方导出的 .zip 或 .json.gz（边读边解压）。
+输入为 zip 时还会写出 assets 表，索引压缩包中的附件文件（见 export_archive.py）。
 """
 
 import json
+import hashlib
+import os
+import sqlite3
 import pandas as pd
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterable, Iterator, TextIO
 import sys
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from blob_store import DEDUPED_MESSAGE_COLUMNS, HASH_FIELDS, hash_contents, open_messages_writer
+from content_classifier import DEFAULT_CLASSIFIER, classify_content
+from dataset_io import (
+    BLOB_COLUMNS, CONVERSATION_COLUMNS, MESSAGE_COLUMNS, EDGE_COLUMNS, FORMATS, iter_table,
+    open_writer, sqlite_insert, table_columns, table_path,
+)
+from export_archive import has_assets, iter_assets, open_export
+from metadata_fields import METADATA_DEFAULTS, extract_metadata_fields
+from metrics_engine import record_features, write_conversation_table
+
+
+# 流式模式下每次读取的字符数与默认的刷盘行数
+STREAM_READ_SIZE = 1 << 20
+DEFAULT_CHUNK_ROWS = 50000
+# 多进程模式下每个任务包含的对话数
+DEFAULT_WORKER_CHUNK = 64
+# 增量模式的清单文件（conversation_id -> update_time/内容哈希）
+MANIFEST_FILE = "ingest_manifest.json"
+
 
 def extract_text_from_parts(parts: List[Any]) -> str:
     """从 parts 数组中提取所有文本内容并拼接"""
@@ -34,37 +62,61 @@ def extract_text_from_parts(parts: List[Any]) -> str:
     return "\n".join(text_parts)
 
 
-def detect_content_flags(parts: List[Any], text: str) -> Dict[str, bool]:
-    """检测内容类型标签"""
-    has_code = False
-    has_image = False
-    has_link = False
-    
-    # 检测代码块（通常在 parts 中以特定格式存在）
-    if isinstance(parts, list):
-        for part in parts:
-            if isinstance(part, dict):
-                # 检查是否有代码相关的字段
-                part_str = json.dumps(part).lower()
-                if "code" in part_str or "language" in part_str or "```" in part_str:
-                    has_code = True
-                if "image" in part_str or "image_url" in part_str:
-                    has_image = True
-    
-    # 在文本中检测代码块标记
-    if "```" in text:
-        has_code = True
-    
-    # 检测链接
-    if isinstance(text, str):
-        if "http://" in text or "https://" in text or "www." in text:
-            has_link = True
+def compute_tree_columns(mapping: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    一次遍历 mapping，计算每个节点的树结构列
     
-    return {
-        "has_code": has_code,
-        "has_image": has_image,
-        "has_link": has_link
-    }
+    Args:
+        mapping: 对话的 mapping（node_id -> 节点）
+        
+    Returns:
+        node_id -> {root_id, depth, sibling_index, is_leaf, subtree_size}；
+        根节点深度为 0，subtree_size 包含节点自身
+    """
+    children_of: Dict[str, List[str]] = {}
+    sibling_index: Dict[str, int] = {}
+    roots = []
+    for node_id, node in mapping.items():
+        children = node.get("children") if isinstance(node, dict) else None
+        kids = [c for c in children if c in mapping] if isinstance(children, list) else []
+        children_of[node_id] = kids
+        for i, child_id in enumerate(kids):
+            sibling_index.setdefault(child_id, i)
+        parent_id = node.get("parent") if isinstance(node, dict) else None
+        if parent_id is None or parent_id not in mapping:
+            roots.append(node_id)
+    
+    columns: Dict[str, Dict[str, Any]] = {}
+    order = []
+    # 先从真正的根出发，再把无法到达的节点（如环）当作各自的根，保证每个节点都有值
+    for start in roots + list(mapping):
+        if start in columns:
+            continue
+        stack = [(start, 0)]
+        while stack:
+            node_id, depth = stack.pop()
+            if node_id in columns:
+                continue
+            kids = children_of[node_id]
+            columns[node_id] = {
+                "root_id": start,
+                "depth": depth,
+                "sibling_index": sibling_index.get(node_id, 0) if depth else 0,
+                "is_leaf": not kids,
+                "subtree_size": 1,
+            }
+            order.append(node_id)
+            stack.extend((child_id, depth + 1) for child_id in reversed(kids))
+    
+    # 逆先序累加子树大小（子节点一定排在父节点之后）
+    for node_id in reversed(order):
+        info = columns[node_id]
+        for child_id in children_of[node_id]:
+            child = columns[child_id]
+            if child["root_id"] == info["root_id"] and child["depth"] == info["depth"] + 1:
+                info["subtree_size"] += child["subtree_size"]
+    
+    return columns
 
 
 def parse_conversation(conv: Dict[str, Any]) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
@@ -84,6 +136,7 @@ def parse_conversation(conv: Dict[str, Any]) -> tuple[List[Dict[str, Any]], List
     default_model_slug = conv.get("default_model_slug")
     
     mapping = conv.get("mapping", {})
+    tree = compute_tree_columns(mapping)
     
     messages = []
     edges = []
@@ -102,15 +155,16 @@ def parse_conversation(conv: Dict[str, Any]) -> tuple[List[Dict[str, Any]], List
             "node_id": node_id,
             "parent_id": parent_id,
             "children_ids": children if isinstance(children, list) else [],
+            **tree[node_id],
             "create_time": conversation_create_time,  # 先用会话级的
             "update_time": conversation_update_time,  # 先用会话级的
             "role": None,
             "content_type": None,
             "parts_raw": None,
+            "content_raw": None,
             "text": "",
-            "has_code": False,
-            "has_image": False,
-            "has_link": False,
+            **DEFAULT_CLASSIFIER.empty_result(),
+            **METADATA_DEFAULTS,
             "metadata_raw": None,
         }
         
@@ -142,12 +196,10 @@ def parse_conversation(conv: Dict[str, Any]) -> tuple[List[Dict[str, Any]], List
                 # 提取文本
                 text = extract_text_from_parts(parts)
                 message_record["text"] = text
-                
-                # 检测内容标签
-                flags = detect_content_flags(parts, text)
-                message_record["has_code"] = flags["has_code"]
-                message_record["has_image"] = flags["has_image"]
-                message_record["has_link"] = flags["has_link"]
+                # content 中除 parts 外还有其他字段（代码的 language/text、工具结果的 result 等）时
+                # 原样保存整个 content，重新分类时与导入使用相同的输入（见 content_classifier.py）
+                if set(content) - {"content_type", "parts"}:
+                    message_record["content_raw"] = json.dumps(content)
             else:
                 # content 可能不是字典，尝试其他方式处理
                 message_record["parts_raw"] = json.dumps(content) if content else None
@@ -156,7 +208,11 @@ def parse_conversation(conv: Dict[str, Any]) -> tuple[List[Dict[str, Any]], List
                 elif isinstance(content, list):
                     message_record["text"] = extract_text_from_parts(content)
             
-            # 提取 metadata（原样保存）
+            # 检测内容标签（单次遍历 content 结构，不做序列化）
+            message_record.update(classify_content(content))
+            
+            # 常用 metadata 字段提升为独立列，metadata 本身原样保存
+            message_record.update(extract_metadata_fields(msg))
             metadata = msg.get("metadata")
             if metadata:
                 message_record["metadata_raw"] = json.dumps(metadata)
@@ -176,20 +232,281 @@ def parse_conversation(conv: Dict[str, Any]) -> tuple[List[Dict[str, Any]], List
     return messages, edges
 
 
-def convert_json_to_dataset(json_file_path: str, output_dir: str = ".") -> Dict[str, pd.DataFrame]:
+def iter_json_array(f: TextIO, read_size: int = STREAM_READ_SIZE) -> Iterator[Any]:
+    """
+    逐个元素解析顶层 JSON 数组，内存中只保留当前元素和一个读缓冲区
+    
+    Args:
+        f: 已打开的文本文件对象
+        read_size: 每次从文件读取的字符数
+        
+    Yields:
+        数组中的每个元素
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    
+    def fill(size: int) -> bool:
+        """丢弃已消费的缓冲区并读入更多数据，读到文件末尾时返回 False"""
+        nonlocal buf, pos, eof
+        chunk = f.read(size)
+        buf = buf[pos:] + chunk
+        pos = 0
+        if not chunk:
+            eof = True
+        return bool(chunk)
+    
+    def skip_ws() -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or not fill(read_size):
+                return
+    
+    skip_ws()
+    if pos >= len(buf) or buf[pos] != "[":
+        raise ValueError("JSON 文件应该是一个对话列表（顶层必须是数组）")
+    pos += 1
+    
+    skip_ws()
+    if pos < len(buf) and buf[pos] == "]":
+        return
+    
+    while True:
+        skip_ws()
+        size = read_size
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                item, end = None, None
+            # 元素恰好结束在缓冲区末尾时可能被截断（如数字），需要再读一些确认
+            if end is not None and (end < len(buf) or eof):
+                break
+            if not fill(size):
+                if end is not None:
+                    break
+                raise ValueError(f"JSON 文件在第 {pos} 个字符附近不完整")
+            # 单个元素很大时成倍增加读取量，避免反复从头解析
+            size *= 2
+        yield item
+        pos = end
+        
+        skip_ws()
+        if pos >= len(buf):
+            raise ValueError("JSON 数组未正确结束")
+        if buf[pos] == ",":
+            pos += 1
+        elif buf[pos] == "]":
+            return
+        else:
+            raise ValueError(f"JSON 数组元素之间缺少逗号: {buf[pos]!r}")
+
+
+def _parse_chunk(start: int, conversations: List[Dict[str, Any]]) -> List[tuple]:
+    """
+    解析一批对话（进程池中的工作单元）
+    
+    Returns:
+        [(index, messages, edges, error), ...]，出错的对话 messages/edges 为空、error 为错误信息
+    """
+    results = []
+    for offset, conv in enumerate(conversations):
+        try:
+            messages, edges = parse_conversation(conv)
+            results.append((start + offset, messages, edges, None))
+        except Exception as e:
+            results.append((start + offset, [], [], f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _chunked(items: Iterable[Any], size: int) -> Iterator[tuple[int, List[Any]]]:
+    """把可迭代对象切成 (起始下标, 列表) 形式的小块"""
+    chunk = []
+    start = 0
+    for i, item in enumerate(items):
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield start, chunk
+            start = i + 1
+            chunk = []
+    if chunk:
+        yield start, chunk
+
+
+def _report(batches: Iterable[List[tuple]], total: Optional[int]) -> Iterator[tuple]:
+    """打印进度和出错对话的序号，产出成功解析的结果"""
+    for batch in batches:
+        for index, messages, edges, error in batch:
+            if (index + 1) % 100 == 0:
+                print(f"处理进度: {index + 1}/{total}" if total else f"处理进度: {index + 1}")
+            if error is not None:
+                print(f"警告: 处理第 {index + 1} 个对话时出错: {error}")
+                continue
+            yield index, messages, edges
+
+
+def iter_parsed_conversations(conversations: Iterable[Dict[str, Any]], workers: int = 1,
+                              chunk_size: int = DEFAULT_WORKER_CHUNK,
+                              total: Optional[int] = None
+                              ) -> Iterator[tuple[int, List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    """
+    解析对话并按输入顺序产出结果
+    
+    workers > 1 时把对话按 chunk_size 分块交给进程池，结果按原顺序合并，输出保持确定。
+    单个对话出错时打印其序号并跳过，不影响其他对话。
+    
+    Args:
+        conversations: 对话的可迭代对象（可以是流式解析器）
+        workers: 进程数，1 表示在当前进程中串行解析
+        chunk_size: 每个进程任务包含的对话数
+        total: 对话总数（仅用于进度显示）
+        
+    Yields:
+        (index, messages, edges) 元组，index 从 0 开始
+    """
+    if workers <= 1:
+        batches = (_parse_chunk(start, chunk) for start, chunk in _chunked(conversations, chunk_size))
+        yield from _report(batches, total)
+        return
+    
+    def ordered_batches():
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for start, chunk in _chunked(conversations, chunk_size):
+                pending.append(executor.submit(_parse_chunk, start, chunk))
+                # 限制在途任务数，避免流式输入被一次性读入内存
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    
+    yield from _report(ordered_batches(), total)
+
+
+def _write_assets(json_file_path: str, output_path: Path, fmt: str) -> Optional[int]:
+    """输入为 zip 导出包时写出 assets 表（附件索引），返回附件数；否则返回 None"""
+    if not has_assets(json_file_path):
+        return None
+    writer = open_writer(output_path, "assets", fmt)
+    try:
+        writer.write(list(iter_assets(json_file_path)))
+    finally:
+        writer.close()
+    print(f"附件索引 {writer.rows} 个, 已保存到: {writer.path}")
+    return writer.rows
+
+
+def _write_conversations(output_path: Path, fmt: str) -> int:
+    """写出每个对话一行的特征表（conversations 表，见 metrics_engine.py），返回对话数"""
+    rows = write_conversation_table(output_path, fmt)
+    print(f"对话特征表 {rows} 行, 已保存到: {table_path(output_path, 'conversations', fmt)}")
+    return rows
+
+
+def _convert_streaming(json_file_path: str, output_path: Path, chunk_rows: int,
+                       fmt: str, workers: int, dedupe: bool) -> Dict[str, int]:
+    """
+    流式转换：逐个解析对话，累计到 chunk_rows 行后刷盘
+
+    每次刷盘的消息都是完整的对话，conversations 表的行在刷盘时由这一块记录
+    直接算出（见 metrics_engine.record_features），不在结束后把整表读回内存。
+    """
+    messages_writer = open_messages_writer(output_path, fmt, dedupe=dedupe)
+    edges_writer = open_writer(output_path, "edges", fmt)
+    conversations_writer = open_writer(output_path, "conversations", fmt)
+    
+    message_buf: List[Dict[str, Any]] = []
+    edge_buf: List[Dict[str, Any]] = []
+    # 与 message_buf 中的对话对应的边（edge_buf 单独刷盘，两者不同步）
+    feature_edges: List[Dict[str, Any]] = []
+    num_conversations = 0
+    
+    def count(conversations: Iterable[Any]) -> Iterator[Any]:
+        nonlocal num_conversations
+        for conv in conversations:
+            num_conversations += 1
+            yield conv
+    
+    def flush_messages() -> None:
+        if message_buf:
+            conversations_writer.write(record_features(message_buf, feature_edges))
+        messages_writer.write(message_buf)
+    
+    try:
+        with open_export(json_file_path) as f:
+            parsed = iter_parsed_conversations(count(iter_json_array(f)), workers=workers)
+            for _, messages, edges in parsed:
+                message_buf.extend(messages)
+                edge_buf.extend(edges)
+                feature_edges.extend(edges)
+                
+                if len(message_buf) >= chunk_rows:
+                    flush_messages()
+                    message_buf, feature_edges = [], []
+                if len(edge_buf) >= chunk_rows:
+                    edges_writer.write(edge_buf)
+                    edge_buf = []
+        
+        flush_messages()
+        edges_writer.write(edge_buf)
+    finally:
+        messages_writer.close()
+        edges_writer.close()
+        conversations_writer.close()
+    
+    print(f"找到 {num_conversations} 个对话")
+    print(f"共提取 {messages_writer.rows} 条消息, {edges_writer.rows} 条边")
+    print(f"messages 已保存到: {messages_writer.path}")
+    print(f"edges 已保存到: {edges_writer.path}")
+    print(f"对话特征表 {conversations_writer.rows} 行, 已保存到: {conversations_writer.path}")
+    
+    return {
+        "conversations": num_conversations,
+        "messages": messages_writer.rows,
+        "edges": edges_writer.rows,
+        "assets": _write_assets(json_file_path, output_path, fmt),
+    }
+
+
+def convert_json_to_dataset(json_file_path: str, output_dir: str = ".",
+                            stream: bool = False,
+                            chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                            fmt: str = "csv",
+                            workers: int = 1,
+                            dedupe: bool = False) -> Dict[str, Any]:
     """
     将 JSON 文件转换为宽数据集
     
     Args:
-        json_file_path: 输入的 JSON 文件路径
+        json_file_path: 输入的 JSON 文件路径（也可以是 .zip 导出包或 .json.gz）
         output_dir: 输出目录（默认为当前目录）
+        stream: 是否使用流式模式（逐个解析对话并分块写出，内存占用与文件大小无关）
+        chunk_rows: 流式模式下每次刷盘的行数
+        fmt: 输出格式（csv / parquet / feather / sqlite）
+        workers: 解析对话的进程数（1 表示串行）
+        dedupe: 是否把 text/parts_raw/content_raw/metadata_raw 写入内容寻址的 blobs 表，
+            messages 表只保存哈希引用（返回的 DataFrame 仍包含完整正文）
         
     Returns:
-        包含 'messages' 和 'edges' 两个 DataFrame 的字典
+        非流式模式：包含 'messages' 和 'edges' 两个 DataFrame 的字典；
+        流式模式：包含 'conversations'、'messages'、'edges'、'assets' 行数的字典
+        （输入不是 zip 时 'assets' 为 None）
     """
     print(f"正在读取 JSON 文件: {json_file_path}")
     
-    with open(json_file_path, 'r', encoding='utf-8') as f:
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    
+    if stream:
+        result = _convert_streaming(json_file_path, output_path, chunk_rows, fmt, workers, dedupe)
+        print("转换完成!")
+        return result
+    
+    with open_export(json_file_path) as f:
         conversations = json.load(f)
     
     if not isinstance(conversations, list):
@@ -200,37 +517,32 @@ def convert_json_to_dataset(json_file_path: str, output_dir: str = ".") -> Dict[
     all_messages = []
     all_edges = []
     
-    # 处理每个对话
-    for i, conv in enumerate(conversations):
-        if (i + 1) % 100 == 0:
-            print(f"处理进度: {i + 1}/{len(conversations)}")
-        
-        try:
-            messages, edges = parse_conversation(conv)
-            all_messages.extend(messages)
-            all_edges.extend(edges)
-        except Exception as e:
-            print(f"警告: 处理第 {i + 1} 个对话时出错: {e}")
-            continue
+    # 处理每个对话（workers > 1 时并行解析，按原顺序合并）
+    for _, messages, edges in iter_parsed_conversations(
+        conversations, workers=workers, total=len(conversations)
+    ):
+        all_messages.extend(messages)
+        all_edges.extend(edges)
     
     print(f"共提取 {len(all_messages)} 条消息, {len(all_edges)} 条边")
     
     # 转换为 DataFrame
-    messages_df = pd.DataFrame(all_messages)
-    edges_df = pd.DataFrame(all_edges)
+    messages_df = pd.DataFrame(all_messages, columns=MESSAGE_COLUMNS)
+    edges_df = pd.DataFrame(all_edges, columns=EDGE_COLUMNS)
     
-    # 保存为 CSV
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
-    
-    messages_csv = output_path / "messages.csv"
-    edges_csv = output_path / "edges.csv"
-    
-    print(f"正在保存 messages 到: {messages_csv}")
-    messages_df.to_csv(messages_csv, index=False, encoding='utf-8-sig')
-    
-    print(f"正在保存 edges 到: {edges_csv}")
-    edges_df.to_csv(edges_csv, index=False, encoding='utf-8-sig')
+    # 保存为指定格式
+    for name, records in (("messages", all_messages), ("edges", all_edges)):
+        if name == "messages":
+            writer = open_messages_writer(output_path, fmt, dedupe=dedupe)
+        else:
+            writer = open_writer(output_path, name, fmt)
+        print(f"正在保存 {name} 到: {writer.path}")
+        try:
+            writer.write(records)
+        finally:
+            writer.close()
+    _write_conversations(output_path, fmt)
+    _write_assets(json_file_path, output_path, fmt)
     
     print("转换完成!")
     
@@ -240,22 +552,298 @@ def convert_json_to_dataset(json_file_path: str, output_dir: str = ".") -> Dict[
     }
 
 
+def conversation_signature(conv: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    计算对话的变更签名：优先使用 update_time，缺失时退回到内容哈希
+    
+    Returns:
+        {"update_time": ..., "hash": ...}，哈希只在没有 update_time 时计算
+    """
+    update_time = conv.get("update_time") if isinstance(conv, dict) else None
+    if update_time is not None:
+        return {"update_time": update_time, "hash": None}
+    payload = json.dumps(conv, sort_keys=True, ensure_ascii=False, default=str)
+    return {"update_time": None, "hash": hashlib.sha1(payload.encode("utf-8")).hexdigest()}
+
+
+def _load_manifest(manifest_path: Path, fmt: str, dedupe: bool) -> Optional[Dict[str, Any]]:
+    """读取增量清单；格式或存储方式不一致、文件损坏时返回 None（触发全量重建）"""
+    if not manifest_path.exists():
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"警告: 无法读取增量清单 {manifest_path}: {e}，将全量重建")
+        return None
+    if manifest.get("format") != fmt:
+        print(f"提示: 清单记录的格式为 {manifest.get('format')}，与本次 {fmt} 不一致，将全量重建")
+        return None
+    if bool(manifest.get("dedupe")) != dedupe:
+        print("提示: 清单记录的正文去重设置与本次不一致，将全量重建")
+        return None
+    return manifest
+
+
+def _is_stale(conversation_ids: pd.Series, stale: set) -> pd.Series:
+    """属于 stale 中对话的行（没有 conversation_id 的行无法追踪，也算在内）"""
+    return conversation_ids.astype(object).fillna("").isin(stale)
+
+
+def _rewrite_tables(output_path: Path, fmt: str, stale: set,
+                    new_messages: List[Dict[str, Any]], new_edges: List[Dict[str, Any]],
+                    new_features: Optional[Any], has_outputs: bool, dedupe: bool) -> Dict[str, int]:
+    """
+    逐块读取旧表、去掉 stale 对话的行，再追加新解析的行，写到临时文件后替换
+
+    new_features 为 None 时不处理 conversations 表。返回各表的行数。
+    """
+    def tmp_of(path: Path) -> Path:
+        return path.with_name(path.name + ".tmp")
+    
+    tables = [("messages", new_messages), ("edges", new_edges)]
+    if new_features is not None:
+        tables.append(("conversations", new_features))
+    rows = {}
+    for name, records in tables:
+        final_path = table_path(output_path, name, fmt)
+        replacements = [final_path]
+        blobs_path = table_path(output_path, "blobs", fmt)
+        if name == "messages" and dedupe:
+            replacements.append(blobs_path)
+        # 上次中断留下的临时文件不能沿用（sqlite 写出器会在已有文件上继续写）
+        for path in replacements:
+            tmp_of(path).unlink(missing_ok=True)
+        if name == "messages":
+            writer = open_messages_writer(output_path, fmt, dedupe=dedupe, path=tmp_of(final_path),
+                                          blobs_path=tmp_of(blobs_path))
+        else:
+            writer = open_writer(output_path, name, fmt, path=tmp_of(final_path))
+        try:
+            if has_outputs:
+                for chunk in iter_table(name, output_path, fmt=fmt):
+                    writer.write(chunk[~_is_stale(chunk["conversation_id"], stale)])
+            writer.write(records)
+            if has_outputs and dedupe and name == "messages":
+                # 保留的旧行仍引用旧 blobs 表中的内容
+                for chunk in iter_table("blobs", output_path, fmt=fmt):
+                    writer.carry_over(chunk)
+        finally:
+            writer.close()
+        # sqlite 格式下所有表在同一个文件中，只替换一次
+        for path in dict.fromkeys(replacements):
+            os.replace(tmp_of(path), path)
+        rows[name] = writer.rows
+    return rows
+
+
+def _update_sqlite(path: Path, stale: set,
+                   new_messages: List[Dict[str, Any]], new_edges: List[Dict[str, Any]],
+                   new_features: Optional[Any], dedupe: bool) -> Dict[str, int]:
+    """
+    在 dataset.sqlite 中原地替换 stale 对话的行：删除旧行、插入新行在同一个事务中完成，
+    中途失败时整体回滚，不需要复制整个数据库
+
+    new_features 为 None 时不处理 conversations 表。返回 messages / edges 的行数。
+    """
+    conn = sqlite3.connect(str(path))
+    try:
+        conn.execute("CREATE TEMP TABLE stale_ids (conversation_id TEXT PRIMARY KEY)")
+        where = ("conversation_id IS NULL OR conversation_id = ''"
+                 " OR conversation_id IN (SELECT conversation_id FROM temp.stale_ids)")
+        tables = ["messages", "edges"] + (["conversations"] if new_features is not None else [])
+        with conn:
+            conn.executemany("INSERT INTO temp.stale_ids VALUES (?)", ((cid,) for cid in stale if cid))
+            for name in tables:
+                conn.execute(f'DELETE FROM "{name}" WHERE {where}')
+            if dedupe:
+                messages_df, new_blobs = hash_contents(pd.DataFrame(new_messages), set())
+                sqlite_insert(conn, "messages", messages_df, DEDUPED_MESSAGE_COLUMNS)
+                conn.execute("CREATE TEMP TABLE new_blobs (hash TEXT, content TEXT)")
+                sqlite_insert(conn, "new_blobs", new_blobs, BLOB_COLUMNS)
+                # NOT EXISTS 而不是 NOT IN：blobs 中有 NULL 哈希时 NOT IN 永远不成立
+                conn.execute("INSERT INTO blobs SELECT n.hash, n.content FROM temp.new_blobs n"
+                             " WHERE NOT EXISTS (SELECT 1 FROM blobs b WHERE b.hash = n.hash)")
+                # 清理不再被任何消息引用的内容（以及旧版本导入写出的 NULL 哈希空内容行）
+                referenced = " UNION ".join(f'SELECT "{col}" AS hash FROM messages WHERE "{col}" IS NOT NULL'
+                                            for col in HASH_FIELDS)
+                conn.execute(f"DELETE FROM blobs WHERE hash IS NULL OR hash NOT IN ({referenced})")
+                # 提交前确认每个引用都能取回内容，否则回滚（保持上次的数据集不变）
+                missing = conn.execute(
+                    f"SELECT COUNT(*) FROM ({referenced}) r"
+                    " WHERE NOT EXISTS (SELECT 1 FROM blobs b WHERE b.hash = r.hash)"
+                ).fetchone()[0]
+                if missing:
+                    raise RuntimeError(f"增量更新后有 {missing} 个内容哈希在 blobs 表中找不到，已回滚")
+            else:
+                sqlite_insert(conn, "messages", new_messages, MESSAGE_COLUMNS)
+            sqlite_insert(conn, "edges", new_edges, EDGE_COLUMNS)
+            if new_features is not None:
+                sqlite_insert(conn, "conversations", new_features, CONVERSATION_COLUMNS)
+        return {name: conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+                for name in ("messages", "edges")}
+    finally:
+        conn.close()
+
+
+def convert_incremental(json_file_path: str, output_dir: str = ".", fmt: str = "csv",
+                        workers: int = 1, dedupe: bool = False) -> Dict[str, int]:
+    """
+    增量转换：只重新解析新增或变更的对话，并替换输出表中对应的旧行
+    
+    输出目录中的 MANIFEST_FILE 记录 conversation_id -> 变更签名。没有清单或
+    输出表时等价于一次全量转换（并写出清单）。导出中已不存在的对话，其旧行也会被删除。
+    
+    旧表逐块读取、过滤后写出（不整表读入内存）；sqlite 格式在库内用一个事务
+    删除旧行并插入新行。conversations 表同样只替换变更对话的行。
+    
+    Args:
+        json_file_path: 输入的 JSON 文件路径（也可以是 .zip 导出包或 .json.gz）
+        output_dir: 输出目录（同时也是上次输出所在目录）
+        fmt: 输出格式（csv / parquet / feather / sqlite）
+        workers: 解析对话的进程数
+        dedupe: 是否使用内容寻址的 blobs 表存储正文（不再被引用的内容会被清理）
+        
+    Returns:
+        包含 'new'、'changed'、'removed'、'unchanged'、'messages'、'edges'、'assets' 计数的字典
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_path / MANIFEST_FILE
+    
+    manifest = _load_manifest(manifest_path, fmt, dedupe)
+    tables = ("messages", "edges", "blobs") if dedupe else ("messages", "edges")
+    has_outputs = all(table_path(output_path, name, fmt).exists() for name in tables)
+    expected_columns = DEDUPED_MESSAGE_COLUMNS if dedupe else MESSAGE_COLUMNS
+    if (manifest is not None and has_outputs
+            and table_columns(table_path(output_path, "messages", fmt), "messages") != expected_columns):
+        print("提示: 已有 messages 表的列与当前版本不一致，将全量重建")
+        has_outputs = False
+    if manifest is None or not has_outputs:
+        manifest = {"format": fmt, "dedupe": dedupe, "conversations": {}}
+        has_outputs = False
+    previous = manifest["conversations"]
+    
+    current: Dict[str, Dict[str, Any]] = {}
+    stats = {"new": 0, "changed": 0, "removed": 0, "unchanged": 0}
+    
+    def delta(conversations: Iterable[Any]) -> Iterator[Any]:
+        """只放行新增或变更的对话，同时记录本次导出的签名"""
+        for conv in conversations:
+            conv_id = conv.get("conversation_id", "") if isinstance(conv, dict) else ""
+            signature = conversation_signature(conv)
+            if conv_id:
+                current[conv_id] = signature
+                if previous.get(conv_id) == signature:
+                    stats["unchanged"] += 1
+                    continue
+            stats["changed" if conv_id in previous else "new"] += 1
+            yield conv
+    
+    print(f"正在增量读取 JSON 文件: {json_file_path}")
+    new_messages: List[Dict[str, Any]] = []
+    new_edges: List[Dict[str, Any]] = []
+    with open_export(json_file_path) as f:
+        for _, messages, edges in iter_parsed_conversations(delta(iter_json_array(f)), workers=workers):
+            new_messages.extend(messages)
+            new_edges.extend(edges)
+    
+    removed = set(previous) - set(current)
+    stats["removed"] = len(removed)
+    # 需要从旧输出中删除的对话：变更的、被删除的，以及没有 ID 无法追踪的；
+    # 新增的对话也算在内，上次写完输出表、没写完清单就中断时不会重复
+    stale = removed | {cid for cid in current if previous.get(cid) != current[cid]}
+    stale.add("")
+    
+    print(f"新增 {stats['new']} 个, 变更 {stats['changed']} 个, "
+          f"删除 {stats['removed']} 个, 未变化 {stats['unchanged']} 个对话")
+    
+    conversations_path = table_path(output_path, "conversations", fmt)
+    # 旧版本的输出没有 conversations 表（或列不一致）时整表重建，否则只替换变更对话的行
+    update_conversations = (has_outputs and conversations_path.exists()
+                            and table_columns(conversations_path, "conversations") == CONVERSATION_COLUMNS)
+    new_features = record_features(new_messages, new_edges) if new_messages else []
+    
+    if fmt == "sqlite" and has_outputs:
+        stats.update(_update_sqlite(table_path(output_path, "messages", fmt), stale, new_messages,
+                                    new_edges, new_features if update_conversations else None, dedupe))
+    else:
+        stats.update(_rewrite_tables(output_path, fmt, stale, new_messages, new_edges,
+                                     new_features if update_conversations else None, has_outputs, dedupe))
+    for name in ("messages", "edges"):
+        print(f"{name} 已保存到: {table_path(output_path, name, fmt)}（共 {stats[name]} 行）")
+    if update_conversations:
+        print(f"对话特征表已更新: {conversations_path}")
+    else:
+        _write_conversations(output_path, fmt)
+    stats["assets"] = _write_assets(json_file_path, output_path, fmt)
+    
+    manifest["conversations"] = current
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    
+    print("增量转换完成!")
+    return stats
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(
+        description="将对话 JSON 导出文件转换为 messages/edges 数据集",
+        epilog="示例: python json_to_dataset.py conversations.json ./output --stream",
+    )
+    parser.add_argument("json_file", help="输入的 JSON 文件路径，也可以直接是导出的 .zip 或 .json.gz")
+    parser.add_argument("output_dir", nargs="?", default=".", help="输出目录（默认当前目录）")
+    parser.add_argument("--stream", action="store_true",
+                        help="流式模式：逐个解析对话并分块写出，内存占用不随文件大小增长")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help=f"流式模式下每次刷盘的行数（默认 {DEFAULT_CHUNK_ROWS}）")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="解析对话的进程数（默认 1，即串行；结果按输入顺序合并）")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"增量模式：根据输出目录中的 {MANIFEST_FILE} 只重新解析新增或变更的对话")
+    parser.add_argument("--dedupe-text", action="store_true", dest="dedupe",
+                        help="正文去重：text/parts_raw/content_raw/metadata_raw 写入内容寻址的 blobs 表，messages 表只存哈希")
+    parser.add_argument("--format", choices=FORMATS, default="csv", dest="fmt",
+                        help="输出格式：csv（默认）、parquet、feather（带类型的列式格式，需要 pyarrow）"
+                             "或 sqlite（单个 dataset.sqlite，带索引，可按对话查询）")
+    return parser.parse_args(argv)
+
+
 def main():
     """主函数"""
-    if len(sys.argv) < 2:
-        print("用法: python json_to_dataset.py <input_json_file> [output_dir]")
-        print("示例: python json_to_dataset.py conversations.json ./output")
-        sys.exit(1)
-    
-    json_file = sys.argv[1]
-    output_dir = sys.argv[2] if len(sys.argv) > 2 else "."
+    args = parse_args()
+    json_file = args.json_file
+    output_dir = args.output_dir
     
     if not Path(json_file).exists():
         print(f"错误: 文件不存在: {json_file}")
         sys.exit(1)
     
     try:
-        datasets = convert_json_to_dataset(json_file, output_dir)
+        if args.incremental:
+            stats = convert_incremental(json_file, output_dir, fmt=args.fmt,
+                                        workers=args.workers, dedupe=args.dedupe)
+            print("\n数据集统计:")
+            print(f"Messages 行数: {stats['messages']}")
+            print(f"Edges 行数: {stats['edges']}")
+            if stats['assets'] is not None:
+                print(f"Assets 行数: {stats['assets']}")
+            return
+        
+        datasets = convert_json_to_dataset(
+            json_file, output_dir, stream=args.stream, chunk_rows=args.chunk_rows,
+            fmt=args.fmt, workers=args.workers, dedupe=args.dedupe
+        )
+        
+        if args.stream:
+            print("\n数据集统计:")
+            print(f"对话数: {datasets['conversations']}")
+            print(f"Messages 行数: {datasets['messages']}")
+            print(f"Edges 行数: {datasets['edges']}")
+            if datasets['assets'] is not None:
+                print(f"Assets 行数: {datasets['assets']}")
+            return
         
         print("\n数据集统计:")
         print(f"Messages DataFrame: {datasets['messages'].shape}")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+LLM 响应的磁盘缓存（sqlite）
+
+以 (model, temperature, max_tokens, system 提示词, user 提示词) 的哈希为键保存
+chat.completions 的回复文本。提示词逐字节相同的请求直接返回缓存，重跑脚本
+（崩溃后重试、只调整了报告排版等）不会重复调用 API。
+
+缓存超过大小上限时按最近访问时间淘汰最久未用的条目。只缓存成功的回复。
+
+环境变量：
+    LLM_CACHE_PATH     缓存文件路径（默认 .dataset_cache/llm_responses.sqlite）
+    LLM_CACHE_MAX_MB   大小上限，单位 MB（默认 200）
+    LLM_CACHE_DISABLE  设为 1 时不读也不写缓存（与脚本的 --no-cache 相同）
+
+用法示例：
+    text = chat_completion(client, model="deepseek", messages=[...],
+                           temperature=0.7, max_tokens=4000)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from dataset_io import PREPARED_CACHE_DIR
+
+
+DEFAULT_CACHE_PATH = Path(PREPARED_CACHE_DIR) / "llm_responses.sqlite"
+DEFAULT_MAX_MB = 200
+
+
+def cache_key(model: str, messages: List[Dict[str, str]], temperature: Optional[float] = None,
+              max_tokens: Optional[int] = None) -> str:
+    """
+    请求的缓存键
+
+    system 和 user 提示词分别拼接后参与哈希；其他影响输出的参数
+    （model / temperature / max_tokens）一并计入。
+    """
+    system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+    user = "\n".join(m["content"] for m in messages if m["role"] != "system")
+    user_hash = hashlib.blake2b(user.encode("utf-8"), digest_size=16).hexdigest()
+    payload = json.dumps([model, temperature, max_tokens, system, user_hash], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """sqlite 中的回复缓存，按大小上限做 LRU 淘汰"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, content TEXT, size INTEGER, "
+            "created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)")
+        # 上限调小后，打开时就淘汰到上限以内
+        self._evict()
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存的回复（同时更新访问时间）；未命中返回 None"""
+        row = self._conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._conn.commit()
+        return row[0]
+
+    def put(self, key: str, model: str, content: str) -> None:
+        """写入一条回复，超过大小上限时淘汰最久未访问的条目"""
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, content, size, created, accessed) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, content, size, now, now),
+        )
+        self._evict()
+        self._conn.commit()
+
+    def total_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self) -> None:
+        excess = self.total_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self) -> None:
+        self._conn.execute("DELETE FROM responses")
+        self._conn.commit()
+
+
+_cache: Optional[ResponseCache] = None
+_disabled = os.getenv("LLM_CACHE_DISABLE", "").lower() in ("1", "true", "yes")
+
+
+def disable_cache() -> None:
+    """本进程内不再读写缓存（脚本的 --no-cache）"""
+    global _disabled
+    _disabled = True
+
+
+def get_cache() -> Optional[ResponseCache]:
+    """进程内共享的缓存；被禁用时返回 None"""
+    global _cache
+    if _disabled:
+        return None
+    if _cache is None:
+        path = os.getenv("LLM_CACHE_PATH") or DEFAULT_CACHE_PATH
+        max_mb = float(os.getenv("LLM_CACHE_MAX_MB") or DEFAULT_MAX_MB)
+        _cache = ResponseCache(path, int(max_mb * 1024 * 1024))
+    return _cache
+
+
+def lookup(model: str, messages: List[Dict[str, str]], temperature: Optional[float] = None,
+           max_tokens: Optional[int] = None, **kwargs) -> Optional[str]:
+    """按请求参数查缓存；未命中或缓存被禁用时返回 None"""
+    cache = get_cache()
+    if cache is None:
+        return None
+    return cache.get(cache_key(model, messages, temperature, max_tokens))
+
+
+def store(content: Optional[str], model: str, messages: List[Dict[str, str]],
+          temperature: Optional[float] = None, max_tokens: Optional[int] = None, **kwargs) -> None:
+    """保存一次成功请求的回复（空回复不缓存）"""
+    cache = get_cache()
+    if cache is None or not content:
+        return
+    cache.put(cache_key(model, messages, temperature, max_tokens), model, content)
+
+
+def chat_completion(client, **request) -> str:
+    """
+    带缓存的 client.chat.completions.create，返回回复文本
+
+    Args:
+        client: OpenAI 客户端
+        **request: 传给 chat.completions.create 的参数（model / messages / temperature / max_tokens 等）
+    """
+    content = lookup(**request)
+    if content is not None:
+        return content
+    response = client.chat.completions.create(**request)
+    content = response.choices[0].message.content
+    store(content, **request)
+    return content
+
+
+def cache_summary() -> str:
+    """本进程的命中统计，供脚本结束时打印"""
+    if _cache is None:
+        return "未使用响应缓存" if _disabled else "响应缓存: 未访问"
+    return f"响应缓存: 命中 {_cache.hits} 次, 未命中 {_cache.misses} 次（{_cache.path}）"
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+把消息 metadata 中常用的字段提升为独立列
+
+导入时（json_to_dataset.py）直接从消息字典中取出：
+1. model_slug / default_model_slug - 生成该消息的模型
+2. finish_reason - metadata.finish_details.type（stop、max_tokens、interrupted 等）
+3. recipient - 消息的接收方（all 表示用户，其他为工具名，如 python、browser）
+4. tool_name - 工具消息的作者名（author.name）
+5. is_visually_hidden - metadata.is_visually_hidden_from_conversation
+6. citations_count - metadata.citations 的条数
+
+分析时只需读取这些列做 value_counts，不再逐行 json.loads(metadata_raw)。
+旧数据集没有这些列时，read_table 会用 promote_metadata 从 metadata_raw 补齐
+（recipient / tool_name 不在 metadata 中，无法补齐）。
+"""
+
+import json
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+
+# 列名 -> 默认值（列顺序与 MESSAGE_COLUMNS 中一致）
+METADATA_DEFAULTS: Dict[str, Any] = {
+    "model_slug": None,
+    "default_model_slug": None,
+    "finish_reason": None,
+    "recipient": None,
+    "tool_name": None,
+    "is_visually_hidden": False,
+    "citations_count": 0,
+}
+# 只依赖 metadata 本身、可以从 metadata_raw 还原的列
+METADATA_ONLY_COLUMNS = [
+    "model_slug", "default_model_slug", "finish_reason", "is_visually_hidden", "citations_count",
+]
+
+
+def _from_metadata(metadata: Any) -> Dict[str, Any]:
+    """从 metadata 字典中取出 METADATA_ONLY_COLUMNS"""
+    fields = {col: METADATA_DEFAULTS[col] for col in METADATA_ONLY_COLUMNS}
+    if not isinstance(metadata, dict):
+        return fields
+    for col in ("model_slug", "default_model_slug"):
+        if isinstance(metadata.get(col), str):
+            fields[col] = metadata[col]
+    finish = metadata.get("finish_details")
+    if isinstance(finish, dict) and isinstance(finish.get("type"), str):
+        fields["finish_reason"] = finish["type"]
+    fields["is_visually_hidden"] = bool(metadata.get("is_visually_hidden_from_conversation"))
+    citations = metadata.get("citations")
+    fields["citations_count"] = len(citations) if isinstance(citations, list) else 0
+    return fields
+
+
+def extract_metadata_fields(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    从一条消息中取出 METADATA_DEFAULTS 中的所有列
+
+    Args:
+        msg: mapping 节点的 message 字典
+
+    Returns:
+        列名 -> 值 的字典
+    """
+    fields = {**METADATA_DEFAULTS, **_from_metadata(msg.get("metadata"))}
+    recipient = msg.get("recipient")
+    if isinstance(recipient, str):
+        fields["recipient"] = recipient
+    author = msg.get("author")
+    if isinstance(author, dict) and author.get("role") == "tool" and isinstance(author.get("name"), str):
+        fields["tool_name"] = author["name"]
+    return fields
+
+
+def _parse(raw: Any) -> Optional[Dict[str, Any]]:
+    if not isinstance(raw, str) or not raw:
+        return None
+    try:
+        meta = json.loads(raw)
+    except ValueError:
+        return None
+    return meta if isinstance(meta, dict) else None
+
+
+def promote_metadata(messages_df: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    为旧数据集从 metadata_raw 补齐 METADATA_ONLY_COLUMNS（每行只解析一次）
+
+    Args:
+        messages_df: 含 metadata_raw 列的 DataFrame
+        columns: 只补齐这些列（默认全部）
+
+    Returns:
+        原表（原地添加缺失的列）
+    """
+    missing = [col for col in columns or METADATA_ONLY_COLUMNS
+               if col in METADATA_ONLY_COLUMNS and col not in messages_df.columns]
+    if not missing or "metadata_raw" not in messages_df.columns:
+        return messages_df
+    fields = pd.DataFrame(
+        [_from_metadata(_parse(raw)) for raw in messages_df["metadata_raw"]],
+        columns=METADATA_ONLY_COLUMNS, index=messages_df.index,
+    )
+    for col in missing:
+        messages_df[col] = fields[col]
+    return messages_df
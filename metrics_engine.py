@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+统一的指标计算引擎
+
+对 messages 表按 conversation_id 只做一次分组聚合，得到每个对话一行的特征表
+（消息数、各角色消息数、代码/图片/工具/多模态消息数、标题、起止时间、树结构指标，
+以及由这些列派生的对话分类标记）。
+
+analyze_usage_patterns.py 的 metrics.json 和 calculate_website_metrics.py 的
+website_metrics.json 中与对话相关的指标都是这张表上的简单投影，不再各自
+反复执行 groupby('conversation_id').size() 或按条件过滤后 unique()。
+
+json_to_dataset.py 导入时把特征表保存为数据目录中的 conversations 表
+（与 messages 表同一格式，见 write_conversation_table），分析脚本通过
+load_conversation_features 直接读取，不必每次重新聚合。
+"""
+
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from dataset_io import (
+    CONVERSATION_COLUMNS, find_table, open_writer, read_dataset, read_table, table_columns,
+    table_path, to_datetime,
+)
+from tree_metrics import conversation_tree_stats
+
+
+# 对话分类阈值
+COMPLEX_THRESHOLD = 20      # 消息数超过该值为复杂对话
+MULTI_STEP_THRESHOLD = 10   # 消息数超过该值为多步骤对话
+ITERATIVE_THRESHOLD = 3     # user 消息数超过该值为迭代优化对话
+# 商务文档类对话的标题关键词（不区分大小写）
+BUSINESS_KEYWORDS = ['ppt', '邮件', '周报', '报告', '演示', 'presentation', 'email', 'report']
+
+# 网站展示用的固定文本（基于总结分析，不由数据计算；精确模式与近似模式共用）
+CODE_LANGUAGES = ["R", "Python", "SQL"]
+IMAGE_TYPES = ["图像识别", "创意生成", "技术处理"]
+TOOL_USAGE_TYPES = ["搜索", "图像生成", "文件处理"]
+INTERACTION_MODES = {"collaborative": 40, "guidance": 35, "qa": 25}
+PERSONALITY_TRAITS = ["深度探讨型用户", "多话题切换能力", "迭代优化倾向", "结构化思维", "技术整合者", "创新应用者"]
+
+# 构建特征表需要的 messages / edges 列
+FEATURE_MESSAGE_COLUMNS = [
+    'conversation_id', 'conversation_title', 'node_id', 'depth', 'create_time', 'role',
+    'content_type', 'has_code', 'has_image', 'has_link', 'model_slug',
+]
+FEATURE_EDGE_COLUMNS = ['conversation_id', 'parent_id', 'child_id']
+
+
+def conversation_features(messages_df: pd.DataFrame,
+                          edges_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    一次分组聚合得到每个对话的特征表
+
+    Args:
+        messages_df: 消息表；缺少的可选列（has_link、datetime、depth 等）对应的特征会被省略
+        edges_df: 可选，提供时合并树结构指标（max_depth、branching_factor 等）
+
+    Returns:
+        以 conversation_id 为索引的 DataFrame（按对话首次出现的顺序），
+        model 为对话中第一个非空的 model_slug
+    """
+    columns = messages_df.columns
+    role = messages_df['role']
+    indicators = {
+        'conversation_id': messages_df['conversation_id'],
+        'message_count': 1,
+        'user_messages': role == 'user',
+        'assistant_messages': role == 'assistant',
+        'tool_messages': role == 'tool',
+        'code_messages': messages_df['has_code'].astype(bool),
+        'image_messages': messages_df['has_image'].astype(bool),
+        'multimodal_messages': messages_df['content_type'] == 'multimodal_text',
+    }
+    if 'has_link' in columns:
+        indicators['link_messages'] = messages_df['has_link'].astype(bool)
+    frame = pd.DataFrame(indicators, index=messages_df.index)
+
+    aggregations = {col: (col, 'sum') for col in frame.columns if col != 'conversation_id'}
+    if 'conversation_title' in columns:
+        frame['title'] = messages_df['conversation_title']
+        aggregations['title'] = ('title', 'first')
+    if 'datetime' in columns:
+        frame['datetime'] = messages_df['datetime']
+        aggregations['first_message_time'] = ('datetime', 'min')
+        aggregations['last_message_time'] = ('datetime', 'max')
+    if 'model_slug' in columns:
+        frame['model'] = messages_df['model_slug'].astype(object)
+        aggregations['model'] = ('model', 'first')
+
+    features = frame.groupby('conversation_id', observed=True, sort=False).agg(**aggregations)
+    features.index = features.index.astype(object)
+    add_conversation_flags(features)
+
+    if edges_df is not None and 'node_id' in columns:
+        tree_columns = [c for c in ('conversation_id', 'node_id', 'depth') if c in columns]
+        tree_stats = conversation_tree_stats(edges_df, messages_df[tree_columns])
+        features = features.join(tree_stats, how='left')
+    return features
+
+
+def add_conversation_flags(features: pd.DataFrame) -> pd.DataFrame:
+    """
+    由特征表中的计数列派生对话分类标记（原地添加并返回）
+
+    读取已保存的 conversations 表时也会重新派生，阈值或关键词调整后不需要重新导入。
+    """
+    features['has_code'] = features['code_messages'] > 0
+    features['has_image'] = features['image_messages'] > 0
+    features['has_tool'] = features['tool_messages'] > 0
+    features['is_multimodal'] = features['multimodal_messages'] > 0
+    features['is_complex'] = features['message_count'] > COMPLEX_THRESHOLD
+    features['is_multi_step'] = features['message_count'] > MULTI_STEP_THRESHOLD
+    features['is_iterative'] = features['user_messages'] > ITERATIVE_THRESHOLD
+    if 'title' in features.columns:
+        pattern = '|'.join(re.escape(kw) for kw in BUSINESS_KEYWORDS)
+        titles = features['title'].astype(object)
+        features['is_business'] = titles.notna() & titles.astype(str).str.lower().str.contains(pattern)
+    return features
+
+
+def record_features(messages: List[Dict[str, Any]], edges: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    由 parse_conversation 产出的消息 / 边记录构建特征表（conversations 表的行）
+
+    记录中的每个对话必须是完整的：流式导入时每块只含完整的对话，逐块计算
+    即可得到与整表计算相同的结果，不必在写完后把整张表读回内存。
+
+    Returns:
+        conversation_id 为普通列的特征表，可直接交给 conversations 表的写出器
+    """
+    messages_df = pd.DataFrame(messages, columns=FEATURE_MESSAGE_COLUMNS)
+    edges_df = pd.DataFrame(edges, columns=FEATURE_EDGE_COLUMNS)
+    messages_df['datetime'] = to_datetime(messages_df['create_time'])
+    return conversation_features(messages_df, edges_df).rename_axis('conversation_id').reset_index()
+
+
+def write_conversation_table(data_dir: str, fmt: str) -> int:
+    """
+    从数据目录中的 messages / edges 表构建特征表，保存为同一目录下的 conversations 表
+
+    Args:
+        data_dir: 数据目录（json_to_dataset.py 的输出目录）
+        fmt: 输出格式，与 messages 表一致
+
+    Returns:
+        写出的对话数
+    """
+    messages_df, edges_df = read_dataset(data_dir, FEATURE_MESSAGE_COLUMNS, FEATURE_EDGE_COLUMNS)
+    messages_df['datetime'] = to_datetime(messages_df['create_time'])
+    features = conversation_features(messages_df, edges_df)
+    # 先写临时文件再替换，写到一半中断时不会留下不完整的表（sqlite 在库内重建该表）
+    final_path = table_path(data_dir, 'conversations', fmt)
+    path = final_path if fmt == 'sqlite' else final_path.with_name(final_path.name + '.tmp')
+    writer = open_writer(data_dir, 'conversations', fmt, path=path)
+    try:
+        writer.write(features.rename_axis('conversation_id').reset_index())
+    finally:
+        writer.close()
+    if path != final_path:
+        os.replace(path, final_path)
+    return writer.rows
+
+
+def _conversation_table_fresh(data_dir: str) -> bool:
+    """
+    conversations 表存在、列完整，并且不早于 messages 表
+
+    sqlite 中各表在同一个文件里，无法比较修改时间；改写 messages 表的地方
+    （导入、增量导入、content_classifier.reclassify_dataset）都会同时重建该表。
+    """
+    try:
+        path = find_table('conversations', data_dir)
+        messages_path = find_table('messages', data_dir)
+    except FileNotFoundError:
+        return False
+    if path.suffix != messages_path.suffix or table_columns(path, 'conversations') != CONVERSATION_COLUMNS:
+        return False
+    return path.suffix == '.sqlite' or path.stat().st_mtime_ns >= messages_path.stat().st_mtime_ns
+
+
+def load_conversation_features(data_dir: str, messages_df: pd.DataFrame,
+                               edges_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    读取导入时保存的 conversations 表；不存在或早于 messages 表时现场计算
+
+    Args:
+        data_dir: 数据目录
+        messages_df, edges_df: conversations 表不可用时用于现场计算
+
+    Returns:
+        与 conversation_features 相同的特征表
+    """
+    if not _conversation_table_fresh(data_dir):
+        return conversation_features(messages_df, edges_df)
+    features = read_table('conversations', data_dir).set_index('conversation_id')
+    features.index = features.index.astype(object)
+    for col in ('first_message_time', 'last_message_time'):
+        features[col] = to_datetime(features[col])
+    return add_conversation_flags(features)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+可合并的网站指标部分聚合（partial aggregates）
+
+每个导出 / 分片（一个 json_to_dataset.py 产出的数据目录）单独计算一份
+PartialMetrics：计数、求和以及直方图（对话长度、对话深度、按小时 / 星期 /
+日期 / 月份的消息数和对话数）。website_metrics.json 中的所有数值都可以由
+这些量得到，因此多个分片的结果只需把各自的 PartialMetrics 相加，不需要
+拼接 messages 表。
+
+不同导出中的对话互不重叠（每个导出属于一个用户，同一导出拆成的分片也按对话
+划分），所以对话计数、按日期的对话数等都可以直接相加，合并结果是精确的。
+
+用法示例：
+    partial = PartialMetrics.from_frames(messages_df, features, cube, shard='alice')
+    partial.save('alice/website_partial.json')
+    merged = PartialMetrics.load('alice/website_partial.json').merge(
+        PartialMetrics.load('bob/website_partial.json'))
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+PARTIAL_VERSION = 1
+# 分片计算后写入数据目录的部分聚合文件
+PARTIAL_FILE = 'website_partial.json'
+
+# 对话级布尔标记（特征表中的列，见 metrics_engine.py）
+CONVERSATION_FLAGS = [
+    'has_code', 'has_image', 'has_tool', 'is_multimodal',
+    'is_complex', 'is_multi_step', 'is_iterative', 'is_business',
+]
+# 可按消息相加的计数
+MESSAGE_SUMS = ['code_messages', 'image_messages', 'tool_messages', 'multimodal_messages']
+# 直方图 / 计数表：名称 -> 索引是否为整数
+HISTOGRAMS = {
+    'length_histogram': True,      # 对话消息数 -> 对话数
+    'depth_histogram': True,       # 对话最大深度 -> 对话数
+    'hourly_messages': True,
+    'weekday_messages': False,
+    'daily_conversations': False,
+    'daily_messages': False,
+    'monthly_conversations': False,
+    'monthly_messages': False,
+}
+
+
+def _counts(series: pd.Series, integer_index: bool = False) -> pd.Series:
+    """规整为 int64 计数表：索引为字符串（日期、月份、星期）或整数（长度、小时）"""
+    series = series.astype('int64')
+    if integer_index:
+        series.index = series.index.astype('int64')
+    else:
+        series.index = series.index.map(str)
+    return series.groupby(level=0).sum()
+
+
+def _add(left: pd.Series, right: pd.Series) -> pd.Series:
+    """两张计数表按索引相加（保持 int64，索引排序）"""
+    return pd.concat([left, right]).groupby(level=0).sum()
+
+
+def _timestamp(value) -> Optional[pd.Timestamp]:
+    return None if value is None or pd.isna(value) else pd.Timestamp(value)
+
+
+class PartialMetrics:
+    """一个或多个分片的部分聚合"""
+
+    def __init__(self, shards: List[str], conversations: int, messages: int,
+                 first_time: Optional[pd.Timestamp], last_time: Optional[pd.Timestamp],
+                 conversation_flags: pd.Series, message_sums: pd.Series,
+                 histograms: Dict[str, pd.Series]):
+        self.shards = shards
+        self.conversations = conversations
+        self.messages = messages
+        self.first_time = first_time
+        self.last_time = last_time
+        self.conversation_flags = conversation_flags
+        self.message_sums = message_sums
+        self.histograms = histograms
+
+    @staticmethod
+    def _conversation_parts(features: pd.DataFrame):
+        """特征表上的标记计数、消息数求和、对话长度 / 深度直方图"""
+        flags = pd.Series({flag: int(features[flag].sum()) for flag in CONVERSATION_FLAGS}, dtype='int64')
+        # 需要同一对话上多个标记的并集，不能在合并后由单个标记的计数得到
+        flags['technical'] = int((features['has_code'] | features['has_tool'] | features['is_complex']).sum())
+        flags['creative'] = int((features['has_image'] | features['is_multimodal']).sum())
+        sums = pd.Series({col: features[col].sum() for col in MESSAGE_SUMS}).astype('int64')
+
+        depths = features['max_depth'].dropna() if 'max_depth' in features.columns else pd.Series(dtype='int64')
+        histograms = {
+            'length_histogram': features['message_count'].value_counts(),
+            'depth_histogram': depths.value_counts(),
+        }
+        return flags, sums, histograms
+
+    @classmethod
+    def from_frames(cls, messages_df: pd.DataFrame, features: pd.DataFrame,
+                    cube, shard: str = '.') -> 'PartialMetrics':
+        """
+        从一个分片的 messages 表、对话特征表和时间立方体计算部分聚合
+
+        Args:
+            messages_df: 带派生时间列的 messages 表（只用到行数和 datetime）
+            features: conversation_features 的结果（需带 max_depth 列）
+            cube: 该分片的 TimeCube
+            shard: 分片名称（用于按用户的视图）
+        """
+        flags, sums, histograms = cls._conversation_parts(features)
+        histograms.update({
+            'hourly_messages': cube.rollup('hour'),
+            'weekday_messages': cube.rollup('day_of_week'),
+            'daily_conversations': cube.distinct_conversations('date'),
+            'daily_messages': cube.rollup('date'),
+            'monthly_conversations': cube.distinct_conversations('month'),
+            'monthly_messages': cube.rollup('month'),
+        })
+        histograms = {name: _counts(series, HISTOGRAMS[name]) for name, series in histograms.items()}
+        times = messages_df['datetime']
+        return cls([shard], int(len(features)), int(len(messages_df)),
+                   _timestamp(times.min()), _timestamp(times.max()), flags, sums, histograms)
+
+    @classmethod
+    def from_activity(cls, features: pd.DataFrame, activity: pd.DataFrame,
+                      shard: str = '.') -> 'PartialMetrics':
+        """
+        从对话特征表和对话活动表（conversation_activity 的结果）计算部分聚合
+
+        用于只涉及一部分对话的增量更新：两张表都只需包含这些对话的行。
+        """
+        flags, sums, histograms = cls._conversation_parts(features)
+        counts = activity['message_count']
+        conv_activity = activity[activity['conversation_id'].notna()]
+        months = pd.to_datetime(conv_activity['date']).dt.to_period('M')
+        histograms.update({
+            'hourly_messages': counts.groupby(activity['hour']).sum(),
+            'weekday_messages': counts.groupby(activity['day_of_week']).sum(),
+            'daily_conversations': conv_activity.groupby('date')['conversation_id'].nunique(),
+            'daily_messages': counts.groupby(activity['date']).sum(),
+            'monthly_conversations': conv_activity['conversation_id'].groupby(months).nunique(),
+            'monthly_messages': counts.groupby(pd.to_datetime(activity['date']).dt.to_period('M')).sum(),
+        })
+        histograms = {name: _counts(series, HISTOGRAMS[name]) for name, series in histograms.items()}
+        first_time = features['first_message_time'].min() if len(features) else None
+        last_time = features['last_message_time'].max() if len(features) else None
+        return cls([shard], int(len(features)), int(counts.sum()),
+                   _timestamp(first_time), _timestamp(last_time), flags, sums, histograms)
+
+    def merge(self, other: 'PartialMetrics') -> 'PartialMetrics':
+        """把另一份部分聚合加到自身，返回自身"""
+        self.shards = self.shards + other.shards
+        self.conversations += other.conversations
+        self.messages += other.messages
+        for attr, pick in (('first_time', min), ('last_time', max)):
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            setattr(self, attr, theirs if mine is None else mine if theirs is None else pick(mine, theirs))
+        self.conversation_flags = _add(self.conversation_flags, other.conversation_flags)
+        self.message_sums = _add(self.message_sums, other.message_sums)
+        for name in HISTOGRAMS:
+            self.histograms[name] = _add(self.histograms[name], other.histograms[name])
+        return self
+
+    def subtract(self, other: 'PartialMetrics') -> 'PartialMetrics':
+        """
+        从自身减去另一份部分聚合（other 必须是自身的一部分，如变更前的对话），返回自身
+
+        first_time / last_time 无法相减，由调用方重新设置。
+        """
+        self.conversations -= other.conversations
+        self.messages -= other.messages
+        self.conversation_flags = _add(self.conversation_flags, -other.conversation_flags)
+        self.message_sums = _add(self.message_sums, -other.message_sums)
+        for name in HISTOGRAMS:
+            difference = _add(self.histograms[name], -other.histograms[name])
+            self.histograms[name] = difference[difference != 0]
+        return self
+
+    @classmethod
+    def merge_all(cls, partials: Iterable['PartialMetrics']) -> 'PartialMetrics':
+        """合并多份部分聚合（不修改输入）"""
+        partials = list(partials)
+        merged = cls.from_dict(partials[0].to_dict())
+        for partial in partials[1:]:
+            merged.merge(partial)
+        return merged
+
+    def to_dict(self) -> dict:
+        """转换为可 JSON 序列化的字典"""
+        def series(s: pd.Series) -> dict:
+            return {str(k): int(v) for k, v in s.items()}
+
+        return {
+            'version': PARTIAL_VERSION,
+            'shards': self.shards,
+            'conversations': self.conversations,
+            'messages': self.messages,
+            'first_time': self.first_time.isoformat() if self.first_time is not None else None,
+            'last_time': self.last_time.isoformat() if self.last_time is not None else None,
+            'conversation_flags': series(self.conversation_flags),
+            'message_sums': series(self.message_sums),
+            'histograms': {name: series(s) for name, s in self.histograms.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PartialMetrics':
+        if data.get('version') != PARTIAL_VERSION:
+            raise ValueError(f"部分聚合版本不一致: {data.get('version')}（当前 {PARTIAL_VERSION}），请重新计算")
+
+        def series(d: dict, integer_index: bool = False) -> pd.Series:
+            return _counts(pd.Series(d, dtype='int64'), integer_index)
+
+        return cls(
+            list(data['shards']), int(data['conversations']), int(data['messages']),
+            _timestamp(data['first_time']), _timestamp(data['last_time']),
+            series(data['conversation_flags']), series(data['message_sums']),
+            {name: series(data['histograms'].get(name, {}), integer_index)
+             for name, integer_index in HISTOGRAMS.items()},
+        )
+
+    def save(self, path) -> None:
+        """写出为 JSON 文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path) -> 'PartialMetrics':
+        """读取部分聚合文件；path 为目录时读取其中的 PARTIAL_FILE"""
+        path = Path(path)
+        if path.is_dir():
+            path = path / PARTIAL_FILE
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+def histogram_mean(histogram: pd.Series) -> float:
+    """直方图（取值 -> 次数）表示的样本均值"""
+    return np.average(histogram.index, weights=histogram.to_numpy())
+
+
+def histogram_median(histogram: pd.Series) -> float:
+    """直方图表示的样本中位数（偶数个样本时取中间两个的平均，与 Series.median 一致）"""
+    histogram = histogram.sort_index()
+    cumulative = histogram.to_numpy().cumsum()
+    n = cumulative[-1]
+    lower = histogram.index[np.searchsorted(cumulative, (n - 1) // 2, side='right')]
+    upper = histogram.index[np.searchsorted(cumulative, n // 2, side='right')]
+    return (lower + upper) / 2
+
+
+def conversation_activity(messages_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    每个对话在每个 (日期, 小时) 的消息数，供 PartialMetrics.from_activity 使用
+
+    行数约为对话数乘以每个对话跨越的小时数，远小于消息数；增量更新时用来减去
+    变更对话原有的时间分布。
+
+    Args:
+        messages_df: 带派生时间列（date / hour / day_of_week）的 messages 表
+
+    Returns:
+        conversation_id, date（'YYYY-MM-DD' 字符串）, hour, day_of_week, message_count 五列
+    """
+    frame = pd.DataFrame({
+        'conversation_id': messages_df['conversation_id'].astype(object),
+        'date': messages_df['date'].map(lambda d: None if pd.isna(d) else str(d)),
+        'hour': messages_df['hour'],
+        'day_of_week': messages_df['day_of_week'],
+    })
+    keys = ['conversation_id', 'date', 'hour', 'day_of_week']
+    return frame.groupby(keys, dropna=False, sort=False).size().rename('message_count').reset_index()
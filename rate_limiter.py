@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+异步 API 调用的限流器（令牌桶）
+
+按每分钟请求数（RPM）和每分钟 token 数（TPM）两个维度限流：每个桶的容量为
+每分钟的额度，并按时间连续回填。请求发出前先从两个桶中取出额度，额度不足时
+等待回填，而不是在每次请求之间固定 sleep。
+
+用法示例：
+    limiter = RateLimiter(rpm=60, tpm=100000)
+    await limiter.acquire(estimate_tokens(prompt) + max_tokens)
+    response = await client.chat.completions.create(...)
+"""
+
+import asyncio
+import time
+from typing import Optional
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计文本的 token 数（不依赖具体模型的分词器）
+
+    中文等非 ASCII 字符大约每个字符一个 token，ASCII 文本大约每 4 个字符一个 token。
+    非 ASCII 字符数由 UTF-8 编码长度推算（中文每字 3 字节），不逐字符遍历。
+    """
+    non_ascii = (len(text.encode("utf-8")) - len(text)) // 2
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟额度，按秒连续回填"""
+
+    def __init__(self, per_minute: float, clock=time.monotonic):
+        if per_minute <= 0:
+            raise ValueError(f"每分钟额度应大于 0，得到: {per_minute}")
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> float:
+        """
+        取出 amount 个令牌，不足时等待
+
+        超过容量的请求按容量计（否则永远等不到）。请求按到达顺序排队。
+
+        Returns:
+            等待的秒数
+        """
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                delay = (amount - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self.tokens -= amount
+        return waited
+
+
+class RateLimiter:
+    """RPM + TPM 限流器；未设置（None 或 0）的维度不限流"""
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """
+        为一次请求取得额度
+
+        Args:
+            tokens: 这次请求预计消耗的 token 数（提示词 + 最大输出）
+
+        Returns:
+            等待的秒数
+        """
+        waited = 0.0
+        if self.requests is not None:
+            waited += await self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            waited += await self.tokens.acquire(tokens)
+        return waited
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+可合并的概率草图（sketch），用于超大数据集上的近似指标
+
+1. HyperLogLog - 近似去重计数（如对话数），内存固定为 2^precision 字节，
+   相对标准误差约 1.04 / sqrt(2^precision)
+2. KLLSketch - 近似分位数（如对话长度的中位数、P90），内存约为 O(k)，
+   归一化秩误差约 2.296 / k^0.9723（约 99% 置信度）
+
+两者都可以按块更新（numpy 向量化），也可以把不同分片 / 用户的草图合并，
+合并结果与把所有数据一次性放入同一个草图等价。
+"""
+
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def hash_values(values) -> np.ndarray:
+    """
+    把任意取值（字符串、category 等）哈希为 uint64，忽略空值
+
+    同一个取值在不同块、不同进程中的哈希相同，草图因此可以合并。
+    category 列只对类别哈希一次，再按编码取值。
+    """
+    series = pd.Series(values)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        categories = series.cat.categories.astype(str).to_numpy(dtype=object)
+        return hash_values(categories)[codes[codes >= 0]]
+    series = series.dropna()
+    if series.empty:
+        return np.empty(0, dtype=np.uint64)
+    return pd.util.hash_array(series.astype(str).to_numpy(dtype=object))
+
+
+def _bit_length(x: np.ndarray) -> np.ndarray:
+    """uint64 数组逐元素的二进制位数（0 的位数为 0）"""
+    x = x.copy()
+    n = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = x >= (np.uint64(1) << np.uint64(shift))
+        n[mask] += shift
+        x[mask] >>= np.uint64(shift)
+    return n + (x > 0)
+
+
+class HyperLogLog:
+    """HyperLogLog 去重计数草图"""
+
+    def __init__(self, precision: int = 14):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"precision 应在 4 到 18 之间，得到: {precision}")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def relative_error(self) -> float:
+        """估计值的相对标准误差（约 68% 置信度；两倍约为 95% 置信度）"""
+        return 1.04 / np.sqrt(len(self.registers))
+
+    def add(self, values) -> 'HyperLogLog':
+        """加入一批取值（空值会被忽略）"""
+        return self.add_hashes(hash_values(values))
+
+    def add_hashes(self, hashes: np.ndarray) -> 'HyperLogLog':
+        """加入一批已经哈希好的 uint64 值"""
+        if len(hashes) == 0:
+            return self
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        rest = hashes & ((np.uint64(1) << (np.uint64(64) - p)) - np.uint64(1))
+        # 剩余位中前导零的个数 + 1
+        rank = (64 - self.precision) - _bit_length(rest) + 1
+        np.maximum.at(self.registers, index, rank.astype(np.uint8))
+        return self
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        """合并另一个草图（精度必须相同），返回自身"""
+        if other.precision != self.precision:
+            raise ValueError("只能合并精度相同的 HyperLogLog")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> float:
+        """估计不同取值的个数"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # 小基数时改用线性计数
+            estimate = m * np.log(m / zeros)
+        return float(estimate)
+
+    @classmethod
+    def union(cls, sketches: Iterable['HyperLogLog']) -> 'HyperLogLog':
+        """多个草图的并集（不修改输入）"""
+        sketches = list(sketches)
+        result = cls(sketches[0].precision)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
+
+
+class KLLSketch:
+    """KLL 分位数草图"""
+
+    def __init__(self, k: int = 200, seed: Optional[int] = 0):
+        self.k = k
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def rank_error(self) -> float:
+        """分位数的归一化秩误差（约 99% 置信度）"""
+        return 2.296 / self.k ** 0.9723
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(items)
+            # 奇数个时留下一个，其余两两取一，权重翻倍后进入上一层
+            keep = items[-1:] if len(items) % 2 else items[:0]
+            pairs = items[:len(items) - len(keep)]
+            offset = int(self._rng.integers(2))
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], pairs[offset::2]])
+            self.levels[level] = keep
+            # 层数增加后下层容量会变小，从头检查
+            level = 0
+
+    def update(self, values) -> 'KLLSketch':
+        """加入一批数值（空值会被忽略）"""
+        values = pd.to_numeric(pd.Series(values), errors='coerce').dropna().to_numpy(dtype=float)
+        if len(values) == 0:
+            return self
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other: 'KLLSketch') -> 'KLLSketch':
+        """合并另一个草图，返回自身"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def quantile(self, q: float) -> float:
+        """估计 q 分位数（0 返回最小值，1 返回最大值）"""
+        if self.n == 0:
+            return float('nan')
+        if q <= 0:
+            return float(self.min)
+        if q >= 1:
+            return float(self.max)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1])
+        return float(items[order][min(position, len(items) - 1)])
+
+    def quantiles(self, qs: Iterable[float]) -> List[float]:
+        return [self.quantile(q) for q in qs]
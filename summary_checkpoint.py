@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+批次总结的断点文件（JSONL）
+
+每个批次完成（成功或失败）后立即追加一行：
+    {"batch": 3, "conversation_ids": [...], "prompt_hash": "...",
+     "status": "ok" | "failed", "summary": "...", "time": "..."}
+
+进程中途退出后用 --resume 重跑：提示词哈希相同且成功的批次直接使用断点中的
+总结，只重新请求失败（"[批次 N 生成失败 ...]" 或空回复）或尚未完成的批次。
+同一批次有多行时以最后一行为准，因此重试结果直接追加即可。
+
+断点文件只追加、从不清空：不带 --resume 的运行同样追加到已有文件末尾，
+之前付费得到的总结仍可在之后的 --resume 中使用。
+"""
+
+import hashlib
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# generate_batch_summaries 在 API 调用失败时返回的占位文本
+FAILED_PATTERN = re.compile(r"^\[批次 \d+ 生成失败")
+
+
+def prompt_hash(prompt: str) -> str:
+    """批次提示词的哈希（用于判断断点中的结果是否仍然适用）"""
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def is_failed_summary(summary: Optional[str]) -> bool:
+    """失败占位文本，或空回复（API 可能返回 content=None）"""
+    return not summary or bool(FAILED_PATTERN.match(summary))
+
+
+class SummaryCheckpoint:
+    """追加写入的批次结果记录"""
+
+    def __init__(self, path, resume: bool = False):
+        """
+        Args:
+            path: 断点文件路径
+            resume: 为 True 时读取已有记录；否则不使用已有记录（但保留在文件中，
+                新结果追加在后面）
+        """
+        self.path = Path(path)
+        self.entries: Dict[str, dict] = {}
+        if resume and self.path.exists():
+            self._load()
+        # 上次运行在写一行的中途被中断时补上换行，避免新记录接在残行后面
+        if self.path.exists() and self.path.stat().st_size:
+            with open(self.path, "rb") as f:
+                f.seek(-1, 2)
+                if f.read(1) != b"\n":
+                    with open(self.path, "a", encoding="utf-8") as out:
+                        out.write("\n")
+
+    def _load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 写到一半时被中断的最后一行
+                    continue
+                self.entries[entry["prompt_hash"]] = entry
+
+    def completed(self, conversation_ids: List[str], prompt_hash: str) -> Optional[str]:
+        """批次已成功完成时返回其总结，否则返回 None"""
+        entry = self.entries.get(prompt_hash)
+        if entry is None or entry["status"] != "ok" or entry["conversation_ids"] != list(conversation_ids):
+            return None
+        return entry["summary"]
+
+    def record(self, batch_number: int, conversation_ids: List[str], prompt_hash: str,
+               summary: Optional[str]) -> None:
+        """追加一个批次的结果并立即写盘"""
+        entry = {
+            "batch": batch_number,
+            "conversation_ids": list(conversation_ids),
+            "prompt_hash": prompt_hash,
+            "status": "failed" if is_failed_summary(summary) else "ok",
+            "summary": summary,
+            "time": datetime.now().isoformat(timespec="seconds"),
+        }
+        self.entries[prompt_hash] = entry
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
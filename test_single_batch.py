@@ -3,20 +3,22 @@
 测试版本：只处理第一个批次的对话（30个对话）
 """
 
-import pandas as pd
-import json
+import argparse
 import os
 from datetime import datetime
 from typing import List
 from openai import OpenAI
 from dotenv import load_dotenv
 
+from conversation_prompts import load_conversation_texts
+from llm_cache import cache_summary, chat_completion, disable_cache
+
 
 # 加载环境变量
 load_dotenv()
 
 # 初始化 OpenAI 客户端
-API_BASE_URL = "https://space.ai-builders.com/backend/v1"
+API_BASE_URL = os.getenv("AI_BUILDER_BASE_URL", "https://space.ai-builders.com/backend/v1")
 api_key = os.getenv("AI_BUILDER_TOKEN")
 
 if not api_key:
@@ -27,47 +29,6 @@ client = OpenAI(
     api_key=api_key
 )
 
-
-def prepare_conversation_summary(messages_df: pd.DataFrame, conv_id: str) -> str:
-    """为单个对话准备摘要文本"""
-    conv_messages = messages_df[messages_df['conversation_id'] == conv_id].copy()
-    
-    if len(conv_messages) == 0:
-        return ""
-    
-    title = conv_messages.iloc[0]['conversation_title'] or "无标题"
-    conv_messages = conv_messages.sort_values('create_time')
-    
-    summary_parts = [f"对话标题: {title}\n对话ID: {conv_id}\n\n"]
-    
-    for idx, msg in conv_messages.iterrows():
-        role = msg['role']
-        if pd.isna(role):
-            continue
-            
-        text = str(msg['text']) if pd.notna(msg['text']) else ""
-        if len(text.strip()) < 10:
-            continue
-        
-        # 截断过长的文本
-        if len(text) > 500:
-            text = text[:500] + "...[已截断]"
-        
-        # 添加标签
-        tags = []
-        if msg['has_code']:
-            tags.append("代码")
-        if msg['has_image']:
-            tags.append("图片")
-        if msg['has_link']:
-            tags.append("链接")
-        tag_str = f"[{', '.join(tags)}]" if tags else ""
-        
-        summary_parts.append(f"{role.upper()}: {text} {tag_str}\n")
-    
-    return "\n".join(summary_parts)
-
-
 def generate_batch_summaries(conversations_text: List[str]) -> str:
     """调用 API 为一批对话生成总结"""
     conversations_combined = "\n\n" + "="*80 + "\n\n".join(
@@ -100,7 +61,8 @@ def generate_batch_summaries(conversations_text: List[str]) -> str:
     print(f"正在调用 API 生成总结（{len(conversations_text)} 个对话）...")
     
     try:
-        response = client.chat.completions.create(
+        summary = chat_completion(
+            client,
             model="deepseek",
             messages=[
                 {"role": "system", "content": "你是一个专业的对话分析专家，擅长从对话中提取关键信息和用户行为模式。"},
@@ -109,8 +71,6 @@ def generate_batch_summaries(conversations_text: List[str]) -> str:
             temperature=0.7,
             max_tokens=4000
         )
-        
-        summary = response.choices[0].message.content
         return summary
         
     except Exception as e:
@@ -122,33 +82,32 @@ def generate_batch_summaries(conversations_text: List[str]) -> str:
 
 def main():
     """主函数 - 只处理第一个批次"""
+    parser = argparse.ArgumentParser(description="测试版本：只处理第一个批次的对话")
+    parser.add_argument("--no-cache", action="store_true", help="不使用 API 响应缓存（见 llm_cache.py）")
+    if parser.parse_args().no_cache:
+        disable_cache()
+    
     print("="*80)
     print("测试版本：处理第一个批次（30个对话）")
     print("="*80)
     
-    messages_file = "messages.csv"
+    data_dir = "."
     batch_size = 30
     output_file = "test_batch_summary.md"
     
-    # 读取数据
-    print(f"\n正在读取 {messages_file}...")
-    messages_df = pd.read_csv(messages_file)
-    print(f"总消息数: {len(messages_df)}")
+    # 读取数据：有 dataset.sqlite 时按对话索引查询，否则整表读入后分组一次
+    conversation_ids, conversation_texts = load_conversation_texts(data_dir, limit=batch_size)
     
-    # 获取前30个对话 ID
-    conversation_ids = messages_df['conversation_id'].unique().tolist()[:batch_size]
     print(f"本次测试处理对话数: {len(conversation_ids)}")
     
     # 准备对话摘要
     print(f"\n正在准备对话摘要...")
     batch_texts = []
     
-    for i, conv_id in enumerate(conversation_ids, 1):
-        conv_text = prepare_conversation_summary(messages_df, conv_id)
-        if conv_text:
-            batch_texts.append(conv_text)
-            if i % 10 == 0:
-                print(f"  已准备 {i}/{len(conversation_ids)} 个对话")
+    for i, (conv_id, conv_text) in enumerate(conversation_texts, 1):
+        batch_texts.append(conv_text)
+        if i % 10 == 0:
+            print(f"  已准备 {i}/{len(conversation_ids)} 个对话")
     
     print(f"  准备完成，有效对话数: {len(batch_texts)}")
     
@@ -167,6 +126,7 @@ def main():
         f.write("\n")
     
     print(f"\n✅ 完成！结果已保存到: {output_file}")
+    print(cache_summary())
     print(f"\n总结预览:")
     print("-" * 80)
     # 显示前500个字符
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+时间维度的预聚合立方体（rollup cube）
+
+把 messages 表按 (date, hour, day_of_week, role, content_type, model_slug) 聚合成
+单元格，每个单元格保存消息数、对话数和内容标签计数。所有时间模式的统计
+（按小时、星期、日期、月份，或任意日期区间内的筛选）都在单元格上完成，
+开销随单元格数而不是消息数增长。
+
+对话数不能跨单元格相加（同一对话会出现在多个单元格中），因此另存一张
+(conversation_id, date) 表，按日期 / 月份去重计数时使用。
+
+用法示例：
+    cube = load_time_cube('.', messages_df)
+    cube.rollup('hour')                                    # 每小时消息数
+    cube.rollup(['day_of_week', 'hour'])                   # 热力图
+    cube.rollup('date', start='2024-01-01', role='user')   # 区间 + 筛选
+    cube.distinct_conversations('month')                   # 每月对话数
+"""
+
+from typing import List, Union
+
+import pandas as pd
+
+from dataset_io import cached_build
+
+
+CUBE_VERSION = 1
+CUBE_DIMENSIONS = ['date', 'hour', 'day_of_week', 'role', 'content_type', 'model_slug']
+# 单元格中可相加的计数列（conversation_count 为单元格内的对话数，不可跨单元格相加）
+FLAG_MEASURES = {'has_code': 'code_messages', 'has_image': 'image_messages', 'has_link': 'link_messages'}
+
+
+def _months(dates: pd.Series) -> pd.Series:
+    return pd.to_datetime(dates).dt.to_period('M')
+
+
+class TimeCube:
+    """时间维度立方体：cells 为聚合单元格，conv_days 为 (conversation_id, date) 去重表"""
+
+    def __init__(self, cells: pd.DataFrame, conv_days: pd.DataFrame):
+        self.cells = cells
+        self.conv_days = conv_days
+
+    @classmethod
+    def from_messages(cls, messages_df: pd.DataFrame) -> 'TimeCube':
+        """
+        从带派生时间列（load_prepared）的 messages 表构建立方体
+
+        缺失的维度列（如旧数据集没有 model_slug）按空值处理。
+        """
+        frame = pd.DataFrame(index=messages_df.index)
+        for dim in CUBE_DIMENSIONS:
+            values = messages_df[dim] if dim in messages_df.columns else None
+            frame[dim] = values.astype(object) if values is not None else None
+        frame['conversation_id'] = messages_df['conversation_id'].astype(object)
+        for flag, measure in FLAG_MEASURES.items():
+            frame[measure] = messages_df[flag].astype(bool) if flag in messages_df.columns else False
+
+        # 空值也是合法的维度取值（例如没有 message 的节点 role 为空），不能丢弃
+        grouped = frame.groupby(CUBE_DIMENSIONS, dropna=False, sort=True)
+        cells = grouped.agg(
+            message_count=('conversation_id', 'size'),
+            conversation_count=('conversation_id', 'nunique'),
+            **{measure: (measure, 'sum') for measure in FLAG_MEASURES.values()},
+        ).reset_index()
+
+        conv_days = (
+            frame.groupby(['conversation_id', 'date'], dropna=False, sort=False)
+            .size().rename('message_count').reset_index()
+        )
+        return cls(cells, conv_days)
+
+    def _select(self, table: pd.DataFrame, start=None, end=None, **filters) -> pd.DataFrame:
+        """按日期区间（含两端）和维度取值筛选"""
+        mask = pd.Series(True, index=table.index)
+        if start is not None or end is not None:
+            dates = pd.to_datetime(table['date'])
+            if start is not None:
+                mask &= dates >= pd.Timestamp(start)
+            if end is not None:
+                mask &= dates <= pd.Timestamp(end)
+        for dim, value in filters.items():
+            if dim not in table.columns:
+                raise ValueError(f"未知的维度: {dim}，可选: {', '.join(CUBE_DIMENSIONS)}")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            mask &= table[dim].isin(values)
+        return table[mask]
+
+    def rollup(self, by: Union[str, List[str]], measure: str = 'message_count',
+               start=None, end=None, **filters) -> pd.Series:
+        """
+        按维度汇总可相加的计数
+
+        Args:
+            by: 汇总维度（CUBE_DIMENSIONS 之一或列表，另支持 'month'）
+            measure: message_count / code_messages / image_messages / link_messages
+            start, end: 日期区间（含两端），如 '2024-01-01'
+            **filters: 维度筛选，如 role='user'、content_type=['text', 'code']
+
+        Returns:
+            以汇总维度为索引的计数 Series（按维度排序，空值维度被忽略）
+        """
+        cells = self._select(self.cells, start, end, **filters)
+        if by == 'month' or (isinstance(by, list) and 'month' in by):
+            cells = cells.assign(month=_months(cells['date']))
+        return cells.groupby(by)[measure].sum()
+
+    def distinct_conversations(self, by: str = 'date', start=None, end=None) -> pd.Series:
+        """
+        按日期或月份统计（去重的）活跃对话数
+
+        Args:
+            by: 'date' 或 'month'
+            start, end: 日期区间（含两端）
+        """
+        conv_days = self._select(self.conv_days, start, end)
+        conv_days = conv_days[conv_days['conversation_id'].notna()]
+        if by == 'month':
+            conv_days = conv_days.assign(month=_months(conv_days['date']))
+        elif by != 'date':
+            raise ValueError(f"distinct_conversations 只支持 date / month，得到: {by}")
+        return conv_days.groupby(by)['conversation_id'].nunique()
+
+
+def load_time_cube(data_dir: str, messages_df: pd.DataFrame, use_cache: bool = True) -> TimeCube:
+    """
+    构建时间立方体；数据集源文件不变时直接读取缓存（见 dataset_io.cached_build）
+
+    Args:
+        data_dir: 数据目录
+        messages_df: 带派生时间列的 messages 表（缓存失效时才会用到）
+        use_cache: False 时不读也不写缓存
+    """
+    def build():
+        return TimeCube.from_messages(messages_df)
+
+    if not use_cache:
+        return build()
+    present = sorted(set(CUBE_DIMENSIONS + list(FLAG_MEASURES)) & set(messages_df.columns))
+    return cached_build(data_dir, 'time_cube', [CUBE_VERSION, present], build)
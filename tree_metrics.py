@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+对话树结构指标的向量化计算
+
+基于 edges 表一次性计算所有对话的树指标，不逐个对话、逐个节点过滤：
+1. node_depths - 每个节点的深度（指针跳跃：把 (对话, 节点) 编码成整数后，
+   parent 数组每轮自乘一次，O(log 最大深度) 轮 numpy 运算即可得到全部深度）
+2. conversation_tree_stats - 每个对话的最大/平均/中位深度和分叉系数
+
+messages 表带有导入时计算的 depth 列时直接使用该列，只在旧数据集上从 edges 推算。
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+TREE_STAT_COLUMNS = [
+    "max_depth", "mean_depth", "median_depth", "node_count",
+    "branching_factor", "branch_points",
+]
+
+
+def _encode_nodes(edges_df: pd.DataFrame, messages_df: Optional[pd.DataFrame] = None):
+    """
+    把 (conversation_id, node_id) 编码为连续整数
+
+    Returns:
+        (nodes, parent_codes, child_codes)：nodes 为按编码排列的
+        conversation_id/node_id 表，后两者为每条边两端的编码
+    """
+    frames = [
+        pd.DataFrame({"conversation_id": edges_df["conversation_id"], "node_id": edges_df["parent_id"]}),
+        pd.DataFrame({"conversation_id": edges_df["conversation_id"], "node_id": edges_df["child_id"]}),
+    ]
+    if messages_df is not None:
+        # 没有任何边的节点（只有一个节点的对话）也要计入
+        frames.append(messages_df[["conversation_id", "node_id"]])
+    stacked = pd.concat(frames, ignore_index=True)
+    stacked["conversation_id"] = stacked["conversation_id"].astype(object)
+    codes = stacked.groupby(["conversation_id", "node_id"], sort=False, dropna=False).ngroup().to_numpy()
+
+    num_edges = len(edges_df)
+    nodes = stacked.iloc[np.unique(codes, return_index=True)[1]].reset_index(drop=True)
+    return nodes, codes[:num_edges], codes[num_edges:2 * num_edges]
+
+
+def node_depths(edges_df: pd.DataFrame, messages_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    从 edges 表计算每个节点的深度（根节点为 0）
+
+    Args:
+        edges_df: 边表（conversation_id, parent_id, child_id）
+        messages_df: 可选，提供 conversation_id/node_id 以包含孤立节点
+
+    Returns:
+        conversation_id, node_id, depth, out_degree 四列的 DataFrame
+    """
+    nodes, parents, children = _encode_nodes(edges_df, messages_df)
+    n = len(nodes)
+
+    # parent[i] 为 i 的父节点编码，根节点指向自身；一个节点出现在多条边中时取第一条
+    parent = np.arange(n)
+    first_edge = np.unique(children, return_index=True)[1]
+    parent[children[first_edge]] = parents[first_edge]
+
+    depth = (parent != np.arange(n)).astype(np.int64)
+    # 指针跳跃：每轮后 depth[i] 为 i 到 parent[i] 的距离，parent 跳到原来的祖父节点
+    # 有环的节点永远收敛不到根，轮数上限保证终止
+    for _ in range(max(1, int(np.ceil(np.log2(max(n, 2))))) + 1):
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            break
+        depth = depth + depth[parent]
+        parent = grand
+
+    nodes["depth"] = depth
+    nodes["out_degree"] = np.bincount(parents, minlength=n) if n else np.zeros(0, dtype=np.int64)
+    return nodes
+
+
+def conversation_tree_stats(edges_df: pd.DataFrame,
+                            messages_df: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    计算每个对话的树指标
+
+    Args:
+        edges_df: 边表
+        messages_df: 可选；带 depth 列时直接用导入时的深度，否则只用于补充孤立节点
+
+    Returns:
+        以 conversation_id 为索引的 DataFrame，列为 TREE_STAT_COLUMNS：
+        max_depth / mean_depth / median_depth - 节点深度的最大值、均值、中位数
+        node_count - 节点数
+        branching_factor - 非叶节点的平均子节点数
+        branch_points - 子节点数大于 1 的节点数（重新生成 / 编辑产生的分叉）
+    """
+    nodes = node_depths(edges_df, messages_df)
+    if messages_df is not None and "depth" in messages_df.columns:
+        imported = messages_df[["conversation_id", "node_id", "depth"]].astype({"conversation_id": object})
+        nodes = nodes.drop(columns="depth").merge(imported, on=["conversation_id", "node_id"], how="inner")
+
+    grouped = nodes.groupby("conversation_id", sort=False)
+    stats = pd.DataFrame({
+        "max_depth": grouped["depth"].max(),
+        "mean_depth": grouped["depth"].mean(),
+        "median_depth": grouped["depth"].median(),
+        "node_count": grouped.size(),
+    })
+    internal = nodes[nodes["out_degree"] > 0].groupby("conversation_id", sort=False)["out_degree"]
+    stats["branching_factor"] = internal.mean().reindex(stats.index).fillna(0.0)
+    stats["branch_points"] = (
+        (nodes["out_degree"] > 1).groupby(nodes["conversation_id"], sort=False).sum().reindex(stats.index)
+    )
+    return stats[TREE_STAT_COLUMNS]